@@ -7,6 +7,8 @@ import pyrap.tables as pt
 import numpy as np
 from datetime import datetime
 from pyrap.quanta import quantity
+from tools.imagestats import image_std
+from tools.mosaic.avgpbz import zero_avgpb
 
 rootpath=os.path.realpath(__file__)
 rootpath=rootpath.split("/")[:-1]
@@ -199,76 +201,7 @@ def check_msformat(mssets):
 	return True, beams, bands, obsids, obsids_beams, obsids_bands
 
 def getimgstd(infile):
-	fln=pyfits.open(infile)
-	rawdata=fln[0].data
-	angle=fln[0].header['obsra']
-	bscale=fln[0].header['bscale']
-	rawdata=rawdata.squeeze()
-	rawdata=rawdata*bscale
-	while len(rawdata) < 20:
-		rawdata = rawdata[0]
-	X,Y = np.shape(rawdata)
-	rawdata = rawdata[Y/6:5*Y/6,X/6:5*X/6]
-	orig_raw = rawdata
-	med, std, mask = Median_clip(rawdata, full_output=True, ftol=0.0, max_iter=10, sigma=3)
-	rawdata[mask==False] = med
-	fln.close()
-	return std
-
-def Median_clip(arr, sigma=3, max_iter=3, ftol=0.01, xtol=0.05, full_output=False, axis=None):
-    """Median_clip(arr, sigma, max_iter=3, ftol=0.01, xtol=0.05, full_output=False, axis=None)
-    Return the median of an array after iteratively clipping the outliers.
-    The median is calculated upon discarding elements that deviate more than
-    sigma * standard deviation the median.
-
-    arr: array to calculate the median from.
-    sigma (3): the clipping threshold, in units of standard deviation.
-    max_iter (3): the maximum number of iterations. A value of 0 will
-        return the usual median.
-    ftol (0.01): fraction tolerance limit for convergence. If the number
-        of discarded elements changes by less than ftol, the iteration is
-        stopped.
-    xtol (0.05): absolute tolerance limit for convergence. If the number
-        of discarded elements increases above xtol with respect to the
-        initial number of elements, the iteration is stopped.
-    full_output (False): If True, will also return the indices that were good.
-    axis (None): Axis along which the calculation is to be done. NOT WORKING!!!
-
-    >>> med = Median_clip(arr, sigma=3, max_iter=3)
-    >>> med, std, inds_good = Median_clip(arr, sigma=3, max_iter=3, full_output=True)
-    """
-    arr = np.ma.masked_invalid(arr)
-    med = np.median(arr, axis=axis)
-    std = np.std(arr, axis=axis)
-    ncount = arr.count(axis=axis)
-    for niter in xrange(max_iter):
-        ncount_old = arr.count(axis=axis)
-        if axis is not None:
-            condition = (arr < np.expand_dims(med-std*sigma, axis)) + (arr > np.expand_dims(med+std*sigma, axis))
-        else:
-            condition = (arr < med-std*sigma) + (arr > med+std*sigma)
-        arr = np.ma.masked_where(condition, arr)
-        ncount_new = arr.count(axis)
-        med = np.median(arr, axis=axis)
-        std = np.std(arr, axis=axis)
-        if np.any(ncount-ncount_new > xtol*ncount):
-            print( "xtol reached {}; breaking at iteration {}".format(1-1.*ncount_new/ncount, niter+1) )
-            break
-        if np.any(ncount_old-ncount_new < ftol*ncount_old):
-            print( "ftol reached {}; breaking at iteration {}".format(1-1.*ncount_new/ncount_old, niter+1) )
-            break
-    if full_output:
-        if isinstance(arr.mask, np.bool_):
-            mask = np.ones(arr.shape, dtype=bool)
-        else:
-            mask = ~arr.mask
-        if axis is not None:
-            med = med.data
-            std = std.data
-        return med, std, mask
-    if axis is not None:
-        med = med.data
-    return med
+	return image_std(infile)
 
 def checkpres(file):
 	if not os.path.isfile(file):
@@ -301,11 +234,18 @@ def create_mask(todo, mask_size, out):
 		subprocess.call(["rm", "-r", "{0}.temp".format(skymodel)])
 		
 def splitdataset(dataset, interval, out):
+	"""
+	Splits a dataset into time intervals. The TIME column is read and sorted once, with each interval's rows found from \
+	the sorted times, so every row is only read once when the intervals are written.
+	"""
 	name=dataset.split("/")[-1]
 	print "Splitting {0} by {1} sec intervals...".format(name ,interval)
 	t = pt.table(dataset, ack=False)
-	starttime = t[0]['TIME']
-	endtime   = t[t.nrows()-1]['TIME']
+	times = t.getcol('TIME')
+	starttime = times[0]
+	endtime   = times[-1]
+	order = np.lexsort((t.getcol('ANTENNA2'), t.getcol('ANTENNA1'), times))
+	sortedtimes = times[order]
 	numberofsplits=int((endtime-starttime)/interval)
 	for split in range(0, numberofsplits):
 		outputname=os.path.join(out, "splitMS", name+".{0}sec_{1:04d}.split".format(int(interval), split+1))
@@ -314,8 +254,10 @@ def splitdataset(dataset, interval, out):
 		else:
 			thisstart=starttime+(float(split)*interval)
 		thisend=starttime+((float(split)+1)*interval)
-		t1 = t.query('TIME > ' + str(thisstart) + ' && \
-		TIME < ' + str(thisend), sortlist='TIME,ANTENNA1,ANTENNA2')
+		first = np.searchsorted(sortedtimes, thisstart, side='right')
+		last = np.searchsorted(sortedtimes, thisend, side='left')
+		t1 = t.selectrows(order[first:last])
+		#a deep copy, so each interval has its own OBSERVATION table for the time range below
 		t1.copy(outputname, True)
 		t1.close()
 		if split==0:
@@ -335,30 +277,33 @@ def create_mosaics(tomos, out, time_mode, avgpbrad, usencp):
 	if time_mode:
 		allimages=sorted(glob.glob(os.path.join(out, mos_obsid, "mosaics", "*{0}*.restored.corr".format(mos_band))))
 		max_window=max([int(w.split(".split")[0].split("_")[-1]) for w in allimages])
+		#the pointings are the same in every window, so the regridding plan is made once and reused
+		plandir=os.path.join(out, mos_obsid, "mosaics", "plans_{0}".format(mos_band))
 		for window in range(1, max_window+1):
 			images=sorted(glob.glob(os.path.join(out, mos_obsid, "mosaics", "*{0}*_{1:04d}.split*.restored.corr".format(mos_band, window))))
 			avgpbs=sorted(glob.glob(os.path.join(out, mos_obsid, "mosaics", "*{0}*_{1:04d}.split*.avgpb".format(mos_band, window))))
 			for pb in avgpbs:
 				print "Zeroing corners of avgpb {0}...".format(pb)
-				subprocess.call("{0} -r {1} {2}".format(tools["mosaicavgpb"], avgpbrad, pb), shell=True)
+				zero_avgpb(pb, radius=avgpbrad)
 			images_formatted=[j.replace(".restored.corr", "") for j in images]
 			images_cmd=",".join(images_formatted)
 			print "Creating Mosaic for {0} {1} Window {2}...".format(mos_obsid, mos_band, window)
 			mosname=os.path.join(out, mos_obsid, "mosaics", "{0}_{1}_window{2:04d}_mosaic.fits".format(mos_obsid, mos_band, window))
 			sensname=os.path.join(out, mos_obsid, "mosaics", "{0}_{1}_window{2:04d}_mosaic_sens.fits".format(mos_obsid, mos_band, window))
 			if usencp:
-				subprocess.call("{0} -N -a avgpbz -o {1} -s {2} {3}".format(tools["mosaic"], mosname, sensname, images_cmd), shell=True)
+				subprocess.call("{0} -N -a avgpbz -o {1} -s {2} -P {3} {4}".format(tools["mosaic"], mosname, sensname, plandir, images_cmd), shell=True)
 			else:
-				subprocess.call("{0} -a avgpbz -o {1} -s {2} {3}".format(tools["mosaic"], mosname, sensname, images_cmd), shell=True)
+				subprocess.call("{0} -a avgpbz -o {1} -s {2} -P {3} {4}".format(tools["mosaic"], mosname, sensname, plandir, images_cmd), shell=True)
 			correctedfits=os.path.join(out, mos_obsid, images_formatted[0].split("/")[-1].replace("_mosaic", "")+".restored.corr.fits")
 			bw, endt, ant, ncore, nremote, nintl, subbandwidth, subbands=copyfitsinfo(correctedfits)
 			correctfits(mosname, bw, endt, ant, ncore, nremote, nintl, subbandwidth, subbands)
+		subprocess.call(["rm", "-rf", plandir])
 	else:
 		images=sorted(glob.glob(os.path.join(out, mos_obsid, "mosaics", "*{0}*.restored.corr".format(mos_band))))
 		avgpbs=sorted(glob.glob(os.path.join(out, mos_obsid, "mosaics", "*{0}*.avgpb".format(mos_band))))
 		for pb in avgpbs:
 			print "Zeroing corners of avgpb {0}...".format(pb)
-			subprocess.call("{0} -r {1} {2}".format(tools["mosaicavgpb"], avgpbrad, pb), shell=True)
+			zero_avgpb(pb, radius=avgpbrad)
 		images_formatted=[j.replace(".restored.corr", "") for j in images]
 		images_cmd=",".join(images_formatted)
 		print "Creating Mosaic for {0} {1}...".format(mos_obsid, mos_band)
@@ -101,8 +101,13 @@ group.add_option("--nice", action="store", type="int", dest="nice", default=conf
 group.add_option("--loglevel", action="store", type="string", dest="loglevel", default=config.get("GENERAL", "loglevel"),help="Use this option to set the print out log level ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'] [default: %default]")
 group.add_option("-D", "--lightweight", action="store_true", dest="destroy", default=config.getboolean("GENERAL", "lightweight"),help="Use this option to delete all the output except images, logs and plots [default: %default]")
 group.add_option("-n", "--ncores", action="store", type="int", dest="ncores", default=config.getint("GENERAL", "ncores"), help="Specify the number of observations to process simultaneously (i.e. the number of cores to use)[default: %default]")
+group.add_option("--maxmem", action="store", type="int", dest="maxmem", default=config.getint("GENERAL", "maxmem"), help="Specify the memory (in MB) the running steps may declare in total, 0 to only use the measured free memory [default: %default]")
+group.add_option("--diskbw", action="store", type="int", dest="diskbw", default=config.getint("GENERAL", "diskbw"), help="Specify the disk bandwidth (in MB/s) of the data disk to schedule I/O heavy steps against, 0 for no limit [default: %default]")
+group.add_option("--timeouts", action="store", type="string", dest="timeouts", default=config.get("GENERAL", "timeouts"), help="Specify timeouts in seconds for external tools, which are stopped and retried when they run over, as 'tool:seconds' separated by commas (0 for no limit) e.g. 'awimager:21600,NDPPP:7200' [default: %default]")
 group.add_option("-o", "--output", action="store", type="string", dest="newdir", default=config.get("GENERAL", "output"),help="Specify name of the directoy that the output will be stored in [default: %default]")
 group.add_option("-w", "--overwrite", action="store_true", dest="overwrite", default=config.getboolean("GENERAL", "overwrite"),help="Use this option to overwrite output directory if it already exists [default: %default]")
+group.add_option("--resume", action="store_true", dest="resume", default=False,help="Use this option to resume an interrupted run in the existing output directory, skipping the steps already completed [default: %default]")
+group.add_option("--cachedir", action="store", type="string", dest="cachedir", default=config.get("GENERAL", "cachedir"),help="Specify a directory in which to cache stage results, so that runs repeating a stage on the same data with the same parsets reuse them [default: %default]")
 parser.add_option_group(group)
 group = optparse.OptionGroup(parser, "LTA Options")
 group.add_option("--LTAfetch", action="store_true", dest="lta", default=config.getboolean("LTA", "LTAfetch"), help="Turn on or off LTA data fetching [default: %default]")
@@ -134,6 +139,10 @@ group.add_option("--concat-bands", action="store_true", dest="concatbands", defa
 group.add_option("--cobalt-flag", action="store_true", dest="cobalt", default=config.getboolean("PROCESSING", "cobalt-flag"),help="Flag pre-processed data for underperforming Cobalt stations [default: %default]")
 group.add_option("--aoflagger", action="store_true", dest="rfi", default=config.getboolean("PROCESSING", "aoflagger"),help="Use this option to run aoflagger before phase-only calibration [default: %default]")
 group.add_option("-f", "--flag", action="store_true", dest="autoflag", default=config.getboolean("PROCESSING", "autoflag"),help="Use this option to use autoflagging in processing [default: %default]")
+group.add_option("--fuse-shift", action="store_true", dest="fuseshift", default=config.getboolean("PROCESSING", "fuse-shift"),help="Only valid in bands mode, use this option to combine the bands \
+straight from the CORRECTED_DATA of the calibrated sub bands instead of first shifting it to new sets, saving a pass over the data. The kept sub band sets then \
+hold the uncalibrated DATA along with the calibrated CORRECTED_DATA, rather than the calibrated data in DATA [default: %default]")
+group.add_option("--autoflag-plots", action="store_true", dest="autoflagplots", default=config.getboolean("PROCESSING", "autoflag-plots"),help="Use this option to make the autoflag plots and station tables once processing has finished [default: %default]")
 group.add_option("--save-preflag", action="store_true", dest="saveflag", default=config.getboolean("PROCESSING", "save-preflag"),help="Use this option to save the measurement set before the auto station flagging [default: %default]")
 group.add_option("-t", "--postcut", action="store", type="int", dest="postcut", default=config.getint("PROCESSING", "postcut"),help="Use this option to enable post-bbs flagging, specifying the cut level [default: %default]")
 group.add_option("-P", "--PHASEONLY", action="store_true", dest="PHASEONLY", default=config.getboolean("PROCESSING", "PHASEONLY"),help="Choose just to perform only a phase only calibration on an already EXISTING rsmpp output [default: %default]")
@@ -153,6 +162,7 @@ detected and the respective model will be automatically fetched [default: %defau
 group.add_option("-s", "--targetmodel", action="store", type="string", dest="skymodel", default=config.get("SKYMODELS", "targetmodel"),help="Specify a particular field skymodel to use for the phase only calibration, by default the skymodels will be\
 automatically generated.[default: %default]")
 group.add_option("-r", "--targetradius", action="store", type="float", dest="skyradius", default=config.getfloat("SKYMODELS", "targetradius"), help="Radius of automatically generated field model [default: %default]")
+group.add_option("--catalogue", action="store", type="string", dest="catalogue", default=config.get("SKYMODELS", "catalogue"), help="Specify local source lists (comma separated, makesourcedb format) to create the field models from instead of gsm.py [default: %default]")
 group.add_option("-y", "--dummymodel", action="store", type="string", dest="dummymodel", default=config.get("SKYMODELS", "dummymodel"),help="Specify dummy model for use in applying gains [default: %default]")
 parser.add_option_group(group)
 group = optparse.OptionGroup(parser, "Peeling Options:")
@@ -160,6 +170,7 @@ group.add_option("-p", "--peeling", action="store_true", dest="peeling", default
 group.add_option("-q", "--peelnumsources", action="store", type="int", dest="peelnumsources", default=config.getint("PEELING", "peelnumsources"),help="Use this option to specify how many sources to peel [default: %default]")
 group.add_option("-l", "--peelfluxlimit", action="store", type="float", dest="peelfluxlimit", default=config.getfloat("PEELING", "peelfluxlimit"),help="Specify the minimum flux to consider a source for peeling (in Jy) [default: %default]")
 group.add_option("-v", "--peelingshort", action="store_true", dest="peelingshort", default=config.getboolean("PEELING", "peelingshort"),help="Use this option to skip the last section of the peeling procedure and NOT add back in the peeled sources [default: %default]")
+group.add_option("--archive-prepeel", action="store_true", dest="archiveprepeel", default=config.getboolean("PEELING", "archiveprepeel"),help="Use this option to keep the datasets from before peeling as compressed tar archives [default: %default]")
 group.add_option("-c", "--peelsources", action="store", type="string", dest="peelsources", default=config.get("PEELING", "peelsources"),help="Use this option to specify which sources to peel instead of the code taking the X brightest sources. Enter in the format\
  source1,source2,source3,.... [default: None]")
 parser.add_option_group(group)
@@ -258,6 +269,7 @@ cobalt=options.cobalt	#perform station flagging on pre-processed cobalt data
 precalloc=options.precalibloc	#precalibrated data location
 autoflag=options.autoflag	#autoflagging on or off
 saveflag=options.saveflag	#save the output prior to autoflag
+autoflagplots=options.autoflagplots	#make the autoflag plots at the end
 imaging_set=options.imaging	#if imaging is to be performed
 imagingmode=options.imagingmode	#which imaging mode to be used
 # automaticthresh=options.automaticthresh	#if the automated imaging threshold strategy should be used
@@ -271,14 +283,20 @@ mosaic=options.mosaic	#mosaic on off
 avpbrad=options.avgpbrad	#avgpbz radius
 ndppp_parset=options.ndppp #the ndppp parset name	
 n=options.ncores	#number of threads to use
+maxmem=options.maxmem	#memory the running steps may use in MB
+diskbw=options.diskbw	#disk bandwidth in MB/s
+timeouts=options.timeouts	#timeouts of the external tools
 newdirname=options.newdir	#name of output directory
 peeling=options.peeling	#peeling on off
 peelnumsources=options.peelnumsources	#number of sources to peel
 peelfluxlimit=options.peelfluxlimit	#flux limit of peeling sources
 shortpeel=options.peelingshort	#do not add the sources back in on off
+archiveprepeel=options.archiveprepeel	#compress the pre-peel datasets
 peelsources_todo=options.peelsources	#specify individual sources to peel
 postcut=options.postcut	#level of post bbs NDPPP to flag down to
 overwrite=options.overwrite	#to overwrite output directory if already exists
+resume=options.resume	#resume an interrupted run
+cachedir=options.cachedir	#directory of the stage cache
 calparset=options.calparset	#calibrator bbs parset
 data_dir=options.datadir	#directory where data to process is located
 calmodel=options.calmodel	#calibrator model
@@ -287,6 +305,7 @@ target_oddeven=options.target_oddeven.lower()	#if the targets are the odd of eve
 phaseparset=options.phaseparset	#phase only parset
 dummy=options.dummymodel	#dummy model for transfer
 skymodel=options.skymodel	#skymodel used in phase calibration
+catalogue=options.catalogue	#local catalogue for the field models
 root_dir=os.getcwd()	#where the script is run from
 destroy=options.destroy	#lightweight mode on or off
 bandsno=options.bandsno	#number of bands there should be
@@ -294,6 +313,7 @@ subsinbands=options.subsinbands	#number of sub bands to combine to make a band
 calibbeam=options.calibratorbeam	#calibrator beam in sim mode
 remaindersbs=options.remaindersbs	#remainder sub bands - only in sim mode
 phaseon=options.phaseon	#phase calibrate bands or sub bands
+fuseshift=options.fuseshift	#combine the bands from the unshifted calibrated sub bands
 concatbands=options.concatbands #continue to concat bands after sub band phase cal
 toprocess=options.obsids	#toprocess variable - what ID's to run
 lta=options.lta	#fetch data from lta on or off
@@ -398,6 +418,15 @@ If you would like to automatically generate a skymodel file do not use the -s op
 		sys.exit()
 	else:
 		create_sky=False
+
+#Check the local catalogue files and make their paths absolute, as models are created from within the run directory
+if create_sky and catalogue!="":
+	catfiles=[os.path.abspath(c) for c in catalogue.replace(" ", "").split(",")]
+	for c in catfiles:
+		if not os.path.isfile(c):
+			log.critical("Cannot locate catalogue {0}, please check file is present\nPipeline now stopping...".format(c))
+			sys.exit()
+	catalogue=",".join(catfiles)
 		
 if calmodel=="AUTO":
 	create_cal=True
@@ -472,7 +501,7 @@ if phaseO:
 			#Get new parset and skymodel if not present
 			checkforphase=os.path.join("..",phaseparset)
 			if os.path.isfile(checkforphase):
-				subprocess.call("cp {0} parsets/".format(checkforphase), shell=True)
+				subprocess.call(["cp", checkforphase, "parsets/"])
 			else:
 				log.critical("Cannot find phase parset in results or main parsets directory!")
 				sys.exit()
@@ -485,7 +514,7 @@ if phaseO:
 				else:
 					checkformodel=os.path.join("..",skymodel)
 					if os.path.isfile(checkformodel):
-						subprocess.call("cp {0} parsets/".format(checkformodel), shell=True)
+						subprocess.call(["cp", checkformodel, "parsets/"])
 					else:
 						log.critical("Cannot find sky model in main  parsets directory!")
 						sys.exit()
@@ -495,7 +524,7 @@ if phaseO:
 				if os.path.isdir(newoutput):
 					if overwrite:
 						log.info("Removing old phase only output...")
-						subprocess.call("rm -rf {0}".format(newoutput), shell=True)
+						subprocess.call(["rm", "-rf", newoutput])
 					else:
 						log.critical("{0} already exists! Use overwrite option or change output name.".format(newoutput))
 						sys.exit()
@@ -505,6 +534,9 @@ if phaseO:
 		workers=Pool(processes=n)
 		standalone_phase_multi=partial(rsmshared.standalone_phase, phaseparset=phaseparset, autoflag=autoflag, saveflag=saveflag, create_sky=create_sky, skymodel=skymodel, phaseoutput=phase_name, phasecolumn=phase_col)
 		workers.map(standalone_phase_multi, tophase)
+		if autoflag and autoflagplots:
+			log.info("Making autoflag plots...")
+			workers.map(rsmshared.plot_flag_stats, sorted(glob.glob("L*/flagging/*.stats")))
 		log.info("All finished successfully")
 		workers.close()
 		end=datetime.utcnow()
@@ -513,7 +545,7 @@ if phaseO:
 		if mail==True:
 			em.send_email(emacc,user_address,"rsmpp Job PHASE ONLY Completed","{0},\n\nYour job {1} has been completed - finished at {2} UTC with a runtime of {3}".format(user,newdirname, date_time_end, tdelta))
 		os.chdir("..")
-		subprocess.call("rm emailslofar.py* quick_keys.py*", shell=True)
+		rsmshared.remove_files(["emailslofar.py*", "quick_keys.py*"])
 		log.info("Run finished at {0} UTC with a runtime of {1}".format(date_time_end, str(tdelta)))
 		subprocess.call(["cp", "rsmpp_phaseonly.log", "{0}/rsmpp_phaseonly_{0}.log".format(newdirname)])
 	except Exception, e:
@@ -530,19 +562,43 @@ else:
 	#----------------------------------------------------------------------------------------------------------------------------------------------
 
 	# Checks that the output directory is not already present, overwrites if -w is used	
-	if os.path.isdir(newdirname) == True:
+	if resume:
+		if not os.path.isdir(newdirname):
+			log.critical("Cannot resume - output directory \"{0}\" does not exist.\n\
+	Pipeline now stopping...".format(newdirname))
+			sys.exit()
+		log.info("Resuming run in {0}...".format(newdirname))
+	elif os.path.isdir(newdirname) == True:
 		if overwrite==True:
 			log.info("Removing previous results directory...")
-			subprocess.call("rm -rf {0}".format(newdirname), shell=True)
+			subprocess.call(["rm", "-rf", newdirname])
 		else:
 			log.critical("Directory \"{0}\" already exists and overwrite option not used, run again with '-w' option to overwrite directory or rename/move old results file\n\
 	Pipeline now stopping...".format(newdirname))
 			sys.exit()
 	
+	#Stage cache, resolved before moving to the output directory
+	if cachedir!="":
+		cache=os.path.realpath(cachedir)
+		if not os.path.isdir(cache):
+			os.makedirs(cache)
+		log.info("Using stage cache in {0}".format(cache))
+	else:
+		cache=None
+
 	# Makes the new directory and moves to it
-	os.mkdir(newdirname)
+	if not resume:
+		os.mkdir(newdirname)
 	os.chdir(newdirname)
 	working_dir=os.getcwd()
+	#Ledger of the completed steps, used to resume
+	ledger=os.path.join(working_dir, "rsmpp_ledger.json")
+	#Catalog of the measurement set metadata, so each set's tables only need to be opened once - it is kept with the stage cache
+	#if there is one so that unchanged data is not validated again by later runs
+	if cache!=None:
+		rsmshared.catalog_file=os.path.join(cache, "rsmpp_catalog.sqlite")
+	else:
+		rsmshared.catalog_file=os.path.join(working_dir, "rsmpp_catalog.sqlite")
 
 	# Copies over all relevant files needed
 	subprocess.call(["cp","-r","../parsets", "."])
@@ -574,7 +630,9 @@ else:
 	#																			LTA Fetch
 	#----------------------------------------------------------------------------------------------------------------------------------------------
 
-	if lta:
+	if lta and resume:
+		log.warning("Resuming run - LTA fetch skipped, data already fetched to {0} will be used".format(data_dir))
+	elif lta:
 		log.info("LTA data fetch starting...")
 		#Set up LTA specific workers for downloading
 		#Fetch the html file to be used
@@ -656,9 +714,7 @@ else:
 				else:	
 					os.mkdir(lta_id)
 					ms_example=sorted(glob.glob("{0}*.dppp".format(lta_id)))[0]
-					temp=pt.table(ms_example+'/OBSERVATION', ack=False)
-					tempst=float(temp.getcell("LOFAR_OBSERVATION_START", 0))
-					temp.close()
+					tempst=rsmshared.ms_metadata(ms_example)["obs_start"]
 					if tempst >= antenna_range[0] and tempst <= antenna_range[1]:
 						antenna_corrections.append(lta_id)
 						log.warning("{0}\t{1}\tAntenna Tables Correction Required".format(ms_example, datetime.utcfromtimestamp(quantity('{0}s'.format(tempst)).to_unix_time())))
@@ -686,7 +742,7 @@ else:
 					antenna_workers.close()
 					os.chdir("..")
 					open('ANTENNA_CORRECTIONS_PERFORMED','a').close()
-					subprocess.call("rm -rf fixinfo*", shell=True)
+					rsmshared.remove_files(["fixinfo*"])
 				else:
 					log.warning("Unable to obtain the fixinfo script - antenna corrections will be skipped!")
 			else:
@@ -796,9 +852,11 @@ Pipeline now stopping...".format(i, data_dir))
 				sys.exit()
 			if not os.path.isdir(i):
 				if mastermode=="INT":
-					subprocess.call("mkdir -p {0}/logs {0}/flagging {0}/preflagged {0}/datasets".format(i), shell=True)
+					for d in ["logs", "flagging", "preflagged", "datasets"]:
+						os.makedirs(os.path.join(i, d))
 				else:
-					subprocess.call("mkdir -p {0}/logs {0}/flagging {0}/preflagged {0}/datasets {0}/calibrators".format(i), shell=True)
+					for d in ["logs", "flagging", "preflagged", "datasets", "calibrators"]:
+						os.makedirs(os.path.join(i, d))
 		if mastermode=="INT":
 			log.info("Calibrators to be processed:")
 			for i in calib_obs:
@@ -808,7 +866,8 @@ Pipeline now stopping...".format(i, data_dir))
 Pipeline now stopping...".format(i, data_dir))
 					sys.exit()
 				if not os.path.isdir(i):
-					subprocess.call("mkdir -p {0}/plots {0}/logs {0}/flagging".format(i), shell=True)
+					for d in ["plots", "logs", "flagging"]:
+						os.makedirs(os.path.join(i, d))
 
 
 		#----------------------------------------------------------------------------------------------------------------------------------------------
@@ -837,7 +896,18 @@ Pipeline now stopping...".format(i, data_dir))
 
 		log.info("Collecting and checking sub bands of observations..")
 		log.info("All measurement sets will be checked for any corruption.")
-		time.sleep(2)
+		#Validate and read the metadata of all the sets in parallel first so the checks below only have to query the catalog,
+		#sets which have not changed since a previous run are not validated again
+		toscan=[]
+		if mastermode=="INT":
+			scanobs=target_obs+calib_obs
+		else:
+			scanobs=target_obs
+		for o in scanobs:
+			toscan+=sorted(glob.glob(os.path.join(data_dir, o, "*.MS.dppp")))
+		scan_pool=Pool(processes=n)
+		rsmshared.scan_catalog(scan_pool, toscan)
+		scan_pool.close()
 		if mastermode=="INT":
 			for i,j in izip(target_obs, calib_obs):
 				missing_calibrators[i]=[]
@@ -857,14 +927,10 @@ Pipeline now stopping...".format(i, data_dir))
 				for c in calibs[j]:
 					calib_name=c.split("/")[-1]
 					#Check for corrupt datasets
-					try:
-						test=pt.table(c,ack=False)
-					except:
+					if rsmshared.ms_metadata(c)["corrupt"]:
 						log.warning("Calibrator {0} is corrupt!".format(calib_name))
-						time.sleep(1)
 						corrupt_calibrators[i].append(c)
 					else:
-						test.close()
 						SB=int(c.split('SB')[1][:3])				#Makes a list of all the Calib sub bands present
 						present_calibs.append(SB)
 				for s in calib_range:
@@ -897,14 +963,10 @@ Pipeline now stopping...".format(i, data_dir))
 				for c in calibs[i]:
 					calib_name=c.split("/")[-1]
 					#Check for corrupt datasets
-					try:
-						test=pt.table(c, ack=False)
-					except:
+					if rsmshared.ms_metadata(c)["corrupt"]:
 						log.warning("Calibrator {0} is corrupt!".format(calib_name))
-						time.sleep(1)
 						corrupt_calibrators[i].append(c)
 					else:
-						test.close()
 						SB=int(c.split('SB')[1][:3])				#Makes a list of all the Calib sub bands present
 						present_calibs.append(SB)
 				for s in calib_range:
@@ -930,8 +992,23 @@ Pipeline now stopping...".format(i, data_dir))
 		#----------------------------------------------------------------------------------------------------------------------------------------------
 		#																Main Run
 		#----------------------------------------------------------------------------------------------------------------------------------------------
-		#Create multiprocessing Pool
-		worker_pool = Pool(processes=n)
+		#Timeouts of the external tools, these also have to be set before the pool is created
+		for t in timeouts.split(","):
+			if t.strip()!="":
+				tool, limit=t.strip().split(":")
+				rsmshared.tool_limits.setdefault(tool, {})["timeout"]=int(limit) if int(limit)>0 else None
+		#Resource use of every command is recorded for the run report, this has to be set before the pool is created
+		stats=os.path.join(working_dir, "rsmpp_stats.json")
+		rsmshared.stats_file=stats
+		#Create multiprocessing Pool - it has more processes than cores so that cheap or I/O bound steps can be run alongside
+		#the CPU bound ones, with run_task_graph admitting the steps according to their costs below
+		worker_pool = Pool(processes=2*n)
+		#Declared cost of each kind of step: CPU threads, memory in MB and disk bandwidth in MB/s
+		task_costs={"ndppp":{"cpu":1, "mem":1000, "io":60}, "check":{"cpu":0.25, "mem":100, "io":5}, "cobalt":{"cpu":1, "mem":2000, "io":40},
+		"calibrate":{"cpu":1, "mem":2000, "io":40}, "band":{"cpu":1, "mem":1000, "io":80}, "aoflagger":{"cpu":1, "mem":4000, "io":40},
+		"phasecal":{"cpu":1, "mem":2000, "io":30}, "peel":{"cpu":1, "mem":3000, "io":30}, "postbbs":{"cpu":0.5, "mem":500, "io":60},
+		"rename":{"cpu":0, "mem":0, "io":0}, "concat":{"cpu":1, "mem":1000, "io":80}, "image":{"cpu":max(1, n/2), "mem":8000, "io":20},
+		"average":{"cpu":1, "mem":500, "io":20}, "mosaic":{"cpu":max(1, n/2), "mem":4000, "io":20}}
 
 		#Reads in NDPPP parset file ready for use
 		n_temp=open(ndppp_parset, 'r')
@@ -945,8 +1022,7 @@ Pipeline now stopping...".format(i, data_dir))
 		if not precal:
 			if create_cal:
 				log.info("Detecting calibrator and obtaining skymodel...")
-				calib_ms=pt.table(calibs[calibs.keys()[0]][0]+"/OBSERVATION", ack=False)
-				calib_name=calib_ms.col("LOFAR_TARGET")[0][0].replace(" ", "")
+				calib_name=rsmshared.ms_metadata(calibs[calibs.keys()[0]][0])["target"].replace(" ", "")
 				log.info("Calibrator Detected: {0}".format(calib_name))
 				calmodel="{0}.skymodel".format(calib_name)
 				if not os.path.isfile(os.path.join(mainrootpath, "skymodels", calmodel)):
@@ -956,32 +1032,39 @@ Pipeline now stopping...".format(i, data_dir))
 					sys.exit()
 				subprocess.call(["cp", os.path.join(mainrootpath, "skymodels", calmodel), "parsets/"])
 				calmodel=os.path.join("parsets", calmodel)
-				calib_ms.close()
 		
 			# Builds parmdb files as these are used over and over
 			log.info("Building calibrator sourcedb...")
-			if os.path.isdir('sky.calibrator'):
-				subprocess.call("rm -rf sky.calibrator", shell=True)
-			subprocess.call("makesourcedb in={0} out=sky.calibrator format=\'<\' > logs/skysourcedb.log 2>&1".format(calmodel), shell=True)
+			rsmshared.build_sourcedb(calmodel, "sky.calibrator", cache=cache, logfile="logs/skysourcedb.log", check=True)
 
 		log.info("Building dummy sourcedb...")
-		if os.path.isdir('sky.dummy'):
-			subprocess.call("rm -rf sky.dummy", shell=True)
-		subprocess.call("makesourcedb in={0} out=sky.dummy format=\'<\'  > logs/dummysourcedb.log 2>&1".format(dummy), shell=True)
+		rsmshared.build_sourcedb(dummy, "sky.dummy", cache=cache, logfile="logs/dummysourcedb.log", check=True)
 
 		#Creates the sky model for each pointing using script that creates sky model from measurement set.
 		if create_sky:
 			log.info("Creating skymodels for each beam...")
+			tocreate=[]
+			for b in beams:
+				beamc="SAP00{0}".format(b)
+				skymodel="parsets/{0}.skymodel".format(beamc)
+				if resume and os.path.isfile(skymodel):
+					log.info("Using {0} from the previous run".format(skymodel))
+				elif catalogue!="":
+					tocreate.append(beamc)
+				else:
+					rsmshared.create_model(targets[targets.keys()[0]][beamc][0], skymodel, options.skyradius)
+			if len(tocreate) > 0:
+				log.info("Searching catalogue {0} for {1}...".format(catalogue, ", ".join(tocreate)))
+				rsmshared.create_models([targets[targets.keys()[0]][beamc][0] for beamc in tocreate], ["parsets/{0}.skymodel".format(beamc) for beamc in tocreate], options.skyradius, catalogue, cache=cache)
 			for b in beams:
 				beamc="SAP00{0}".format(b)
 				skymodel="parsets/{0}.skymodel".format(beamc)
-				rsmshared.create_model(targets[targets.keys()[0]][beamc][0], skymodel, options.skyradius)
 				#Check it ran ok
 				if not os.path.isfile(skymodel):
 					log.critical("Skymodel {0} failed to be created, gsm.py may be broken, cannot continue".format(skymodel))
 					raise Exception("Skymodel {0} failed to be created".format(skymodel))
 				if imaging_set:
-					subprocess.call("makesourcedb in={0} out={1} format=\'<\' > logs/skysourcedb_{2}.log 2>&1".format(skymodel, skymodel.replace(".skymodel", ".sky"), beamc), shell=True)
+					rsmshared.build_sourcedb(skymodel, skymodel.replace(".skymodel", ".sky"), cache=cache, logfile="logs/skysourcedb_{0}.log".format(beamc))
 		elif multisky:
 			log.info("Copying skymodels for each beam...")
 			for b in sorted(multiskymodels.keys()):
@@ -989,124 +1072,88 @@ Pipeline now stopping...".format(i, data_dir))
 				subprocess.call(["cp", os.path.join("..",thismodel), b])
 				beamc=b.split("/")[-1].split(".")[0]
 				if imaging_set:
-					subprocess.call("makesourcedb in={0} out={1} format=\'<\' > logs/skysourcedb_{2}.log 2>&1".format(b, b.replace(".skymodel", ".sky"), beamc), shell=True)
+					rsmshared.build_sourcedb(b, b.replace(".skymodel", ".sky"), cache=cache, logfile="logs/skysourcedb_{0}.log".format(beamc))
 			create_sky=True
 			
 
-		#Now working through the steps starting with NDPPP (see rsmppfuncs.py for functions)
+		#Now working through the steps starting with NDPPP (see rsmppfuncs.py for functions). Rather than running each step over every dataset
+		#before moving on, all the steps are put into a task graph so that each sub band, and then band, moves on as soon as its own inputs are ready.
 		postcorrupt=0
-		# for i,j in izip(sorted(targets.keys()), sorted(calibs)):
-		for snpsht in range(0, len(targets.keys())):
-			i=sorted(targets.keys())[snpsht]
-			if mastermode=="INT":
-				j=sorted(calibs.keys())[snpsht]
-				log.info("Starting Initial NDPPP for {0} and {1}...".format(i, j))
+		if not os.path.isfile("post_ndppp_corrupt_report.txt"):
+			corrupt_report=open("post_ndppp_corrupt_report.txt", 'w')
+			corrupt_report.close()
+		if mode=="UNKNOWN":
+			msfreq=rsmshared.ms_metadata(targets[sorted(targets.keys())[0]]["SAP00{0}".format(beams[0])][0])["ref_freq"]
+			if int(msfreq)/1e6 < 100:
+				mode="LBA"
 			else:
-				j=i
-				log.info("Starting Initial NDPPP for {0}...".format(i))
-			#Nearly all functions are used with partial such that they can be passed to .map
-			NDPPP_Initial_Multi=partial(rsmshared.NDPPP_Initial, wk_dir=working_dir, ndppp_base=ndppp_base, prec=precal, precloc=precalloc)
-			#Define calibrator observation depending on mode
-			if __name__ == '__main__':
-				if not precal:
-					worker_pool.map(NDPPP_Initial_Multi, calibs[j])
-					calibs[j] = sorted(glob.glob(os.path.join(j,"*.tmp")))
-					if not os.path.isfile("post_ndppp_corrupt_report.txt"):
-						corrupt_report=open("post_ndppp_corrupt_report.txt", 'w')
-						corrupt_report.close()
-					log.info("Checking for bad calibrators in {0}...".format(j))
-					checkresults=worker_pool.map(rsmshared.check_dataset, calibs[j])
-					corrupt_report=open("post_ndppp_corrupt_report.txt", "a")
-					for p in checkresults:
-						if p!=True:
-							calibs[j].remove(p)
-							SB_no=int(p.split('SB')[1][:3])
-							corrupt_report.write("{0} sub band {1} was corrupt after NDPPP".format(j, SB_no))
-							postcorrupt+=1
-							for beam in beams:
-								if beam==0:
-									target_to_remove=p.replace(j,i).replace(".tmp", "")
-								else:
-									target_to_remove_sb=SB_no+(diff*beam)
-									target_to_remove=p.replace("SB{0}".format('%03d' % SB_no), "SB{0}".format('%03d' % target_to_remove_sb)).replace("SAP000", "SAP00{0}".format(beam)).replace(j, i).replace(".tmp", "")
-								log.warning("Deleting {0}...".format(target_to_remove))
-								subprocess.call("rm -r {0}".format(target_to_remove), shell=True)
-								for k in rsm_bands:
-									if target_to_remove in rsm_bands[k]:
-										rsm_bands[k].remove(target_to_remove)
-										rsm_bands_lens[k]=len(rsm_bands[k])
-					corrupt_report.close()
-					log.debug("{0} Calibrators after NDPPP = {1}".format(j, calibs[j]))
-					if cobalt:
-						log.info("Performing Cobalt Flagging...")
-						worker_pool.map(rsmshared.cobalt_flag, calibs[j])
-						subprocess.call("mv {0}/*.stats {0}/*.tab {0}/*.pdf {0}/flagging/".format(j), shell=True)
-						subprocess.call("rm -rf {0}/GLOBAL_STATS".format(j), shell=True)
-				
+				mode="HBA"
+			log.info("Data observing mode: {0}".format(mode))
+		#In bands mode the shift of the calibrated data can be done as part of the band combination (leaving the kept sub bands
+		#with the calibrated data in CORRECTED_DATA), and without peeling the post-BBS clipping is done in the same NDPPP pass
+		#as the autoflag, saving a full pass over the data each
+		fuse_shift=(fuseshift and phaseon=="bands" and not precal)
+		if phaseon=="bands" and postbbs and not peeling:
+			fused_postcut=postcut
+		else:
+			fused_postcut=0
+		#Nearly all functions are used with partial such that they can be passed to the pool
+		NDPPP_Initial_Multi=partial(rsmshared.NDPPP_Initial, wk_dir=working_dir, ndppp_base=ndppp_base, prec=precal, precloc=precalloc, cache=cache)
+		if mastermode=="INT":
+			calibrate_msss1_multi=partial(rsmshared.hba_calibrate_msss1, beams=beams, diff=diff, calparset=calparset, 
+			calmodel=calmodel, correctparset=correctparset, dummy=dummy, oddeven=target_oddeven, firstid=firstid_oe, mode=mode, shift=not fuse_shift, cache=cache)
+			transfer_targets_multi=partial(rsmshared.hba_transfer_targets, beams=beams, diff=diff, oddeven=target_oddeven, firstid=firstid_oe)
+		else:
+			calibrate_msss1_multi=partial(rsmshared.lba_calibrate_msss1, beams=beams, diff=diff, calparset=calparset, 
+			calmodel=calmodel, correctparset=correctparset, dummy=dummy, calibbeam=calibbeam, mode=mode, shift=not fuse_shift, cache=cache)
+			transfer_targets_multi=partial(rsmshared.lba_transfer_targets, beams=beams, diff=diff, calibbeam=calibbeam)
+		rsm_bandsndppp_multi=partial(rsmshared.rsm_bandsndppp, rsm_bands=ideal_bands, phaseon=phaseon, fuse_shift=fuse_shift, cache=cache)
+		calibrate_msss2_multi=partial(rsmshared.calibrate_msss2, phaseparset=phaseparset, autoflag=autoflag, saveflag=saveflag, create_sky=create_sky, skymodel=skymodel, phaseon=phaseon, postcut=fused_postcut, cache=cache)
+		peeling_steps_multi=partial(rsmshared.peeling_steps, shortpeel=shortpeel, peelsources=peelsources_todo, peelnumsources=peelnumsources, fluxlimit=peelfluxlimit,
+		skymodel=skymodel, create_sky=create_sky, archive=archiveprepeel, cache=cache)
+		post_bbs_multi=partial(rsmshared.post_bbs, postcut=postcut, cache=cache)
+		aoflagger_multi=partial(rsmshared.aoflagger, cache=cache)
+		cobalt_flag_multi=partial(rsmshared.cobalt_flag, cache=cache)
+		
+		tasks={}
+		target_ready={}		#The task after which each target sub band is ready for the solutions to be transferred
+		subband_done={}		#The task after which each calibrated target sub band is complete
+		calib_transfers={}	#The target sub bands each calibrator sub band transfers its solutions to
+		chain_end={}		#The last task of each band, which the final concatenation waits on
+		uncalibrated=set()	#Target sub bands whose calibrator sub band was corrupt, deleted once they are no longer being written
+		ready_done=set()	#Target sub bands whose target_ready task has finished
+		for i in sorted(targets.keys()):
 			for b in beams:
-				beam=b
 				beamc="SAP00{0}".format(b)
-				if __name__ == '__main__':
-					worker_pool.map(NDPPP_Initial_Multi, targets[i][beamc])
-				if not precal:
-					targets[i][beamc] = sorted(glob.glob(i+"/*{0}*.tmp".format(beamc)))
-				else:
-					targets[i][beamc] = sorted(glob.glob(i+"/*{0}*.dppp".format(beamc)))
-				if nchans==0:
-					temp=pt.table("{0}/SPECTRAL_WINDOW".format(targets[i][beamc][0]), ack=False)
-					nchans=int(temp.col("NUM_CHAN")[0])
-					log.info("Number of channels in a sub band: {0}".format(nchans))
-					if mode=="UNKNOWN":
-						msfreq=show_freq = temp.getcell('REF_FREQUENCY',0)
-						if int(msfreq)/1e6 < 100:
-							mode="LBA"
-						else:
-							mode="HBA"
-						log.info("Data observing mode: {0}".format(mode))
-					temp.close()
-				if not os.path.isfile("post_ndppp_corrupt_report.txt"):
-					corrupt_report=open("post_ndppp_corrupt_report.txt", 'w')
-					corrupt_report.close()
-				corrupt_report=open("post_ndppp_corrupt_report.txt", "a")
-				log.info("Checking for bad targets in {0} beam {1}...".format(i, beamc))
-				checkresults=worker_pool.map(rsmshared.check_dataset, targets[i][beamc])
-				for p in checkresults:
-					if p!=True:
-						targets[i][beamc].remove(p)
-						log.warning("Deleting {0}...".format(p))
-						subprocess.call("rm -r {0}".format(p), shell=True)
-						pp=p.replace(".tmp", "")
-						corrupt_report.write("{0} was corrupt after NDPPP".format(pp))
-						postcorrupt+=1
-						for q in rsm_bands:
-							if pp in rsm_bands[q]:
-								rsm_bands[q].remove(pp)
-								rsm_bands_lens[q]=len(rsm_bands[q])
-				corrupt_report.close()
-				log.debug("{0} Beam {1} Targets after NDPPP = {2}".format(i, beamc, targets[i][beamc]))
-				if cobalt and not precal:
-					log.info("Performing Cobalt Flagging...")
-					worker_pool.map(rsmshared.cobalt_flag, targets[i][beamc])
-					subprocess.call("mv {0}/*.stats {0}/*.tab {0}/*.pdf {0}/flagging/".format(i), shell=True)
-					subprocess.call("rm -rf {0}/GLOBAL_STATS".format(i), shell=True)
-			
-			log.info("Done!")
-			# calibrate step 1 process
-			if not precal:
-				if mastermode=="INT":
-					log.info("Calibrating calibrators and transferring solutions for {0} and {1}...".format(i, j))
-					calibrate_msss1_multi=partial(rsmshared.hba_calibrate_msss1, beams=beams, diff=diff, calparset=calparset, 
-					calmodel=calmodel, correctparset=correctparset, dummy=dummy, oddeven=target_oddeven, firstid=firstid_oe, mode=mode)
-					if __name__ == '__main__':
-						worker_pool.map(calibrate_msss1_multi, calibs[j])
-				else:
-					log.info("Calibrating calibrators and transfering solutions for {0}...".format(i))
-					calibrate_msss1_multi=partial(rsmshared.lba_calibrate_msss1, beams=beams, diff=diff, calparset=calparset, 
-					calmodel=calmodel, correctparset=correctparset, dummy=dummy, calibbeam=calibbeam, mode=mode)
-					if __name__ == '__main__':
-						worker_pool.map(calibrate_msss1_multi, calibs[i])
-			else:
-				log.info("Data is precalibrated - calibrator calibration has been skipped")
+				for t in targets[i][beamc]:
+					tar=rsmshared.ndppp_output(t, precal)
+					tasks["ndppp:"+tar]={"func":NDPPP_Initial_Multi, "args":(t,), "inputs":[t], "outputs":[tar]}
+					tasks["check:"+tar]={"func":rsmshared.check_dataset, "args":(tar,), "deps":["ndppp:"+tar], "inputs":[tar]}
+					target_ready[tar]="check:"+tar
+					if cobalt and not precal:
+						tasks["cobalt:"+tar]={"func":cobalt_flag_multi, "args":(tar,), "deps":[target_ready[tar]], "inputs":[tar], "outputs":[tar]}
+						target_ready[tar]="cobalt:"+tar
+					if precal:
+						subband_done[tar]=target_ready[tar]
+		# calibrate step 1 process - each calibrator sub band is calibrated as soon as it and the target sub bands it is transferred to are ready
+		if not precal:
+			for j in sorted(calibs.keys()):
+				for c in calibs[j]:
+					cal=rsmshared.ndppp_output(c, precal)
+					tasks["ndppp:"+cal]={"func":NDPPP_Initial_Multi, "args":(c,), "inputs":[c], "outputs":[cal]}
+					tasks["check:"+cal]={"func":rsmshared.check_dataset, "args":(cal,), "deps":["ndppp:"+cal], "inputs":[cal]}
+					ready="check:"+cal
+					if cobalt:
+						tasks["cobalt:"+cal]={"func":cobalt_flag_multi, "args":(cal,), "deps":[ready], "inputs":[cal], "outputs":[cal]}
+						ready="cobalt:"+cal
+					calib_transfers[cal]=transfer_targets_multi(cal)
+					tasks["calibrate:"+cal]={"func":calibrate_msss1_multi, "args":(cal,), "deps":[ready], 
+					"after":[target_ready[tar] for tar in calib_transfers[cal] if tar in target_ready],
+					"inputs":[cal]+calib_transfers[cal], "outputs":[cal+"/instrument"]+[tar if fuse_shift else tar.replace(".tmp", "") for tar in calib_transfers[cal]]}
+					for tar in calib_transfers[cal]:
+						subband_done[tar.replace(".tmp", "")]="calibrate:"+cal
+		else:
+			log.info("Data is precalibrated - calibrator calibration has been skipped")
 		
 		for q in sorted(rsm_bands):
 			bandtempsplit=q.split("_")
@@ -1114,79 +1161,140 @@ Pipeline now stopping...".format(i, data_dir))
 			thisobs=bandtempsplit[0]
 			log.debug("{0} BAND {1} sets: {2}".format(thisobs, bandtemp, rsm_bands[q]))
 		
-		log.info("Done!")
-		
+		log.info("Phase calibration on {0} selected".format(phaseon))
 		if phaseon=="bands":
-			log.info("Phase calibration on {0} selected".format(phaseon))
-			#Combine the bands
-			log.info("Creating Bands for all sets...")
-			rsm_bandsndppp_multi=partial(rsmshared.rsm_bandsndppp, rsm_bands=ideal_bands, phaseon=phaseon)
-			if __name__ == '__main__':
-				worker_pool.map(rsm_bandsndppp_multi, sorted(rsm_bands.keys()))
-			log.info("Done!")		
-			tocalibrate=sorted(glob.glob("L*/L*_SAP00?_BAND*.MS.dppp.tmp"))
+			#Each band is combined once all of its sub bands are done, then phase calibrated, peeled and clipped
+			for a in sorted(rsm_bands.keys()):
+				band=rsmshared.band_output(a, phaseon)
+				tasks["band:"+a]={"func":rsm_bandsndppp_multi, "args":(a,), "after":[subband_done[s] for s in ideal_bands[a] if s in subband_done]+
+				[target_ready[s+".tmp"] for s in ideal_bands[a] if s+".tmp" in target_ready],
+				"inputs":[s+".tmp" if fuse_shift else s for s in ideal_bands[a]], "outputs":[band]}
+				last="band:"+a
+				if rfi:
+					tasks["aoflagger:"+band]={"func":aoflagger_multi, "args":(band,), "deps":[last], "inputs":[band], "outputs":[band]}
+					last="aoflagger:"+band
+				# calibrate step 2 process
+				tasks["phasecal:"+band]={"func":calibrate_msss2_multi, "args":(band,), "deps":[last], "inputs":[band], "outputs":[band.replace(".tmp", "")]}
+				last="phasecal:"+band
+				band=band.replace(".tmp", "")
+				if peeling:
+					tasks["peel:"+band]={"func":peeling_steps_multi, "args":(band,), "deps":[last], "inputs":[band], "outputs":[band]}
+					last="peel:"+band
+				if postbbs and peeling:
+					tasks["postbbs:"+band]={"func":post_bbs_multi, "args":(band,), "deps":[last], "inputs":[band], "outputs":[band]}
+					last="postbbs:"+band
+				chain_end[a]=last
 		else:
-			log.info("Phase calibration on {0} selected".format(phaseon))
-			for sb in sorted(glob.glob("L*/L*.dppp")):
-				#bit dangerous but a quick fix
-				subprocess.call("mv {0} {0}.phasecaltmp".format(sb), shell=True)
-			tocalibrate=sorted(glob.glob("L*/L*_SAP00?_*.MS.dppp.phasecaltmp"))
+			phasecal_done={}
+			for s in sorted(subband_done.keys()):
+				sb=s+".phasecaltmp"
+				tasks["rename:"+s]={"func":rsmshared.move_dataset, "args":(s, sb), "deps":[subband_done[s]], "inputs":[s], "outputs":[sb]}
+				last="rename:"+s
+				if rfi:
+					tasks["aoflagger:"+sb]={"func":aoflagger_multi, "args":(sb,), "deps":[last], "inputs":[sb], "outputs":[sb]}
+					last="aoflagger:"+sb
+				tasks["phasecal:"+sb]={"func":calibrate_msss2_multi, "args":(sb,), "deps":[last], "inputs":[sb], "outputs":[s]}
+				phasecal_done[s]="phasecal:"+sb
+			if concatbands:
+				for a in sorted(rsm_bands.keys()):
+					tasks["band:"+a]={"func":rsm_bandsndppp_multi, "args":(a,), "after":[phasecal_done[s] for s in ideal_bands[a] if s in phasecal_done],
+					"inputs":ideal_bands[a], "outputs":[rsmshared.band_output(a, phaseon)]}
+					chain_end[a]="band:"+a
 		
-		if rfi:
-			log.info("Starting flagging processes with aoflagger...")
-			# torfi=sorted(glob.glob(os.path.join(i,"*.MS.dppp")))
-			# rficonsole_multi=partial(rsmshared.rficonsole)
-			worker_pool.map(rsmshared.aoflagger, tocalibrate)
+		if peeling:
+			for t in target_obs:
+				if not os.path.isdir(os.path.join(t, "prepeeled_sets")):
+					os.mkdir(os.path.join(t, "prepeeled_sets"))
 		
-		log.info("Performing phaseonly calibration (and flagging if selected) on all sets...")
-		# calibrate step 2 process
-		# tocalibrate=sorted(glob.glob("L*/L*_SAP00?_BAND*.MS.dppp.tmp"))
-		calibrate_msss2_multi=partial(rsmshared.calibrate_msss2, phaseparset=phaseparset, autoflag=autoflag, saveflag=saveflag, create_sky=create_sky, skymodel=skymodel, phaseon=phaseon)
-		if __name__ == '__main__':
-			worker_pool.map(calibrate_msss2_multi, tocalibrate)
-		proc_target_obs=sorted(glob.glob("L*/L*_SAP00?_BAND*.MS.dppp"))
-		log.info("Done!")
+		#Final Concat Step for MSSS style - each final band waits only on the same band from every snapshot
+		if len(target_obs)>1:
+			for be in beams:
+				final_concat_multi=partial(rsmshared.hba_final_concat, beam=be, target_obs=target_obs)
+				for bnd in rsm_band_numbers:
+					ends=[chain_end[a] for a in chain_end if a.split("_")[1]=="SAP00{0}".format(be) and int(a.split("_")[2])==bnd]
+					finalband="final_datasets/SAP00{0}_BAND{1:02d}_FINAL.MS.dppp".format(be, bnd)
+					tasks["concat:SAP00{0}_BAND{1:02d}".format(be, bnd)]={"func":final_concat_multi, "args":(bnd,), "after":ends, "inputs":target_obs, "outputs":[finalband]}
 		
-		if autoflag:
-			subprocess.call("rm -rf L*/GLOBAL_STATS", shell=True)
+		def remove_uncalibrated(tar):
+			"""Deletes a target sub band that cannot be calibrated, as was done before the task graph."""
+			for s in (tar, tar.replace(".tmp", "")):
+				if os.path.isdir(s):
+					log.warning("Deleting {0}...".format(s))
+					subprocess.call(["rm", "-r", s])
+
+		def task_done(name, result):
+			"""Keeps the corruption report and band lists up to date as the tasks finish."""
+			global postcorrupt, nchans
+			ms=name.split(":", 1)[-1]
+			if name.startswith("ndppp:") and ms in target_ready and nchans==0:
+				nchans=rsmshared.ms_metadata(ms)["nchan"]
+				log.info("Number of channels in a sub band: {0}".format(nchans))
+			if target_ready.get(ms)==name:
+				ready_done.add(ms)
+				if ms in uncalibrated:
+					remove_uncalibrated(ms)
+					return False
+			if not name.startswith("check:") or result==True:
+				return True
+			corrupt_report=open("post_ndppp_corrupt_report.txt", "a")
+			postcorrupt+=1
+			if ms in calib_transfers:
+				SB_no=int(ms.split('SB')[1][:3])
+				corrupt_report.write("{0} sub band {1} was corrupt after NDPPP\n".format(ms.split("/")[0], SB_no))
+				for tar in calib_transfers[ms]:
+					target_to_remove=tar.replace(".tmp", "")
+					log.warning("{0} will not be calibrated...".format(target_to_remove))
+					corrupt_report.write("{0} was removed as its calibrator sub band was corrupt\n".format(target_to_remove))
+					uncalibrated.add(tar)
+					#a target still being processed is removed when it is ready, so nothing is deleted while being written
+					if tar in ready_done:
+						remove_uncalibrated(tar)
+					for k in rsm_bands:
+						if target_to_remove in rsm_bands[k]:
+							rsm_bands[k].remove(target_to_remove)
+							rsm_bands_lens[k]=len(rsm_bands[k])
+			else:
+				log.warning("Deleting {0}...".format(ms))
+				subprocess.call(["rm", "-r", ms])
+				pp=ms.replace(".tmp", "")
+				corrupt_report.write("{0} was corrupt after NDPPP\n".format(pp))
+				for q in rsm_bands:
+					if pp in rsm_bands[q]:
+						rsm_bands[q].remove(pp)
+						rsm_bands_lens[q]=len(rsm_bands[q])
+			corrupt_report.close()
+			return False
 		
-		if peeling:
-			log.info("Peeling process started on all sets...")
-			peeling_steps_multi=partial(rsmshared.peeling_steps, shortpeel=shortpeel, peelsources=peelsources_todo, peelnumsources=peelnumsources, fluxlimit=peelfluxlimit,
-			skymodel=skymodel, create_sky=create_sky)
-			for t in target_obs:
-				os.mkdir(os.path.join(t, "prepeeled_sets"))
-			if __name__=='__main__':
-				# pool_peeling=mpl(processes=n)
-				worker_pool.map(peeling_steps_multi, proc_target_obs)
-			log.info("Done!")
+		for t in tasks:
+			tasks[t]["cost"]=task_costs.get(t.split(":")[0], {})
+		if os.path.isfile(ledger):
+			completed=set(rsmshared.completed_tasks(tasks, ledger))
+			for tar in target_ready:
+				if target_ready[tar] in completed:
+					ready_done.add(tar)
+		log.info("Processing {0} tasks across {1} cores...".format(len(tasks), n))
+		if __name__ == '__main__':
+			taskstatus=rsmshared.run_task_graph(worker_pool, tasks, n, on_done=task_done, ledger=ledger, nslots=2*n, maxmem=maxmem, diskbw=diskbw, iopath=working_dir)
+			failed=[t for t in taskstatus if not taskstatus[t]]
+			if len(failed)>0:
+				log.warning("{0} of {1} tasks did not complete - see log for details".format(len(failed), len(taskstatus)))
+			#anything whose ready task never finished, e.g. a failed NDPPP, is still removed
+			for tar in sorted(uncalibrated):
+				remove_uncalibrated(tar)
+		log.info("Done!")
 		
-		if postbbs==True:
-			log.info("Post-bbs clipping process started on all sets...")
-			post_bbs_multi=partial(rsmshared.post_bbs, postcut=postcut)
+		if (autoflag or cobalt) and autoflagplots:
+			log.info("Making autoflag plots...")
 			if __name__ == '__main__':
-				# pool_postbbs = Pool(processes=n)
-				worker_pool.map(post_bbs_multi, proc_target_obs)
-			log.info("Done!")
+				worker_pool.map(rsmshared.plot_flag_stats, sorted(glob.glob("L*/*.stats")))
 		
-		if phaseon=="subbands" and concatbands:
-			log.info("Creating Bands for all sets...")
-			rsm_bandsndppp_multi=partial(rsmshared.rsm_bandsndppp, rsm_bands=ideal_bands, phaseon=phaseon)
-			if __name__ == '__main__':
-				worker_pool.map(rsm_bandsndppp_multi, sorted(rsm_bands.keys()))
-			log.info("Done!")
+		if cobalt and not precal:
+			for o in sorted(set(calibs.keys()+target_obs)):
+				rsmshared.move_files([o+"/*.stats", o+"/*.tab", o+"/*.pdf"], o+"/flagging/")
+				subprocess.call(["rm", "-rf", o+"/GLOBAL_STATS"])
 		
-		#----------------------------------------------------------------------------------------------------------------------------------------------
-		#																Final Concat Step for MSSS style
-		#----------------------------------------------------------------------------------------------------------------------------------------------
-		if len(target_obs)>1:
-			# correct=nchans*subsinbandss
-			log.info("Final concatenate process started...")
-			for be in beams:
-			# 	# snapshot_concat_multi=partial(rsmshared.snapshot_concat, beam=be)	#Currently cannot combine all bands in a snapshot (different number of subands)
-				final_concat_multi=partial(rsmshared.hba_final_concat, beam=be, target_obs=target_obs)
-				if __name__ == '__main__':
-					worker_pool.map(final_concat_multi, rsm_band_numbers)
+		if autoflag:
+			rsmshared.remove_files(["L*/GLOBAL_STATS"])
 
 		#----------------------------------------------------------------------------------------------------------------------------------------------
 		#																Imaging Step
@@ -1206,8 +1314,18 @@ Pipeline now stopping...".format(i, data_dir))
 				toimage=sorted(glob.glob("L*/L*BAND*.MS.dppp"))
 			else:
 				toimage=sorted(glob.glob("final_datasets/*BAND*.MS.dppp"))
+			if setstoimage=="obsbands":
+				imagetargetobs=target_obs
+			elif setstoimage=="finalbands":
+				imagetargetobs=["final_datasets"]
+			else:
+				imagetargetobs=target_obs+["final_datasets"]
+			for i in imagetargetobs:
+				if not os.path.isdir(os.path.join(i, "images")):
+					os.mkdir(os.path.join(i, "images"))
 			log.info("Starting imaging process with AWimager...")
-			os.mkdir("JAWS_products")
+			if not os.path.isdir("JAWS_products"):
+				os.mkdir("JAWS_products")
 			log.info("Imaging mode: {0}".format(imagingmode))
 			log.info("Imaging: {0}".format(setstoimage))
 			if imagingmode=="auto":
@@ -1249,44 +1367,41 @@ Pipeline now stopping...".format(i, data_dir))
 			
 			log.info("Baseline range to image: {0} - {1} ({2})".format(minb, maxb, maxbunit))
 			if mask:
-				create_mask_multi=partial(rsmshared.create_mask, mask_size=mask_size, toimage=toimage)
+				create_mask_multi=partial(rsmshared.create_mask, mask_size=mask_size, toimage=toimage, cache=cache)
 				if __name__ == '__main__':
 					worker_pool.map(create_mask_multi,beams)
 			AW_Steps_multi=partial(rsmshared.AW_Steps, aw_sets=aw_sets, minb=minb, maxb=maxb, aw_env=awimager_environ, niter=niters, imagingmode=imagingmode,
 			bandsthreshs_dict=bandsthreshs_dict, initialiter=initialiters, uvORm=maxbunit, usemask=mask, userthresh=userthresh, mos=mosaic)
+			imagetasks={}
+			for g in toimage:
+				imagetasks["image:"+g]={"func":AW_Steps_multi, "args":(g,), "inputs":[g], "outputs":rsmshared.image_products(g), "cost":task_costs["image"]}
 			if __name__ == '__main__':
-				pool = Pool(processes=2)
-				pool.map(AW_Steps_multi,toimage)
-				pool.close()
+				rsmshared.run_task_graph(worker_pool, imagetasks, n, ledger=ledger, nslots=2*n, maxmem=maxmem, diskbw=diskbw, iopath=working_dir)
 			log.info("Done!")
 
 			log.info("Tidying up imaging...")
 			os.rmdir("JAWS_products")
-			if setstoimage=="obsbands":
-				imagetargetobs=target_obs
-			elif setstoimage=="finalbands":
-				imagetargetobs=["final_datasets"]
-			else:
-				imagetargetobs=target_obs+["final_datasets"]
 			for i in imagetargetobs:
 				os.chdir(i)
-				if not os.path.isdir("images"):
-					os.mkdir("images")
-				subprocess.call("mv *.fits images/", shell=True)
-				subprocess.call("mv *.model *.residual *.psf *.restored *.avgpb *.img0.spheroid_cut* *.corr images/", shell=True)
+				rsmshared.move_files(["*.fits"], "images/")
+				rsmshared.move_files(["*.model", "*.residual", "*.psf", "*.restored", "*.avgpb", "*.img0.spheroid_cut*", "*.corr"], "images/")
 				os.chdir("..")
 			log.info("Creating averaged images...")
-			average_band_images_multi=partial(rsmshared.average_band_images, beams=beams)
+			averagetasks={}
+			for i in imagetargetobs:
+				for b in beams:
+					averagetasks["average:{0}:{1}".format(i, b)]={"func":rsmshared.average_beam_images, "args":(i, b), "cost":task_costs["average"]}
 			if __name__=='__main__':
-				worker_pool.map(average_band_images_multi, imagetargetobs)
+				rsmshared.run_task_graph(worker_pool, averagetasks, n, nslots=2*n, maxmem=maxmem, diskbw=diskbw, iopath=working_dir)
 			if mosaic:
-				create_mosaic_multi=partial(rsmshared.create_mosaic, band_nums=rsm_band_numbers, chosen_environ=chosen_environ, pad=userpad, avgpbr=avpbrad, ncp=ncp)
-				pool=Pool(processes=len(rsm_band_numbers))
-				pool.map(create_mosaic_multi, imagetargetobs)
-				pool.close()
+				create_mosaic_multi=partial(rsmshared.create_mosaic, band_nums=rsm_band_numbers, chosen_environ=chosen_environ, pad=userpad, avgpbr=avpbrad, ncp=ncp, jobs=task_costs["mosaic"]["cpu"])
+				mosaictasks={}
+				for i in imagetargetobs:
+					mosaictasks["mosaic:"+i]={"func":create_mosaic_multi, "args":(i,), "cost":task_costs["mosaic"]}
+				rsmshared.run_task_graph(worker_pool, mosaictasks, n, nslots=2*n, maxmem=maxmem, diskbw=diskbw, iopath=working_dir)
 				for i in target_obs:
 					os.chdir(os.path.join(i, "images"))
-					subprocess.call("mv *_mosaic* mosaics/", shell=True)
+					rsmshared.move_files(["*_mosaic*"], "mosaics/")
 					os.chdir("../..")
 				
 		#----------------------------------------------------------------------------------------------------------------------------------------------
@@ -1299,10 +1414,12 @@ Pipeline now stopping...".format(i, data_dir))
 		if mastermode=="INT":
 			if not precal:
 				for c in calib_obs:
-					subprocess.call("mkdir {0}/datasets {0}/parmdb_tables > /dev/null 2>&1".format(c), shell=True)
-					subprocess.call("mv {0}/*.pdf {0}/plots > /dev/null 2>&1".format(c), shell=True)
-					subprocess.call("mv {0}/*.tmp {0}/datasets > /dev/null 2>&1".format(c), shell=True)
-					subprocess.call("mv {0}/*.parmdb {0}/parmdb_tables > /dev/null 2>&1".format(c), shell=True)
+					for d in ["datasets", "parmdb_tables"]:
+						if not os.path.isdir(os.path.join(c, d)):
+							os.mkdir(os.path.join(c, d))
+					rsmshared.move_files([c+"/*.pdf"], c+"/plots", logfile=os.devnull)
+					rsmshared.move_files([c+"/*.tmp"], c+"/datasets", logfile=os.devnull)
+					rsmshared.move_files([c+"/*.parmdb"], c+"/parmdb_tables", logfile=os.devnull)
 			os.mkdir("Calibrators")
 			mv_calibs=["mv",]+sorted(calib_obs)
 			mv_calibs.append("Calibrators")
@@ -1312,10 +1429,10 @@ Pipeline now stopping...".format(i, data_dir))
 		for t in target_obs:
 			if mastermode=="SIM":
 				if not precal:
-					subprocess.call("mv {0}/*.tmp* {0}/calibrators > /dev/null 2>&1".format(t), shell=True)
-			subprocess.call("mv {0}/*_uv.MS.dppp {0}/datasets > /dev/null 2>&1".format(t), shell=True)
+					rsmshared.move_files([t+"/*.tmp*"], t+"/calibrators", logfile=os.devnull)
+			rsmshared.move_files([t+"/*_uv.MS.dppp"], t+"/datasets", logfile=os.devnull)
 			if autoflag:
-				subprocess.call("mv {0}/*.stats {0}/*.pdf {0}/*.tab {0}/flagging > /dev/null 2>&1".format(t), shell=True)
+				rsmshared.move_files([t+"/*.stats", t+"/*.pdf", t+"/*.tab"], t+"/flagging", logfile=os.devnull)
 		subprocess.call(["rm","-r","sky.calibrator","sky.dummy"])
 		
 		if postcorrupt==0:
@@ -1326,8 +1443,9 @@ Pipeline now stopping...".format(i, data_dir))
 			# for c in calib_obs:
 			# 	subprocess.call(["rm", "-r", "Calibrators/{0}/parmdb_tables".format(c)])
 			for t in target_obs:
-				subprocess.call("rm -r {0}/datasets".format(t), shell=True)
+				subprocess.call(["rm", "-r", t+"/datasets"])
 
+		rsmshared.write_run_report(stats, os.path.join(working_dir, "rsmpp_report.json"))
 		log.info("All processed successfully!")
 		log.info("Results can be found in {0}".format(newdirname))
 	
@@ -1347,6 +1465,7 @@ Pipeline now stopping...".format(i, data_dir))
 		date_time_end=end.strftime("%d-%b-%Y %H:%M:%S")
 		tdelta=end-now
 		subprocess.call(["cp", os.path.join(root_dir, "rsmpp.log"), "rsmpp_CRASH.log".format(newdirname)])
+		log.info("Completed steps are recorded in the ledger, re-run with '--resume' to carry on from where the run stopped")
 		if mail==True:
 			em.send_email(emacc,user_address,"rsmpp Job Error","{0},\n\nYour job {1} crashed with the following error:\n\n{2}\n\nTime of crash: {3}".format(user,newdirname,e, end))
 			em.send_email(emacc,"adam.stewart@astro.ox.ac.uk","rsmpp Job Error","{0}'s job '{1}' just crashed with the following error:\n\n{2}\n\nDirectory: {3}\n\nTime of crash: {4}".format(user,newdirname,e,root_dir,end))
@@ -1,11 +1,19 @@
 #Version 2.5.1
 
-import os, subprocess,time, multiprocessing, glob, pyfits, logging, sys
+import os, subprocess,time, multiprocessing, glob, pyfits, logging, sys, json, hashlib, signal, sqlite3, shutil
 import numpy as np
 import pyrap.tables as pt
 from collections import Counter
+from distutils.spawn import find_executable
 from datetime import datetime
 from pyrap.quanta import quantity
+from tools.plotting.statsplot import find_bad_stations
+from tools.imagestats import image_std
+from tools.average_inverse_var3 import average_images
+from tools.mosaic.avgpbz import zero_avgpb
+from tools.msss_mask import fill_mask
+from tools.peeling.peeling_new_slofarpp import plan_peeling
+from tools.skycatalogue import load_index, cone_search, write_model
 
 rootpath=os.path.realpath(__file__)
 rootpath=rootpath.split("/")[:-1]
@@ -25,8 +33,15 @@ tools={"editparmdb":os.path.join(rootpath, "tools", "edit_parmdb", "edit_parmdb.
 "stats":os.path.join(rootpath, "tools", "plotting", "statsplot.py"),
 "HBAdefault":os.path.join(rootpath, "tools", "HBAdefault"),
 "LBAdefault":os.path.join(rootpath, "tools", "LBAdefault"),
+"cleanateam":os.path.join(rootpath, "skymodels", "clean_ateam.txt"),
+"cleancalibrators":os.path.join(rootpath, "skymodels", "clean_calibrators.txt"),
 }
 
+#A-team and calibrator tables of clean_model, keyed by their files
+clean_cache={}
+#Identities of the external tools used in the stage cache keys
+tool_ids={}
+
 log=logging.getLogger("rsm")
 
 class Ddict(dict):
@@ -41,16 +56,16 @@ class Ddict(dict):
 def fetch(file):
 	"""Simple wget get line"""
 	log.info("Fetching {0}...".format(file.split("/")[-1]))
-	subprocess.call("wget {0} > /dev/null 2>&1".format(file), shell=True)
+	run_command(["wget", file], logfile=os.devnull)
 
 def fetchgrid(file):
 	"""Simple wget get line"""
 	log.info("Fetching {0}...".format(file.split("/")[-1]))
-	subprocess.call("srmcp {0} > /dev/null 2>&1".format(file), shell=True)
+	run_command(["srmcp", file], logfile=os.devnull)
 	
 def untar(file):
 	"""Simple wget get line"""
-	subprocess.call("tar --force-local -xvf {0} > /dev/null 2>&1".format(file), shell=True)
+	run_command(["tar", "--force-local", "-xvf", file], logfile=os.devnull)
 	
 def rename1(SB):
 	SBtable=pt.table("{0}/OBSERVATION".format(SB), ack=False)
@@ -58,11 +73,11 @@ def rename1(SB):
 	SBtable.close()
 	if newname.endswith(".MS"):
 		newname+=".dppp"
-	subprocess.call(["mv", SB, newname])
+	run_command(["mv", SB, newname])
 	
 def organise(SB):
 	obsid=SB.split("_")[0]
-	subprocess.call(["mv", SB, os.path.join(obsid, SB)])
+	run_command(["mv", SB, os.path.join(obsid, SB)])
 	
 def deletefile(file):
 	"""Only files not directories"""
@@ -72,21 +87,21 @@ def fetchantenna(period):
 	log.info("Fetching fixinfo file...")
 	if period==1:
 		try:
-			subprocess.call("wget http://www.astron.nl/sites/astron.nl/files/cms/fixinfo.tar > /dev/null 2>&1", shell=True)
-			subprocess.call("tar xvf fixinfo.tar > /dev/null 2>&1", shell=True)
+			run_command(["wget", "http://www.astron.nl/sites/astron.nl/files/cms/fixinfo.tar"], logfile=os.devnull)
+			run_command(["tar", "xvf", "fixinfo.tar"], logfile=os.devnull)
 		except:
 			return False
 	elif period==2:
 		try:
-			subprocess.call("wget http://www.astron.nl/sites/astron.nl/files/cms/fixbeaminfo_March2015.tar > /dev/null 2>&1", shell=True)
-			subprocess.call("tar xvf fixbeaminfo_March2015.tar > /dev/null 2>&1", shell=True)
+			run_command(["wget", "http://www.astron.nl/sites/astron.nl/files/cms/fixbeaminfo_March2015.tar"], logfile=os.devnull)
+			run_command(["tar", "xvf", "fixbeaminfo_March2015.tar"], logfile=os.devnull)
 		except:
 			return False
 	return True
 	
 def correctantenna(ms):
 	log.info("Correcting Antenna Table for {0}...".format(ms.split("/")[-1]))
-	subprocess.call("./fixbeaminfo {0} > /dev/null 2>&1".format(ms), shell=True)
+	run_command(["./fixbeaminfo", ms], logfile=os.devnull)
 	
 def renameobsids(torename):
 	basename=torename[0]
@@ -110,7 +125,7 @@ def renameobsids(torename):
 		strname="L{0}".format(newname)
 		filestochange=sorted(glob.glob("L{0}/*.dppp".format(name)))
 		for file in filestochange:
-			subprocess.call("mv {0} {1}".format(file, file.replace(str(name), str(newname))), shell=True)
+			run_command(["mv", file, file.replace(str(name), str(newname))])
 		try:
 			os.rmdir("L{0}".format(name))
 		except:
@@ -118,43 +133,60 @@ def renameobsids(torename):
 		newtargetobs.append(strname)
 	return newtargetobs
 
-def clean(f):
-	"""Function to 'clean' a sky model. It removes double sources, A-team sources and replaces MSSS calibrators with MSSS calibrator models."""
-	Ateam=["2323.2+5850", "2323.4+5849", "1959.4+4044"]
-	calibrators={"1411.3+5212":"3c295A, POINT, 14:11:20.49, +52.12.10.70, 48.8815, , , , 150e6, [-0.582, -0.298, 0.583, -0.363]\n3c295B, POINT, 14:11:20.79, +52.12.07.90, 48.8815, , , , 150e6, [-0.582, -0.298, 0.583, -0.363]\n",
-	"0542.6+4951":"3c147, POINT, 05:42:36.1, 49.51.07, 66.738, , , , 150e6 , [-0.022, -1.012, 0.549]\n",
-	"0813.6+4813":"3c196, POINT, 08:13:36.0, 48.13.03, 83.084, , , , 150e6, [-0.699, -0.110]\n",
-	"1331.1+3030":"3c286, POINT, 13:31:08.3, 30.30.33, 27.477, , , , 150e6, [-0.158, 0.032, -0.180]\n",
-	"1330.6+2509":"3c287, POINT, 13:30:37.7, 25.09.11, 16.367, , , , 150e6, [-0.364]\n",
-	"1829.5+4844":"3c380, POINT, 18:29:31.8, 48.44.46, 77.352, , , , 150e6, [-0.767]\n",
-	"0137.6+3309":"3c48,  POINT, 01:37:41.3, 33.09.35, 64.768, , [-0.387, -0.420, 0.181]\n"}
-	input_model=open(f+".temp", 'r')
-	output_model=open(f, 'w+r')
-	source_names=[]
-	for line in input_model:
-		source=str(line)
+def clean_tables(ateamfile=tools["cleanateam"], calfile=tools["cleancalibrators"]):
+	"""Loads the A-team names and the calibrator replacement components used by clean_model. The A-team file lists one source name \
+	per line, the calibrator file a source name followed by a replacement component on each line. Loaded once per process."""
+	key=(ateamfile, calfile)
+	if key not in clean_cache:
+		ateam=set()
+		for line in open(ateamfile):
+			if line.strip()!="" and line[0]!="#":
+				ateam.add(line.strip())
+		calibrators={}
+		for line in open(calfile):
+			if line.strip()!="" and line[0]!="#":
+				name, component=line.strip().split(None, 1)
+				calibrators[name]=calibrators.get(name, "")+component+"\n"
+		clean_cache[key]=(ateam, calibrators)
+	return clean_cache[key]
+
+def clean_model(lines, ateam=None, calibrators=None):
+	"""Filters the lines of a sky model, e.g. gsm.py or catalogue output, as they are read. It removes double sources and A-team sources \
+	and replaces MSSS calibrators with MSSS calibrator models. Sources are identified by the first 11 characters of the line."""
+	if ateam is None or calibrators is None:
+		tables=clean_tables()
+		if ateam is None:
+			ateam=tables[0]
+		if calibrators is None:
+			calibrators=tables[1]
+	source_names=set()
+	for source in lines:
 		source_name=source[:11]
-		# print source_name
-		if source_name not in source_names:
-			if source_name in Ateam:
-				log.info("A team source {0} removed".format(source_name))
-				continue
-			if source_name in calibrators:
-				source=calibrators[source_name]
-				newsourcename=source.split(",")[0]
-				log.info("{0} detected in target field - replaced gsm.py with MSSS component.".format(newsourcename))
-			source_names.append(source_name)
-			output_model.write(source)
-		else:
+		if source_name in source_names:
 			log.warning("Source {0} was doubled - removed second copy".format(source_name))
+			continue
+		source_names.add(source_name)
+		if source_name in ateam:
+			log.info("A team source {0} removed".format(source_name))
+			continue
+		if source_name in calibrators:
+			source=calibrators[source_name]
+			newsourcename=source.split(",")[0]
+			log.info("{0} detected in target field - replaced gsm.py with MSSS component.".format(newsourcename))
+		yield source
+
+def clean(f):
+	"""Function to 'clean' a sky model f, read from f.temp, with clean_model."""
+	input_model=open(f+".temp", 'r')
+	output_model=open(f, 'w')
+	output_model.writelines(clean_model(input_model))
 	input_model.close()
 	output_model.close()
+	os.remove(f+".temp")
 	log.info("Cleaned sky model {0} produced".format(f))
-	subprocess.call("rm {0}.temp".format(f), shell=True)
 	
-def create_model(ms, outfile, rad):
-	cut=0.1
-	asth=0.00278
+def field_centre(ms):
+	"""Returns the RA and Dec (deg) of the reference direction of a measurement set."""
 	log.info("Obtaining RA and Dec of {0}...".format(ms))
 	obs = pt.table(ms + '/FIELD', ack=False)
 	ra = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][0]))
@@ -163,74 +195,133 @@ def create_model(ms, outfile, rad):
 	dec = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][1]))
 	log.info("RA:{0}\tDec:{1}".format(ra, dec))
 	obs.close()
-	subprocess.call("gsm.py {0}.temp {1} {2} {3} {4} {5} > /dev/null 2>&1".format(outfile, ra, dec, rad, cut, asth), shell=True)
+	return ra, dec
+
+def create_model(ms, outfile, rad):
+	cut=0.1
+	asth=0.00278
+	ra, dec=field_centre(ms)
+	run_command(["gsm.py", outfile+".temp"]+[str(i) for i in (ra, dec, rad, cut, asth)], logfile=os.devnull)
 	clean(outfile)
+
+def create_models(mslist, outfiles, rad, catalogue, cut=0.1, cache=None):
+	"""Creates the sky models of several beams at once from a local catalogue (comma separated list of makesourcedb format files) \
+	instead of gsm.py, using one cone search per beam on the declination zone index. Sources of the catalogues are associated \
+	within the gsm.py radius. The index is kept in the stage cache, or the working directory without one. The search output \
+	is cleaned with clean_model as it is written."""
+	asth=0.00278
+	indexdir=skymodel_cache(cache)
+	if indexdir is None:
+		indexdir=os.getcwd()
+	index=load_index(catalogue.split(","), indexdir, asth=asth)
+	cones=cone_search(index, [field_centre(ms) for ms in mslist], rad, cut)
+	for outfile, lines in zip(outfiles, cones):
+		log.info("{0} catalogue sources found for {1}".format(len(lines), outfile))
+		write_model(outfile, index["header"], clean_model(lines))
+		log.info("Cleaned sky model {0} produced".format(outfile))
 	
-def NDPPP_Initial(SB, wk_dir, ndppp_base, prec, precloc):
+def NDPPP_Initial(SB, wk_dir, ndppp_base, prec, precloc, cache=None):
 	"""
 	Creates an NDPPP parset file using settings already supplied and adds\
 	the msin and out parameters. Then runs using NDPPP and removes the parset.
 	"""
 	curr_SB=SB.split('/')[-1]
 	curr_obs=curr_SB.split("_")[0]
+	msout=os.path.join(wk_dir, ndppp_output(SB, prec))
 	ndppp_filename='ndppp.initial.{0}.parset'.format(curr_SB)
-	g = open(ndppp_filename, 'w')
-	g.write("msin={0}\n".format(SB))
+	parset="msin={0}\n".format(SB)
 	if prec:
-		g.write("msin.datacolumn = {0}\n".format(precloc))
-		if SB[-3:]==".MS":
-			g.write("msout={0}.dppp\n".format(os.path.join(wk_dir, curr_obs, curr_SB)))
-		else:	
-			g.write("msout={0}\n".format(os.path.join(wk_dir, curr_obs, curr_SB)))
+		parset+="msin.datacolumn = {0}\n".format(precloc)
 	else:
-		g.write("msin.datacolumn = DATA\n")
-		if SB[-3:]==".MS":
-			g.write("msout={0}.dppp.tmp\n".format(os.path.join(wk_dir, curr_obs, curr_SB)))
-		else:	
-			g.write("msout={0}.tmp\n".format(os.path.join(wk_dir, curr_obs, curr_SB)))
-	for i in ndppp_base:
-		g.write(i)
-	g.close()
+		parset+="msin.datacolumn = DATA\n"
+	parset+="msout={0}\n".format(msout)
+	parset+="".join(ndppp_base)
+	key=stage_key([SB], parset, tools=["NDPPP"], cache=cache)
+	if cache_fetch(cache, key, [msout]):
+		return True
 	log.info("Performing Initial NDPPP on {0}...".format(curr_SB))
-	subprocess.call("NDPPP {0} > {1}/logs/ndppp.{2}.log 2>&1".format(ndppp_filename, curr_obs, curr_SB), shell=True)
-	os.remove(ndppp_filename)
+	run_ndppp(parset, ndppp_filename, "{0}/logs/ndppp.{1}.log".format(curr_obs, curr_SB), msout=msout)
+	cache_result(cache, key, [msout])
+	return os.path.isdir(msout)
+
+def ndppp_output(SB, prec):
+	"""
+	Returns the name, relative to the working directory, of the measurement set NDPPP_Initial produces from SB.
+	"""
+	curr_SB=SB.split('/')[-1]
+	curr_obs=curr_SB.split("_")[0]
+	out=os.path.join(curr_obs, curr_SB)
+	if SB[-3:]==".MS":
+		out+=".dppp"
+	if not prec:
+		out+=".tmp"
+	return out
 	
-def aoflagger(ms):
+def aoflagger(ms, cache=None):
 	log.info("Running aoflagger on {0}...".format(ms))
 	obsid=ms.split("/")[-1].split("_")[0]
-	subprocess.call("aoflagger -j 1 {0} > {1}/logs/aoflagger.{2}.log 2>&1".format(ms, obsid, ms.split("/")[-1]), shell=True)
+	unshare_dataset(ms, cache)
+	run_command(["aoflagger", "-j", "1", ms], logfile="{0}/logs/aoflagger.{1}.log".format(obsid, ms.split("/")[-1]), check=True)
+	extend_identity(ms, "aoflagger"+tool_identity(["aoflagger"]), cache)
 
 def check_dataset(ms):
-	check=pt.table(ms, ack=False)
-	try:
-		row=check.row("DATA").get(0)
-	except:
+	if ms_metadata(ms)["corrupt"]:
 		log.warning("{0} is corrupt!".format(ms))
 		return ms
-	else:
-		check.close()
-		return True
+	return True
 		
+def ndppp_parset(msin, datacolumn, msout="", outcolumn=None, msin_opts=[], steps=[]):
+	"""
+	Builds the text of an NDPPP parset which runs a chain of steps in a single pass over the data. msin_opts are extra (key, value) \
+	msin settings and steps a list of (name, [(key, value), ...]) pairs run in order. An empty msout updates the set in place.
+	"""
+	text="msin={0}\nmsin.datacolumn={1}\n".format(msin, datacolumn)
+	for k, v in msin_opts:
+		text+="msin.{0}={1}\n".format(k, v)
+	text+="msout={0}\n".format(msout)
+	if outcolumn!=None:
+		text+="msout.datacolumn={0}\n".format(outcolumn)
+	text+="steps=[{0}]\n".format(",".join([step[0] for step in steps]))
+	for name, opts in steps:
+		for k, v in opts:
+			text+="{0}.{1}={2}\n".format(name, k, v)
+	return text
+
+def baseline_flag_step(blines):
+	"""
+	Preflagger step flagging the given baselines.
+	"""
+	return ("flag", [("type", "preflagger"), ("baseline", blines)])
+
+def amplitude_clip_step(postcut):
+	"""
+	Preflagger step clipping cross correlation amplitudes above postcut, as used after BBS.
+	"""
+	return ("clip", [("type", "preflagger"), ("corrtype", "cross"), ("amplmax", postcut), ("baseline", "[CS*,RS*,DE*,SE*,UK*,FR*]")])
+
+def run_ndppp(parset, parset_name, logfile, msout=None):
+	"""
+	Writes the parset text to parset_name, runs NDPPP on it logging to logfile and removes the parset. Any partly written msout \
+	is removed before a retry.
+	"""
+	f=open(parset_name, 'w')
+	f.write(parset)
+	f.close()
+	try:
+		run_command(["NDPPP", parset_name], logfile=logfile, cleanup=[msout] if msout!=None else [], check=True)
+	finally:
+		os.remove(parset_name)
+
 def shiftndppp(target, tar_obs, target_name):
 	"""
 	Simply shifts the CORRECTED_DATA to a new measurement set DATA column.
 	"""
-	shift_ndppp=open("ndppp.shift_{0}.parset".format(target_name), 'w')
-	shift_ndppp.write("msin={0}\n\
-# msin.missingdata=true\n\
-# msin.orderms=false\n\
-msin.datacolumn=CORRECTED_DATA\n\
-msin.baseline=*&\n\
-msout={1}\n\
-msout.datacolumn=DATA\n\
-steps=[]".format(target, target.replace(".dppp.tmp", ".dppp")))
-	shift_ndppp.close()
+	parset=ndppp_parset(target, "CORRECTED_DATA", msout=target.replace(".dppp.tmp", ".dppp"), outcolumn="DATA", msin_opts=[("baseline", "*&")])
 	log.info("Performing shift NDPPP for {0}...".format(target_name))
-	subprocess.call("NDPPP ndppp.shift_{0}.parset > {1}/logs/ndppp_shift_{0}.log 2>&1".format(target_name, tar_obs), shell=True)
-	os.remove("ndppp.shift_{0}.parset".format(target_name))
+	run_ndppp(parset, "ndppp.shift_{0}.parset".format(target_name), "{0}/logs/ndppp_shift_{1}.log".format(tar_obs, target_name), msout=target.replace(".dppp.tmp", ".dppp"))
 	if os.path.isdir(target.replace(".dppp.tmp", ".dppp")):
-		subprocess.call("rm -r {0}".format(target), shell=True)
-	subprocess.call("mv calibrate-stand-alone*log logs > logs/movecalibratelog.log 2>&1", shell=True)
+		run_command(["rm", "-r", target])
+	move_files(["calibrate-stand-alone*log"], "logs", logfile="logs/movecalibratelog.log")
 
 # def create_ideal_rsm_bands(rsm_bands):
 # 	ideal={}
@@ -261,9 +352,10 @@ steps=[]".format(target, target.replace(".dppp.tmp", ".dppp")))
 # 		lastobs=obs
 # 	return ideal
 
-def rsm_bandsndppp(a, rsm_bands, phaseon):
+def rsm_bandsndppp(a, rsm_bands, phaseon, fuse_shift=False, cache=None):
 	"""
-	Function to combine together the sub bands into bands.
+	Function to combine together the sub bands into bands. With fuse_shift the calibrated sub bands have not been shifted \
+	and the CORRECTED_DATA is read straight from the .tmp sets, which are then renamed to their usual names.
 	"""
 	info=a.split("_")
 	current_obs=info[0]
@@ -272,25 +364,44 @@ def rsm_bandsndppp(a, rsm_bands, phaseon):
 	band=int(info[2])
 	# b_real=b+(beam*34)
 	datacol={"bands":"DATA", "subbands":"CORRECTED_DATA"}
-	fileend={"bands":".tmp", "subbands":""}
+	msout=band_output(a, phaseon)
 	log.info("Combining {0} BAND{1}...".format(b, '%02d' % band))
 	filename="{0}_ndppp.band{1}.parset".format(b, '%02d' % band)
-	n=open(filename, "w")
-	n.write("msin={0}\n\
-msin.datacolumn={4}\n\
-msin.baseline=[CR]S*&\n\
-msin.missingdata=True\n\
-msin.orderms=False\n\
-msout={1}/{2}_BAND{3}.MS.dppp{5}\n\
-steps=[]".format(rsm_bands[a], current_obs, b,'%02d' % band, datacol[phaseon], fileend[phaseon]))
-	n.close()
-	subprocess.call("NDPPP {0} > {1}/logs/{2}_BAND{3}.log 2>&1".format(filename,current_obs,b,'%02d' % band), shell=True)
-	os.remove(filename)
+	members=rsm_bands[a]
+	column=datacol[phaseon]
+	if fuse_shift:
+		members=[m+".tmp" for m in members]
+		column="CORRECTED_DATA"
+	parset=ndppp_parset(members, column, msout=msout, msin_opts=[("baseline", "[CR]S*&"), ("missingdata", "True"), ("orderms", "False")])
+	key=stage_key(members, parset, tools=["NDPPP"], cache=cache)
+	if not cache_fetch(cache, key, [msout]):
+		run_ndppp(parset, filename, "{0}/logs/{1}_BAND{2:02d}.log".format(current_obs, b, band), msout=msout)
+		cache_result(cache, key, [msout])
+	if fuse_shift and os.path.isdir(msout):
+		for m in rsm_bands[a]:
+			if os.path.isdir(m+".tmp"):
+				run_command(["mv", m+".tmp", m])
+	return os.path.isdir(msout)
+
+def band_output(a, phaseon):
+	"""
+	Returns the name of the band measurement set rsm_bandsndppp creates for band key a.
+	"""
+	info=a.split("_")
+	fileend={"bands":".tmp", "subbands":""}
+	return "{0}/{0}_{1}_BAND{2:02d}.MS.dppp{3}".format(info[0], info[1], int(info[2]), fileend[phaseon])
+
+def move_dataset(ms, newname):
+	"""
+	Renames a measurement set, used to mark sub bands ready for phase calibration.
+	"""
+	run_command(["mv", ms, newname])
+	return os.path.isdir(newname)
 	
-def calibrate_msss2(target, phaseparset, autoflag, saveflag, create_sky, skymodel, phaseon):
+def calibrate_msss2(target, phaseparset, autoflag, saveflag, create_sky, skymodel, phaseon, postcut=0, cache=None):
 	"""
 	Function for the second half of MSSS style calibration - it performs a phase-only calibration and the auto flagging \
-	if selected.
+	if selected. A non zero postcut also clips the amplitudes in the same NDPPP pass as the flagging.
 	"""
 	tsplit=target.split("/")
 	curr_obs=tsplit[0]
@@ -298,23 +409,43 @@ def calibrate_msss2(target, phaseparset, autoflag, saveflag, create_sky, skymode
 	beam=target.split("_")[1]
 	if create_sky==True:
 		skymodel="parsets/{0}.skymodel".format(beam)
+	if phaseon=="bands":
+		final=target.replace(".tmp", "")
+	else:
+		final=target.replace(".phasecaltmp", "")
+	stats=os.path.join(curr_obs, name+".stats")
+	outputs=[final, stats] if autoflag else [final]
+	key=stage_key([target], file_text(phaseparset)+file_text(skymodel), "autoflag={0}:saveflag={1}:postcut={2}".format(autoflag, saveflag, postcut), tools=["calibrate-stand-alone", "bbs-reducer", "NDPPP"], cache=cache)
+	#the preflagged copy is only made by a real run, so it is never stored or reused
+	store=None if saveflag else cache
+	if cache_fetch(store, key, outputs):
+		run_command(["rm", "-rf", target])
+		if autoflag:
+			log.info("Flagged baselines: {0} from {1} (cached)".format(",".join(stats_bad_stations(stats)), target))
+		return True
 	log.info("Performing phase only calibration on {0}...".format(target))
-	subprocess.call("calibrate-stand-alone -f {0} {1} {2} > {3}/logs/calibrate_phase_{4}.txt 2>&1".format(target, phaseparset, skymodel, curr_obs, name), shell=True)
+	unshare_dataset(target, cache)
+	run_command(["calibrate-stand-alone", "-f", target, phaseparset, skymodel], logfile="{0}/logs/calibrate_phase_{1}.txt".format(curr_obs, name), check=True)
+	steps=[]
 	if autoflag:
 		if saveflag:
 			log.info("Saving {0} before autoflag...".format(name))
-			subprocess.call("cp -r {0} {1}".format(target, os.path.join(curr_obs, "preflagged")), shell=True)
+			run_command(["cp", "-r", target, os.path.join(curr_obs, "preflagged")])
 		final_toflag=flagging(target)
 		log.info("Flagging baselines: {0} from {1}".format(",".join(final_toflag), target))
-		ndpppflag(target, final_toflag, False)
-	# subprocess.call('msselect in={0} out={1} baseline=\'{2}\' deep=true > {3}/logs/msselect.log 2>&1'.format(target, target.replace(".tmp", ""), final_toflag, curr_obs), shell=True)
-	if phaseon=="bands":
-		subprocess.call('mv {0} {1} > /dev/null 2>&1'.format(target, target.replace(".tmp", "")), shell=True)
-	else:
-		subprocess.call('mv {0} {1} > /dev/null 2>&1'.format(target, target.replace(".phasecaltmp", "")), shell=True)
-	subprocess.call("mv calibrate-stand-alone*log logs > logs/movecalibratelog.log 2>&1", shell=True)
+		steps.append(baseline_flag_step(final_toflag))
+	if postcut!=0:
+		log.info("Performing post-BBS NDPPP flagging, with cut of {0}, on {1}...".format(postcut, name))
+		steps.append(amplitude_clip_step(postcut))
+	if len(steps)>0:
+		parset=ndppp_parset(target, "CORRECTED_DATA", outcolumn="CORRECTED_DATA", steps=steps)
+		run_ndppp(parset, "{0}_flag.parset".format(name), "{0}/logs/ndppp_station_flagging_{1}_flag_log.txt".format(curr_obs, name))
+	# run_command('msselect in={0} out={1} baseline=\'{2}\' deep=true > {3}/logs/msselect.log 2>&1'.format(target, target.replace(".tmp", ""), final_toflag, curr_obs))
+	run_command(["mv", target, final], logfile=os.devnull)
+	move_files(["calibrate-stand-alone*log"], "logs", logfile="logs/movecalibratelog.log")
+	cache_result(store, key, outputs)
 	# if os.path.isdir(target.replace(".tmp", "")):
-		# subprocess.call("rm -rf {0}".format(target), shell=True)
+		# run_command("rm -rf {0}".format(target))
 
 def standalone_phase(target, phaseparset, autoflag, saveflag, create_sky, skymodel, phaseoutput, phasecolumn):
 	"""
@@ -333,42 +464,176 @@ msout.datacolumn=DATA\n\
 steps=[]".format(target, phasecolumn))
 	phase_shift_ndppp.close()
 	log.info("Performing phase shift NDPPP for {0}...".format(target_name))
-	subprocess.call("NDPPP ndppp.shift_{0}.parset > {1}/logs/ndppp_phase_standalone_shift_{0}.log 2>&1".format(target_name, curr_obs), shell=True)
+	run_command(["NDPPP", "ndppp.shift_{0}.parset".format(target_name)], logfile="{0}/logs/ndppp_phase_standalone_shift_{1}.log".format(curr_obs, target_name))
 	os.remove("ndppp.shift_{0}.parset".format(target_name))
 	target+=".PHASEONLY.tmp"
 	if create_sky:
 		skymodel="parsets/{0}.skymodel".format(beam)
 	log.info("Performing phase only calibration on {0}...".format(target))
-	subprocess.call("calibrate-stand-alone -f {0} {1} {2} > {3}/logs/calibrate_standalone_phase_{4}.txt 2>&1".format(target, phaseparset, skymodel, curr_obs, target_name), shell=True)
+	run_command(["calibrate-stand-alone", "-f", target, phaseparset, skymodel], logfile="{0}/logs/calibrate_standalone_phase_{1}.txt".format(curr_obs, target_name))
 	if autoflag:
 		if saveflag:
 			log.info("Saving {0} before autoflag...")
-			subprocess.call("cp -r {0} {1}".format(target, os.path.join(curr_obs, phaseoutput, "preflagged")), shell=True)
+			run_command(["cp", "-r", target, os.path.join(curr_obs, phaseoutput, "preflagged")])
 		final_toflag=flagging(target)
 		log.info("Flagging baselines: {0} from {1}".format(",".join(final_toflag), target))
 		ndpppflag(target, final_toflag, False)
-	# subprocess.call('msselect in={0} out={1} baseline=\'{2}\' deep=true > {3}/logs/msselect_phaseonly.log 2>&1'.format(target, os.path.join(curr_obs, phaseoutput,target_name+".PHASEONLY"),final_toflag,curr_obs), shell=True)
-	subprocess.call('mv {0} {1} > /dev/null 2>&1'.format(target, os.path.join(curr_obs, phaseoutput,target_name+".PHASEONLY")), shell=True)
-	subprocess.call("mv calibrate-stand-alone*log logs > logs/movecalibratelog.log 2>&1", shell=True)
+	# run_command('msselect in={0} out={1} baseline=\'{2}\' deep=true > {3}/logs/msselect_phaseonly.log 2>&1'.format(target, os.path.join(curr_obs, phaseoutput,target_name+".PHASEONLY"),final_toflag,curr_obs))
+	run_command(["mv", target, os.path.join(curr_obs, phaseoutput,target_name+".PHASEONLY")], logfile=os.devnull)
+	move_files(["calibrate-stand-alone*log"], "logs", logfile="logs/movecalibratelog.log")
 	# if os.path.isdir(os.path.join(curr_obs, phaseoutput,target_namhe+".PHASEONLY")):
-		# subprocess.call("rm -rf {0}".format(target), shell=True)
-	subprocess.call("mv {0}*.pdf {0}*.stats {0}*.tab {1}/flagging/".format(target, curr_obs), shell=True)
+		# run_command("rm -rf {0}".format(target))
+	move_files([target+"*.pdf", target+"*.stats", target+"*.tab"], curr_obs+"/flagging/")
+
+def baseline_stats(ms, column="DATA", chunk=5000, nbins=1024, decades=6.):
+	"""
+	Computes the per baseline and correlation statistics used by the autoflag in a single pass over the data, reading the data and \
+	flags in chunks of rows. As in asciistats.py with its default settings, each row is averaged over its unflagged channels and the \
+	median amplitude and the standard deviation of the real part of these averages are found for each cross correlation baseline. \
+	Only per baseline accumulators are kept: the standard deviation is merged exactly from the mean and sum of squared deviations of \
+	each chunk, and the median is interpolated from a histogram of log amplitude with nbins bins spanning the given number of decades \
+	around the first amplitudes of each baseline, so it agrees with the exact median to a small fraction of a bin. \
+	Returns a list of (ant1, ant2, corr, num, numflag, amp_median, real_std) ordered by baseline.
+	"""
+	t=pt.table(ms, ack=False)
+	nrows=t.nrows()
+	nant=pt.table(ms+"/ANTENNA", ack=False).nrows()
+	nbl=nant*nant
+	acc=None
+	for start in range(0, nrows, chunk):
+		n=min(chunk, nrows-start)
+		ant1=t.getcol("ANTENNA1", start, n)
+		ant2=t.getcol("ANTENNA2", start, n)
+		data=t.getcol(column, start, n)
+		good=~(t.getcol("FLAG", start, n) | np.isnan(data))
+		if acc is None:
+			nchan=data.shape[1]
+			ncorr=data.shape[2]
+			acc={"rows":np.zeros(nbl, dtype=np.int64), "num":np.zeros((ncorr, nbl)), "nvalid":np.zeros((ncorr, nbl)),
+			"mean":np.zeros((ncorr, nbl)), "m2":np.zeros((ncorr, nbl)), "ref":np.zeros((ncorr, nbl)),
+			"hist":np.zeros((ncorr, nbl, nbins), dtype=np.int32)}
+		cross=ant1!=ant2
+		g=(ant1*nant+ant2)[cross]
+		cnt=good[cross].sum(axis=1)
+		means=np.where(good[cross], data[cross], 0).sum(axis=1, dtype=np.complex128)/np.maximum(cnt, 1)
+		acc["rows"]+=np.bincount(g, minlength=nbl)
+		for j in range(ncorr):
+			acc["num"][j]+=np.bincount(g, weights=cnt[:,j], minlength=nbl)
+			valid=cnt[:,j]>0
+			gv=g[valid]
+			x=means[valid, j]
+			nchunk=np.bincount(gv, minlength=nbl).astype(np.float64)
+			#merge the chunk's mean and squared deviations of the real part into the running ones
+			cmean=np.bincount(gv, weights=x.real, minlength=nbl)/np.maximum(nchunk, 1)
+			cm2=np.bincount(gv, weights=(x.real-cmean[gv])**2, minlength=nbl)
+			total=acc["nvalid"][j]+nchunk
+			delta=cmean-acc["mean"][j]
+			frac=nchunk/np.maximum(total, 1)
+			acc["m2"][j]+=cm2+delta**2*acc["nvalid"][j]*frac
+			acc["mean"][j]+=delta*frac
+			acc["nvalid"][j]=total
+			#histogram of log amplitude about a reference taken from the first amplitudes of each baseline
+			amp=np.abs(x)
+			unset=(acc["ref"][j]==0) & (nchunk>0)
+			if unset.any():
+				first=np.bincount(gv, weights=amp, minlength=nbl)/np.maximum(nchunk, 1)
+				acc["ref"][j][unset]=np.where(first[unset]>0, first[unset], 1.)
+			with np.errstate(divide='ignore'):
+				pos=(np.log10(amp)-np.log10(acc["ref"][j][gv]))/decades+0.5
+			idx=np.clip(np.floor(np.nan_to_num(pos)*nbins), 0, nbins-1).astype(np.int64)
+			np.add.at(acc["hist"][j].reshape(-1), gv*nbins+idx, 1)
+	t.close()
+	if acc is None:
+		return []
+	baselines=np.nonzero(acc["rows"])[0]
+	results={}
+	for j in range(ncorr):
+		nvalid=acc["nvalid"][j][baselines]
+		has=nvalid>0
+		std=np.sqrt(acc["m2"][j][baselines]/np.maximum(nvalid, 1))
+		std[~has]=np.nan
+		#median from the cumulative histogram, interpolated within the bin holding the middle rank
+		hist=acc["hist"][j][baselines]
+		cum=np.cumsum(hist, axis=1)
+		half=nvalid/2.
+		k=np.argmax(cum > half[:,None], axis=1)
+		below=np.where(k>0, cum[np.arange(len(k)), k-1], 0)
+		inbin=hist[np.arange(len(k)), k]
+		frac=(half-below)/np.maximum(inbin, 1)
+		logamp=np.log10(acc["ref"][j][baselines])+((k+frac)/nbins-0.5)*decades
+		med=np.where(has, 10**logamp, np.nan)
+		num=acc["num"][j][baselines].astype(np.int64)
+		results[j]=(num, acc["rows"][baselines]*nchan-num, med, std)
+	stats=[]
+	for b in range(len(baselines)):
+		for j in range(ncorr):
+			num, numflag, med, std=results[j]
+			stats.append((int(baselines[b]/nant), int(baselines[b]%nant), j, int(num[b]), int(numflag[b]), med[b], std[b]))
+	return stats
+
+def write_baseline_stats(ms, stats, output, acc=4):
+	"""
+	Writes the statistics from baseline_stats to output/<ms name>.stats in the format of asciistats.py, as read by statsplot.py.
+	"""
+	t=pt.table(ms+"/ANTENNA", ack=False)
+	names=t.getcol("NAME")
+	t.close()
+	freq="{0:.3f}".format(ms_metadata(ms)["ref_freq"]/1.e6)
+	widths=[9, 5, 5, 15, 15, 4, 10, 10, 8+acc, 8+acc]
+	labels=['XX', 'XY', 'YX', 'YY']
+	form="%."+str(acc)+"e"
+	f=open(os.path.join(output, ms.split("/")[-1]+".stats"), 'w')
+	header=['#sbfreq', 'ant1', 'ant2', 'ant1Name', 'ant2Name', 'corr', 'num', 'numflag', 'amp_median', 'real_std']
+	f.write("\t".join([h.rjust(w) for h, w in zip(header, widths)])+"\n")
+	for a1, a2, j, num, numflag, med, std in stats:
+		row=[freq, str(a1), str(a2), names[a1], names[a2], labels[j], str(num), str(numflag), form % med, form % std]
+		f.write("\t".join([r.rjust(w) for r, w in zip(row, widths)])+"\n")
+	f.close()
 
 def flagging(target):
 	"""
-	A function which copies the auto detection of bad stations developed during MSSS.
+	A function which copies the auto detection of bad stations developed during MSSS. The stations are selected in memory, the \
+	.stats file is only kept for the record and the plots, which are made afterwards by plot_flag_stats.
 	"""
 	log.info("Gathering AutoFlag Information for {0}...".format(target))
-	subprocess.call('{0} -i {1} -r {2}/ > {2}/logs/asciistats.log 2>&1'.format(tools["ascii"], target, target.split("/")[0]), shell=True)
-	subprocess.call('{0} -i {1}.stats -o {1} > logs/statsplot.log 2>&1'.format(tools["stats"], target), shell=True)
-	stats=open('{0}.tab'.format(target), 'r')
-	baselines=[]
-	for line in stats:
-		if line.startswith('#')==False:
-			cols=line.rstrip('\n').split('\t')
-			if cols[12] == 'True':
-				baselines.append(cols[1])
-	return baselines
+	stats=baseline_stats(target)
+	write_baseline_stats(target, stats, target.split("/")[0])
+	t=pt.table(target+"/ANTENNA", ack=False)
+	names=t.getcol("NAME")
+	t.close()
+	return bad_station_names(stats, names)
+
+def bad_station_names(stats, names):
+	"""
+	Returns the names of the stations selected as bad from the statistics of baseline_stats.
+	"""
+	if len(stats)==0:
+		return []
+	ant1, ant2, corr, num, numflag, amp_median, real_std=[np.array(c) for c in zip(*stats)]
+	return [names[i] for i in find_bad_stations(ant1, ant2, corr, num, amp_median, real_std)]
+
+def stats_bad_stations(stats_file):
+	"""
+	Returns the names of the stations selected as bad from a .stats file written by write_baseline_stats, used when the \
+	calibrated data come from the stage cache.
+	"""
+	labels=['XX', 'XY', 'YX', 'YY']
+	stats=[]
+	names={}
+	for line in open(stats_file):
+		if line.strip()=="" or line.lstrip().startswith("#"):
+			continue
+		freq, a1, a2, name1, name2, corr, num, numflag, med, std=line.split()
+		names[int(a1)]=name1
+		names[int(a2)]=name2
+		stats.append((int(a1), int(a2), labels.index(corr), int(num), int(numflag), float(med), float(std)))
+	return bad_station_names(stats, names)
+
+def plot_flag_stats(stats):
+	"""
+	Makes the autoflag plots and station table from a .stats file written by flagging, next to the file.
+	"""
+	run_command([tools["stats"], "-i", stats, "-o", stats[:-len(".stats")]], logfile="logs/statsplot.log")
 
 def ndpppflag(MS, blines, cobalt):
 	msname=MS.split("/")[-1]
@@ -378,31 +643,24 @@ def ndpppflag(MS, blines, cobalt):
 		column="DATA"
 	else:
 		column="CORRECTED_DATA"
-	f=open(parset_name, 'w')
-	f.write("msin={0}\n\
-msin.datacolumn={1}\n\
-msout=\n\
-\n\
-steps=[flag]\n\
-\n\
-flag.type=preflagger\n\
-flag.baseline={2}\n".format(MS, column, blines))
-	f.close()
+	parset=ndppp_parset(MS, column, steps=[baseline_flag_step(blines)])
 	logname="{0}_flag_log.txt".format(msname)
 	if cobalt:
-		subprocess.call("NDPPP {0} > {1}/logs/ndppp_cobalt_station_flagging_{2}.txt 2>&1".format(parset_name,obs,logname), shell=True)
+		run_ndppp(parset, parset_name, "{0}/logs/ndppp_cobalt_station_flagging_{1}.txt".format(obs, logname))
 	else:
-		subprocess.call("NDPPP {0} > {1}/logs/ndppp_station_flagging_{2}.txt 2>&1".format(parset_name,obs,logname), shell=True)
-	os.remove(parset_name)
+		run_ndppp(parset, parset_name, "{0}/logs/ndppp_station_flagging_{1}.txt".format(obs, logname))
 	
-def cobalt_flag(MS):
+def cobalt_flag(MS, cache=None):
 	blines=flagging(MS)
 	log.info("Flagging baselines: {0} from {1}".format(",".join(blines), MS.split("/")[-1]))
+	unshare_dataset(MS, cache)
 	ndpppflag(MS, blines, True)
+	extend_identity(MS, "cobalt:"+",".join(blines)+tool_identity(["NDPPP"]), cache)
 
-def peeling_steps(SB, shortpeel, peelsources, peelnumsources, fluxlimit, skymodel, create_sky):
+def peeling_steps(SB, shortpeel, peelsources, peelnumsources, fluxlimit, skymodel, create_sky, archive=False, cache=None):
 	"""
-	Performs the peeling steps developed during MSSS activities.
+	Performs the peeling steps developed during MSSS activities. The pre-peel dataset is moved to prepeeled_sets and the \
+	peeled one put in its place with renames rather than copies, and archive stores the pre-peel dataset as a tar.gz.
 	"""
 	peelsplit=SB.split('/')
 	logname=peelsplit[-1]
@@ -411,6 +669,8 @@ def peeling_steps(SB, shortpeel, peelsources, peelnumsources, fluxlimit, skymode
 	beam=logname.split("_")[1]
 	if create_sky:
 		skymodel="parsets/{0}.skymodel".format(beam)
+	if os.path.isdir(SB+".peeltmp"):
+		run_command(["rm", "-rf", SB+".peeltmp"])
 	log.info("Creating new {0} dataset ready for peeling...".format(SB))
 	p_shiftname="peeling_shift_{0}.parset".format(logname)
 	f=open(p_shiftname, 'w')
@@ -419,41 +679,49 @@ msin.datacolumn=CORRECTED_DATA\n\
 msout={0}.peeltmp\n\
 steps=[]".format(SB))
 	f.close()
-	subprocess.call("NDPPP {0} > {1}/logs/ndppp_peeling_shift_{2}.log 2>&1".format(p_shiftname, obsid, logname), shell=True)
+	run_command(["NDPPP", p_shiftname], logfile="{0}/logs/ndppp_peeling_shift_{1}.log".format(obsid, logname), cleanup=[SB+".peeltmp"], check=True)
 	peelparset=SB+"_peeling.parset"
 	if shortpeel:
 		log.info("Performing only first stage of peeling (i.e. peeled sources will not be re-added)")
-		subprocess.call(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new.parset')), peelparset])
+		run_command(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new.parset')), peelparset])
 	else:
 		log.info("Performing full peeling steps")
 		peel2parset=SB+'_peeling_step2.parset'
-		subprocess.call(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new_readyforstep2.parset')), peelparset])
-		subprocess.call(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new_step2.parset')), peel2parset])
+		run_command(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new_readyforstep2.parset')), peelparset])
+		run_command(['cp', "{0}".format(os.path.join(tools["peelingparsets"],'peeling_new_step2.parset')), peel2parset])
 	log.info("Determining sources to peel for {0}...".format(SB))
-	if peelsources=="0":
-		subprocess.call("python {0} -i {1} -p {2} -m {3} -v -n {4} -l {5}".format(tools["peelingnew"], SB, peelparset, skymodel, peelnumsources, fluxlimit), shell=True)
-	else:
-		subprocess.call("python {0} -i {1} -p {2} -m {3} -v -n {4} -s {5} -l {6}".format(tools["peelingnew"], SB, peelparset, skymodel, peelnumsources, peelsources, fluxlimit), shell=True)
+	peel, other=plan_peeling(SB, skymodel, limit=fluxlimit, nsources=peelnumsources, specsources=peelsources, parset=peelparset, cachedir=skymodel_cache(cache))
+	log.info("Peeling {0} source(s) from {1}: {2}".format(len(peel), SB, ",".join(peel)))
 	newSB=SB+".peeltmp"
 	log.info("Peeling {0}...".format(SB))
-	subprocess.call("calibrate-stand-alone -f {0} {1} {2} > {4}/logs/{3}_peeling_calibrate.log 2>&1".format(newSB, peelparset, skymodel, logname, obsid), shell=True)
+	run_command(["calibrate-stand-alone", "-f", newSB, peelparset, skymodel], logfile="{0}/logs/{1}_peeling_calibrate.log".format(obsid, logname), check=True)
 	if not shortpeel:
-		subprocess.call("{0} -f -o {1}.skymodel {1}/instrument/ {2} > {4}/logs/{3}_float_solutions.txt 2>&1".format(tools["peelingfloat"], newSB, skymodel, logname, obsid), shell=True)
-		subprocess.call("calibrate-stand-alone -f {0} {1} {0}.skymodel > {3}/logs/{2}_peeling_calibrate_step2.log 2>&1".format(newSB, peel2parset, logname, obsid), shell=True)
-	#move preepeeled dataset
-	subprocess.call('msselect in={0} out={2}/prepeeled_sets/{1} deep=true > {2}/logs/msselect_moveprepeel.log 2>&1'.format(SB, prepeel, obsid), shell=True)
-	#rename the peeled dataset
-	subprocess.call('msselect in={0} out={1} deep=true > {2}/logs/msselect_movingpeeled.log 2>&1'.format(newSB, SB, obsid), shell=True)
-	if os.path.isdir(SB):
-		subprocess.call("rm -r {0}.peeltmp".format(SB), shell=True)
+		run_command([tools["peelingfloat"], "-f", "-o", newSB+".skymodel", newSB+"/instrument/", skymodel], logfile="{0}/logs/{1}_float_solutions.txt".format(obsid, logname))
+		run_command(["calibrate-stand-alone", "-f", newSB, peel2parset, newSB+".skymodel"], logfile="{0}/logs/{1}_peeling_calibrate_step2.log".format(obsid, logname), check=True)
+	#move preepeeled dataset and rename the peeled dataset, both within the observation directory
+	prepeeldir=os.path.join(obsid, "prepeeled_sets")
+	if os.path.isdir(os.path.join(prepeeldir, prepeel)):
+		run_command(["rm", "-rf", os.path.join(prepeeldir, prepeel)])
+	os.rename(SB, os.path.join(prepeeldir, prepeel))
+	try:
+		os.rename(newSB, SB)
+	except OSError:
+		os.rename(os.path.join(prepeeldir, prepeel), SB)
+		raise
+	if archive:
+		log.info("Archiving pre-peel {0}...".format(SB))
+		run_command(["tar", "czf", os.path.join(prepeeldir, prepeel+".tar.gz"), "-C", prepeeldir, prepeel], logfile="{0}/logs/{1}_archive_prepeel.log".format(obsid, logname),
+		cleanup=[os.path.join(prepeeldir, prepeel+".tar.gz")], check=True)
+		run_command(["rm", "-rf", os.path.join(prepeeldir, prepeel)])
 	os.remove(p_shiftname)
 	os.remove(peelparset)
 	if not shortpeel:
 		os.remove(peel2parset)
 		os.remove("{0}.skymodel".format(newSB))
-	subprocess.call("mv calibrate-stand-alone*log logs > logs/peelcalibratelog.log 2>&1", shell=True)
+	move_files(["calibrate-stand-alone*log"], "logs", logfile="logs/peelcalibratelog.log")
+	extend_identity(SB, "peel:"+file_text(skymodel)+file_text(peelparset)+tool_identity(["calibrate-stand-alone", "bbs-reducer", "NDPPP"]), cache)
 
-def post_bbs(SB, postcut):
+def post_bbs(SB, postcut, cache=None):
 	"""
 	Generates a standard NDPPP parset and clips the amplitudes to user specified level.
 	"""
@@ -461,21 +729,10 @@ def post_bbs(SB, postcut):
 	SB_name=SBsplit[-1]
 	log.info("Performing post-BBS NDPPP flagging, with cut of {0}, on {1}...".format(postcut, SB_name))
 	postbbsfname='ndppp.{0}.postbbs.parset'.format(SB_name)
-	ndppp_postbbs=open(postbbsfname,'w')
-	ndppp_postbbs.write("msin={0}\n\
-msin.datacolumn = CORRECTED_DATA\n\
-msout=\n\
-msout.datacolumn = CORRECTED_DATA\n\
-\n\
-steps = [preflag]   # if defined as [] the MS will be copied and NaN/infinite will be  flagged\n\
-\n\
-preflag.type=preflagger\n\
-preflag.corrtype=cross\n\
-preflag.amplmax={1}\n\
-preflag.baseline=[CS*,RS*,DE*,SE*,UK*,FR*]".format(SB, postcut))
-	ndppp_postbbs.close()
-	subprocess.call("NDPPP ndppp.{0}.postbbs.parset > {1}/logs/ndppp_postbbs_{0}.txt 2>&1".format(SB_name, SBsplit[0]), shell=True)
-	os.remove(postbbsfname)
+	parset=ndppp_parset(SB, "CORRECTED_DATA", outcolumn="CORRECTED_DATA", steps=[amplitude_clip_step(postcut)])
+	unshare_dataset(SB, cache)
+	run_ndppp(parset, postbbsfname, "{0}/logs/ndppp_postbbs_{1}.txt".format(SBsplit[0], SB_name))
+	extend_identity(SB, "postbbs:{0}".format(postcut)+tool_identity(["NDPPP"]), cache)
 
 def convert_newawimager(environ):
 	"""
@@ -487,7 +744,7 @@ def convert_newawimager(environ):
 	environ['PYTHONPATH']="/opt/share/soft/pathdirs/python-packages:/opt/share/lofar-archive/2013-02-11-16-46/pathdirs/python-packages"
 	return environ
 
-def create_mask(beam, mask_size, toimage):
+def create_mask(beam, mask_size, toimage, cache=None):
 	beamc="SAP00{0}".format(beam)
 	mask="parsets/{0}.mask".format(beamc)
 	for i in toimage:
@@ -497,12 +754,12 @@ def create_mask(beam, mask_size, toimage):
 	if not os.path.isdir(mask):
 		log.info("Creating {0} mask...".format(beamc))
 		skymodel="parsets/{0}.skymodel".format(beamc)
-		subprocess.call('makesourcedb in={0} out={0}.temp format=Name,Type,Ra,Dec,I,Q,U,V,ReferenceFrequency=\\\"60e6\\\",SpectralIndex=\\\"[0.0]\\\",MajorAxis,MinorAxis,Orientation > /dev/null 2>&1'.format(skymodel), shell=True)
-		mask_command="awimager ms={0} image={1} operation=empty stokes='I'".format(g, mask)
-		mask_command+=mask_size
-		subprocess.call(mask_command+" > logs/aw_mask_creation_{0}.log 2>&1".format(beamc), shell=True)
-		subprocess.call("{0} {1} {2}.temp > logs/msss_mask.log 2>&1".format(tools["msssmask"], mask, skymodel), shell=True)
-		subprocess.call(["rm", "-r", "{0}.temp".format(skymodel)])
+		build_sourcedb(skymodel, skymodel+".temp", 'Name,Type,Ra,Dec,I,Q,U,V,ReferenceFrequency="60e6",SpectralIndex="[0.0]",MajorAxis,MinorAxis,Orientation', cache)
+		mask_command=["awimager", "ms="+g, "image="+mask, "operation=empty", "stokes=I"]+mask_size.split()
+		run_command(mask_command, logfile="logs/aw_mask_creation_{0}.log".format(beamc), cleanup=[mask])
+		for w in fill_mask(mask, skymodel+".temp", verbose=False):
+			log.warning("{0} mask: {1}".format(beamc, w))
+		run_command(["rm", "-r", "{0}.temp".format(skymodel)])
 
 
 def open_subtables(table):
@@ -599,10 +856,9 @@ def getdatainfo(ms):
 	t1=pt.table("{0}.img.restored.corr".format(ms), ack=False)
 	restbw=t1.getkeywords()['coords']['spectral2']['wcs']['cdelt']
 	t1.close()
-	t1=pt.table("{0}/OBSERVATION".format(ms), ack=False)
-	thisendtime=t1.getcell('LOFAR_OBSERVATION_END', 0)
-	thisantenna=t1.getcell('LOFAR_ANTENNA_SET', 0)
-	t1.close()
+	info=ms_metadata(ms)
+	thisendtime=info["obs_end"]
+	thisantenna=info["antenna_set"]
 	table = pt.table("{0}.img.restored.corr".format(ms), ack=False)
 	subtables = open_subtables(table)
 	ncore, nremote, nintl =  parse_stations(subtables)
@@ -657,8 +913,7 @@ def AW_Steps(g, aw_sets, minb, maxb, aw_env, niter, imagingmode, bandsthreshs_di
 		obsid="final_datasets"
 	else:
 		obsid=logname.split("_")[0]
-	ft = pt.table(g+'/SPECTRAL_WINDOW', ack=False)
-	freq = ft.getcell('REF_FREQUENCY',0)
+	freq=ms_metadata(g)["ref_freq"]
 	wave_len=c/freq
 	if uvORm == "M":
 		UVmin=minb/(wave_len*1000.)
@@ -670,7 +925,6 @@ def AW_Steps(g, aw_sets, minb, maxb, aw_env, niter, imagingmode, bandsthreshs_di
 		UVmax=maxb
 		localminb=UVmin*(wave_len*1000.)
 		localmaxb=UVmax*(wave_len*1000.)
-	ft.close()
 	log.debug("Frequency = {0} Hz".format(freq))
 	log.debug("Wavelength = {0} m".format(wave_len))
 	log.debug("UVmin = {0}".format(UVmin))
@@ -700,8 +954,8 @@ UVmax={4}\n".format(g, initialiter,thisthreshold,UVmin,UVmax))
 			local_parset.write(i)
 		local_parset.close()
 		log.info("Imaging {0} with AWimager...".format(g))
-		subprocess.call("awimager {0} > {1}/logs/awimager_{2}_initial_log.txt 2>&1".format(aw_parset_name, obsid, logname), env=aw_env, shell=True)
-		subprocess.call("image2fits in={0}.img.residual out={0}.img.fits > {1}/logs/image2fits.log 2>&1".format(g, obsid), shell=True)
+		run_command(["awimager", aw_parset_name], env=aw_env, logfile="{0}/logs/awimager_{1}_initial_log.txt".format(obsid, logname), cleanup=[g+".img*", g+".img0*"], check=True)
+		run_command(["image2fits", "in={0}.img.residual".format(g), "out={0}.img.fits".format(g)], logfile="{0}/logs/image2fits.log".format(obsid), cleanup=[g+".img.fits"])
 		try:
 			if imagingmode=='rsm':
 				thresh=2.5*(getimgstd("{0}.img.fits".format(g)))
@@ -709,7 +963,7 @@ UVmax={4}\n".format(g, initialiter,thisthreshold,UVmin,UVmax))
 				thresh=5.0*(getimgstd("{0}.img.fits".format(g)))
 		except:
 			log.error("FITS {0}.img.fits could not be found!".format(g))
-			return
+			return False
 		os.remove("{0}.img.fits".format(g))
 	else:
 		thresh=userthresh
@@ -726,19 +980,27 @@ UVmax={4}\n".format(g, finish_iters, thresh, UVmin, UVmax))
 	for i in aw_sets:
 		local_parset.write(i)
 	local_parset.close()
-	subprocess.call("awimager {0} > {1}/logs/awimager_{2}_final_log.txt 2>&1".format(aw_parset_name, obsid, logname), env=aw_env, shell=True)
+	run_command(["awimager", aw_parset_name], env=aw_env, logfile="{0}/logs/awimager_{1}_final_log.txt".format(obsid, logname), cleanup=[g+".img*", g+".img0*"], check=True)
 	if mos:
-		subprocess.call("cp -r {0}.img.restored.corr {0}.img_mosaic.restored.corr".format(g), shell=True)
-		subprocess.call("cp -r {0}.img0.avgpb {0}.img_mosaic0.avgpb".format(g), shell=True)
-	subprocess.call("addImagingInfo {0}.img.restored '' {4} {3} {0} > {1}/logs/addImagingInfo_{2}_log.txt 2>&1".format(g, obsid, logname, localmaxb, localminb), shell=True)
-	subprocess.call("addImagingInfo {0}.img.restored.corr '' {4} {3} {0} > {1}/logs/addImagingInfo_{2}_log.txt 2>&1".format(g, obsid, logname, localmaxb, localminb), shell=True)
-	subprocess.call("image2fits in={0}.img.restored out={0}.img.restored.fits > {1}/logs/image2fits.log 2>&1".format(g, obsid), shell=True)
-	subprocess.call("image2fits in={0}.img.restored.corr out={0}.img.restored.corr.fits > {1}/logs/image2fits.log 2>&1".format(g, obsid), shell=True)
+		run_command(["cp", "-r", g+".img.restored.corr", g+".img_mosaic.restored.corr"])
+		run_command(["cp", "-r", g+".img0.avgpb", g+".img_mosaic0.avgpb"])
+	run_command(["addImagingInfo", g+".img.restored", "", str(localminb), str(localmaxb), g], logfile="{0}/logs/addImagingInfo_{1}_log.txt".format(obsid, logname))
+	run_command(["addImagingInfo", g+".img.restored.corr", "", str(localminb), str(localmaxb), g], logfile="{0}/logs/addImagingInfo_{1}_corr_log.txt".format(obsid, logname))
+	run_command(["image2fits", "in={0}.img.restored".format(g), "out={0}.img.restored.fits".format(g)], logfile="{0}/logs/image2fits.log".format(obsid), cleanup=[g+".img.restored.fits"])
+	run_command(["image2fits", "in={0}.img.restored.corr".format(g), "out={0}.img.restored.corr.fits".format(g)], logfile="{0}/logs/image2fits_corr.log".format(obsid), cleanup=[g+".img.restored.corr.fits"])
 	os.remove(aw_parset_name)
 	restbw, thisendtime, thisantenna, ncore, nremote, nintl, subbandwidth, subbands=getdatainfo(g)
 	fitstofix=["{0}.img.restored.corr.fits".format(g), "{0}.img.restored.fits".format(g)]
 	for fix in fitstofix:
 		correctfits(fix, restbw, thisendtime, thisantenna, ncore, nremote, nintl, subbandwidth, subbands)
+	move_files([g+".img*"], os.path.join(os.path.dirname(g), "images"), logfile=os.devnull)
+	
+def image_products(g):
+	"""
+	Returns the final FITS images AW_Steps produces for dataset g once moved to the images directory.
+	"""
+	images=os.path.join(os.path.dirname(g), "images", os.path.basename(g))
+	return [images+".img.restored.fits", images+".img.restored.corr.fits"]
 	
 
 def wavelength(f):
@@ -766,14 +1028,10 @@ def awroughparset(toimage, bands, res, mode):
 	resolution={"vlss":np.deg2rad(80./60./60.)}
 	#Obtain the frequency/wavelength range
 	lfreqms=[ms for ms in toimage if "BAND{0:02d}".format(range(bands)[0]) in ms][0]
-	ft = pt.table(lfreqms+'/SPECTRAL_WINDOW', ack=False)
-	lfreq = float(ft.getcell('REF_FREQUENCY',0))
-	ft.close()
+	lfreq=ms_metadata(lfreqms)["ref_freq"]
 	if bands>1:
 		hfreqms=[ms for ms in toimage if "BAND{0:02d}".format(range(bands)[-1]) in ms][0]
-		ft = pt.table(hfreqms+'/SPECTRAL_WINDOW', ack=False)
-		hfreq = float(ft.getcell('REF_FREQUENCY',0))
-		ft.close()
+		hfreq=ms_metadata(hfreqms)["ref_freq"]
 	else:
 		hfreq=lfreq
 	l_high=wavelength(hfreq)
@@ -824,84 +1082,22 @@ ApplyElement=0".format(int(Nround), int(cellround), int(wmax)))
 	return parsetname, uv_max
 
 def getimgstd(infile):
-	fln=pyfits.open(infile)
-	rawdata=fln[0].data
-	angle=fln[0].header['obsra']
-	bscale=fln[0].header['bscale']
-	rawdata=rawdata.squeeze()
-	rawdata=rawdata*bscale
-	while len(rawdata) < 20:
-		rawdata = rawdata[0]
-	X,Y = np.shape(rawdata)
-	rawdata = rawdata[Y/6:5*Y/6,X/6:5*X/6]
-	orig_raw = rawdata
-	med, std, mask = Median_clip(rawdata, full_output=True, ftol=0.0, max_iter=10, sigma=3)
-	rawdata[mask==False] = med
-	fln.close()
-	return std
-
-def Median_clip(arr, sigma=3, max_iter=3, ftol=0.01, xtol=0.05, full_output=False, axis=None):
-    """Median_clip(arr, sigma, max_iter=3, ftol=0.01, xtol=0.05, full_output=False, axis=None)
-    Return the median of an array after iteratively clipping the outliers.
-    The median is calculated upon discarding elements that deviate more than
-    sigma * standard deviation the median.
-
-    arr: array to calculate the median from.
-    sigma (3): the clipping threshold, in units of standard deviation.
-    max_iter (3): the maximum number of iterations. A value of 0 will
-        return the usual median.
-    ftol (0.01): fraction tolerance limit for convergence. If the number
-        of discarded elements changes by less than ftol, the iteration is
-        stopped.
-    xtol (0.05): absolute tolerance limit for convergence. If the number
-        of discarded elements increases above xtol with respect to the
-        initial number of elements, the iteration is stopped.
-    full_output (False): If True, will also return the indices that were good.
-    axis (None): Axis along which the calculation is to be done. NOT WORKING!!!
-
-    >>> med = Median_clip(arr, sigma=3, max_iter=3)
-    >>> med, std, inds_good = Median_clip(arr, sigma=3, max_iter=3, full_output=True)
-    """
-    arr = np.ma.masked_invalid(arr)
-    med = np.median(arr, axis=axis)
-    std = np.std(arr, axis=axis)
-    ncount = arr.count(axis=axis)
-    for niter in xrange(max_iter):
-        ncount_old = arr.count(axis=axis)
-        if axis is not None:
-            condition = (arr < np.expand_dims(med-std*sigma, axis)) + (arr > np.expand_dims(med+std*sigma, axis))
-        else:
-            condition = (arr < med-std*sigma) + (arr > med+std*sigma)
-        arr = np.ma.masked_where(condition, arr)
-        ncount_new = arr.count(axis)
-        med = np.median(arr, axis=axis)
-        std = np.std(arr, axis=axis)
-        if np.any(ncount-ncount_new > xtol*ncount):
-            print( "xtol reached {}; breaking at iteration {}".format(1-1.*ncount_new/ncount, niter+1) )
-            break
-        if np.any(ncount_old-ncount_new < ftol*ncount_old):
-            print( "ftol reached {}; breaking at iteration {}".format(1-1.*ncount_new/ncount_old, niter+1) )
-            break
-    if full_output:
-        if isinstance(arr.mask, np.bool_):
-            mask = np.ones(arr.shape, dtype=bool)
-        else:
-            mask = ~arr.mask
-        if axis is not None:
-            med = med.data
-            std = std.data
-        return med, std, mask
-    if axis is not None:
-        med = med.data
-    return med
-
-def average_band_images(snap, beams):
-	for b in beams:
-		log.info("Averaging {0} SAP00{1}...".format(snap, b))
-		subprocess.call("{0} {1}/images/{1}_SAP00{2}_AVG.restored {1}/images/*SAP00{2}_BAND0?*MS.dppp.img.restored.fits > {1}/logs/average_SAP00{2}_restored.log.txt 2>&1".format(tools["average"], snap, b), shell=True)
-		subprocess.call("{0} {1}/images/{1}_SAP00{2}_AVG {1}/images/*SAP00{2}_BAND0?*MS.dppp.img.restored.corr.fits > {1}/logs/average_SAP00{2}_restored.corr.log.txt 2>&1".format(tools["average"], snap, b), shell=True)
+	return image_std(infile)
+
+def average_beam_images(snap, b):
+	"""
+	Produces the inverse variance weighted averages of the restored and primary beam corrected band images of one beam.
+	"""
+	log.info("Averaging {0} SAP00{1}...".format(snap, b))
+	for out, pattern in [("_AVG.restored", "restored"), ("_AVG", "restored.corr")]:
+		images=sorted(glob.glob("{0}/images/*SAP00{1}_BAND0?*MS.dppp.img.{2}.fits".format(snap, b, pattern)))
+		w=average_images("{0}/images/{0}_SAP00{1}{2}".format(snap, b, out), images, verbose=False)
+		if w is None:
+			log.warning("{0} SAP00{1} {2} images not averaged ({3} found)".format(snap, b, pattern, len(images)))
+		else:
+			log.info("{0} SAP00{1} {2} weights: {3}".format(snap, b, pattern, w))
 	
-def create_mosaic(snap, band_nums, chosen_environ, pad, avgpbr, ncp):
+def create_mosaic(snap, band_nums, chosen_environ, pad, avgpbr, ncp, jobs=1):
 	for b in band_nums:
 		tocorrect=sorted(glob.glob(os.path.join(snap, "images","*SAP00?_BAND0{0}*.img_mosaic0.avgpb".format(b))))
 		for w in tocorrect:
@@ -922,7 +1118,7 @@ def create_mosaic(snap, band_nums, chosen_environ, pad, avgpbr, ncp):
 				avgpb.putkeyword('coords', coordstablecopy)
 				avgpb.close()
 			log.info("Zeroing corners of avgpb {0}...".format(wname))
-			subprocess.call("{0} -r {1} {2} > {3}/logs/avgpbz_{4}_log.txt 2>&1".format(tools["mosaicavgpb"], avgpbr, w, snap, wname), shell=True)
+			zero_avgpb(w, radius=avgpbr)
 		tomosaic=sorted(glob.glob(os.path.join(snap, "*SAP00?_BAND0{0}*.MS.dppp".format(b))))
 		if not os.path.isdir(os.path.join(snap, "images", "mosaics")):
 			os.mkdir(os.path.join(snap, "images", "mosaics"))
@@ -931,15 +1127,839 @@ def create_mosaic(snap, band_nums, chosen_environ, pad, avgpbr, ncp):
 		m_name=os.path.join(snap, "images", "mosaics", "{0}_BAND0{1}_mosaic.fits".format(snap, b))
 		m_sens_name=os.path.join(snap, "images", "mosaics", "{0}_BAND0{1}_mosaic_sens.fits".format(snap, b))
 		if ncp:
-			subprocess.call("python {0} -o {1} -N -a avgpbz -s {2} {3} > {4}/logs/mosaic_band0{5}_log.txt 2>&1".format(tools["mosaic"], m_name, m_sens_name, ",".join(m_list), snap, b), shell=True)
+			#the 20 degree NCP mosaics are built out-of-core
+			run_command(["python", tools["mosaic"], "-o", m_name, "-N", "-a", "avgpbz", "-s", m_sens_name, "-j", str(jobs), "-t", os.path.join(snap, "images", "mosaics"), ",".join(m_list)], logfile="{0}/logs/mosaic_band0{1}_log.txt".format(snap, b))
 		else:
-			subprocess.call("python {0} -o {1} -a avgpbz -s {2} {3} > {4}/logs/mosaic_band0{5}_log.txt 2>&1".format(tools["mosaic"], m_name, m_sens_name, ",".join(m_list), snap, b), shell=True)
+			run_command(["python", tools["mosaic"], "-o", m_name, "-a", "avgpbz", "-s", m_sens_name, "-j", str(jobs), ",".join(m_list)], logfile="{0}/logs/mosaic_band0{1}_log.txt".format(snap, b))
 		correctedfits=m_list[0].replace("_mosaic", "")+".restored.corr.fits"
 		bw, endt, ant, ncore, nremote, nintl, subbandwidth, subbands=copyfitsinfo(correctedfits)
 		correctfits(m_name, bw, endt, ant, ncore, nremote, nintl, subbandwidth, subbands)
 
 correct_lofarroot={'/opt/share/lofar-archive/2013-06-20-19-15/LOFAR_r23543_10c8b37':'rsm-mainline', '/opt/share/lofar/2013-09-30-16-27/LOFAR_r26772_1374418':'lofar-sept2013', '/opt/share/lofar/2014-01-22-15-21/LOFAR_r28003_357357b':'lofar-jan2014'}
 
+#----------------------------------------------------------------------------------------------------------------------------------------------
+#																MS Catalog
+#----------------------------------------------------------------------------------------------------------------------------------------------
+
+#SQLite file the metadata of the measurement sets is kept in, set by rsmpp before the worker pool is created
+catalog_file=None
+
+catalog_columns=["ms", "stamp", "corrupt", "nrows", "ref_freq", "nchan", "bandwidth", "time_start", "time_end", "obs_start", "obs_end",
+"antenna_set", "target", "clock", "ncore", "nremote", "nintl"]
+
+def ms_stamp(ms):
+	"""
+	Returns a stamp of the files of a measurement set which changes whenever any of them is rewritten.
+	"""
+	stamp=[]
+	for f in sorted(os.listdir(ms)):
+		st=os.stat(os.path.join(ms, f))
+		stamp.append("{0}:{1}:{2}".format(f, st.st_size, st.st_mtime))
+	return hashlib.sha1(",".join(stamp)).hexdigest()
+
+def sample_rows(t, columns=["DATA", "FLAG"]):
+	"""
+	Checks that an open main table has rows and that the given columns can be read at its start, middle and end.
+	"""
+	nrows=t.nrows()
+	if nrows==0:
+		return False
+	for col in columns:
+		if col not in t.colnames():
+			return False
+	for row in sorted(set([0, nrows/2, nrows-1])):
+		for col in columns:
+			t.getcell(col, row)
+	return True
+
+def scan_ms(ms):
+	"""
+	Validates a measurement set and reads the metadata needed by the pipeline: the frequency, channels, time range, LOFAR \
+	observation details and the number of core, remote and international stations. A set is marked as corrupt if its tables \
+	cannot be opened, it has no rows or the sampled DATA and FLAG rows cannot be read.
+	"""
+	info=dict([(c, None) for c in catalog_columns])
+	info["ms"]=os.path.realpath(ms)
+	info["corrupt"]=1
+	try:
+		info["stamp"]=ms_stamp(ms)
+		t=pt.table(ms, ack=False)
+		info["nrows"]=t.nrows()
+		ok=sample_rows(t)
+		t.close()
+	except:
+		return info
+	if not ok:
+		return info
+	try:
+		t=pt.table(ms+"/SPECTRAL_WINDOW", ack=False)
+		info["ref_freq"]=float(t.getcell("REF_FREQUENCY", 0))
+		info["nchan"]=int(t.getcell("NUM_CHAN", 0))
+		info["bandwidth"]=float(t.getcell("TOTAL_BANDWIDTH", 0))
+		t.close()
+		t=pt.table(ms+"/OBSERVATION", ack=False)
+		time_range=t.getcell("TIME_RANGE", 0)
+		info["time_start"]=float(time_range[0])
+		info["time_end"]=float(time_range[1])
+		cols=t.colnames()
+		if "LOFAR_OBSERVATION_START" in cols:
+			info["obs_start"]=float(t.getcell("LOFAR_OBSERVATION_START", 0))
+			info["obs_end"]=float(t.getcell("LOFAR_OBSERVATION_END", 0))
+			info["antenna_set"]=str(t.getcell("LOFAR_ANTENNA_SET", 0))
+			info["target"]=str(t.getcell("LOFAR_TARGET", 0)[0])
+		if "LOFAR_CLOCK_FREQUENCY" in cols:
+			info["clock"]=float(t.getcell("LOFAR_CLOCK_FREQUENCY", 0))
+		t.close()
+		t=pt.table(ms+"/ANTENNA", ack=False)
+		names=t.getcol("NAME")
+		t.close()
+	except:
+		return info
+	info["corrupt"]=0
+	info["ncore"]=len([n for n in names if n.startswith("CS")])
+	info["nremote"]=len([n for n in names if n.startswith("RS")])
+	info["nintl"]=len(names)-info["ncore"]-info["nremote"]
+	return info
+
+def catalog_connect():
+	conn=sqlite3.connect(catalog_file, timeout=120)
+	conn.text_factory=str
+	conn.execute("CREATE TABLE IF NOT EXISTS ms ({0}, PRIMARY KEY (ms))".format(", ".join(catalog_columns)))
+	return conn
+
+def ms_metadata(ms):
+	"""
+	Returns the metadata of a measurement set (see scan_ms) as a dictionary. It comes from the catalog when the catalog has an \\
+	entry made since the set was last written, otherwise the set is scanned and the catalog updated.
+	"""
+	if catalog_file==None:
+		return scan_ms(ms)
+	path=os.path.realpath(ms)
+	try:
+		stamp=ms_stamp(ms)
+	except OSError:
+		stamp=None
+	conn=catalog_connect()
+	row=conn.execute("SELECT {0} FROM ms WHERE ms=?".format(", ".join(catalog_columns)), (path,)).fetchone()
+	if row!=None and row[1]==stamp and stamp!=None:
+		conn.close()
+		return dict(zip(catalog_columns, row))
+	info=scan_ms(ms)
+	conn.execute("INSERT OR REPLACE INTO ms VALUES ({0})".format(", ".join(["?"]*len(catalog_columns))), [info[c] for c in catalog_columns])
+	conn.commit()
+	conn.close()
+	return info
+
+def scan_catalog(pool, mslist):
+	"""
+	Brings the catalog entries of a list of measurement sets up to date, scanning them in parallel on the pool.
+	"""
+	log.info("Reading metadata of {0} measurement sets...".format(len(mslist)))
+	return dict(zip(mslist, pool.map(ms_metadata, mslist)))
+
+#----------------------------------------------------------------------------------------------------------------------------------------------
+#																Instrumentation
+#----------------------------------------------------------------------------------------------------------------------------------------------
+
+#File the resource usage of each command is appended to, set by rsmpp before the worker pool is created
+stats_file=None
+#Task the current process is running, set by run_task
+current_task=None
+
+def proc_io(pid):
+	"""
+	Returns the bytes read and written by a process from /proc/<pid>/io, or None if it can no longer be read.
+	"""
+	try:
+		f=open("/proc/{0}/io".format(pid), 'r')
+		io={}
+		for line in f:
+			k, v=line.split(":")
+			io[k]=int(v)
+		f.close()
+	except (IOError, ValueError):
+		return None
+	return (io.get("read_bytes", 0), io.get("write_bytes", 0))
+
+def record_stats(entry):
+	"""
+	Appends a JSON line to the stats file, if one is set.
+	"""
+	if stats_file==None:
+		return
+	f=open(stats_file, 'a')
+	f.write(json.dumps(entry)+"\n")
+	f.close()
+
+class CommandError(Exception):
+	"""
+	Raised by run_command when a checked command fails, so that the task running it is marked as failed.
+	"""
+	pass
+
+#Timeout in seconds (None for no limit) and number of retries for each tool, the timeouts can be changed with the timeouts option of rsmpp
+tool_limits={"NDPPP":{"timeout":7200, "retries":1},
+"calibrate-stand-alone":{"timeout":14400, "retries":1},
+"awimager":{"timeout":21600, "retries":1},
+"aoflagger":{"timeout":7200, "retries":1},
+"image2fits":{"timeout":900, "retries":2},
+"makesourcedb":{"timeout":900, "retries":2},
+"msselect":{"timeout":3600, "retries":1},
+"parmexportcal":{"timeout":900, "retries":2},
+"addImagingInfo":{"timeout":1800, "retries":1},
+}
+#Delay before the first retry in seconds, doubled for each one after
+retry_delay=30.
+
+def command_tool(cmd):
+	"""
+	Returns the name of the tool a command runs, used to look up its limits and in the stats.
+	"""
+	tool=cmd[0]
+	if tool=="python" and len(cmd)>1:
+		tool=cmd[1]
+	return tool.split("/")[-1]
+
+def run_attempt(cmd, env, logfile, timeout):
+	"""
+	Runs a command once, returning the exit status, the rusage, the bytes read and written and whether it timed out.
+	"""
+	if logfile!=None:
+		out=open(logfile, 'a')
+	else:
+		out=None
+	#a command with a timeout gets its own process group so that anything it starts is killed along with it
+	if timeout!=None:
+		p=subprocess.Popen(cmd, env=env, stdout=out, stderr=subprocess.STDOUT if out!=None else None, preexec_fn=os.setsid)
+	else:
+		p=subprocess.Popen(cmd, env=env, stdout=out, stderr=subprocess.STDOUT if out!=None else None)
+	if out!=None:
+		out.close()
+	start=time.time()
+	io=None
+	timedout=False
+	killed=None
+	wait=0.05
+	while True:
+		pid, status, usage=os.wait4(p.pid, os.WNOHANG)
+		if pid!=0:
+			break
+		io=proc_io(p.pid) or io
+		if timeout!=None and time.time()-start > timeout:
+			if killed==None:
+				log.error("{0} has run for over {1} s - stopping it".format(command_tool(cmd), timeout))
+				timedout=True
+				killed=time.time()
+				os.killpg(p.pid, signal.SIGTERM)
+			elif time.time()-killed > 30.:
+				os.killpg(p.pid, signal.SIGKILL)
+		time.sleep(wait)
+		wait=min(wait*2, 1.)
+	p.returncode=os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+	#the block counts of the rusage include the last writes and any reaped children the /proc sample of the command misses
+	if io==None:
+		io=(0, 0)
+	io=(max(io[0], usage.ru_inblock*512), max(io[1], usage.ru_oublock*512))
+	return p.returncode, usage, io, timedout
+
+def run_command(cmd, env=None, logfile=None, timeout=None, retries=None, cleanup=[], check=False):
+	"""
+	Runs an external command, given as an argument list, in place of subprocess.call. Nothing goes through the shell. \
+	Output is appended to logfile, if given. A command running for longer than its timeout is killed and failed attempts are \
+	retried after an increasing delay, with anything matching the cleanup patterns removed first. The timeout and retries default \
+	to the tool_limits of the tool. The wall time, CPU time, peak memory and disk I/O of every attempt are recorded in the stats. \
+	Returns the exit status, or raises CommandError if check is set and the command failed.
+	"""
+	if isinstance(cmd, basestring):
+		raise TypeError("run_command takes an argument list, not the string '{0}'".format(cmd))
+	tool=command_tool(cmd)
+	limits=tool_limits.get(tool, {})
+	if timeout==None:
+		timeout=limits.get("timeout")
+	if retries==None:
+		retries=limits.get("retries", 0)
+	if logfile!=None:
+		open(logfile, 'w').close()
+	attempt=0
+	while True:
+		start=time.time()
+		status, usage, io, timedout=run_attempt(cmd, env, logfile, timeout)
+		record_stats({"task":current_task, "tool":tool, "start":start, "wall":time.time()-start, "user":usage.ru_utime,
+		"sys":usage.ru_stime, "maxrss":usage.ru_maxrss/1024., "read":io[0]/1.e6, "write":io[1]/1.e6, "status":status, "attempt":attempt,
+		"timedout":timedout})
+		if status==0 or attempt>=retries:
+			break
+		delay=retry_delay*2**attempt
+		attempt+=1
+		log.warning("{0} exited with status {1} - retrying in {2:.0f} s (attempt {3} of {4})".format(tool, status, delay, attempt, retries))
+		time.sleep(delay)
+		for pattern in cleanup:
+			for path in glob.glob(pattern):
+				subprocess.call(["rm", "-rf", path])
+	if status!=0 and check:
+		raise CommandError("{0} failed with exit status {1}{2}".format(tool, status, " (timed out)" if timedout else ""))
+	return status
+
+def move_files(patterns, dest, logfile=None):
+	"""
+	Moves the files matching the glob patterns into dest with mv, expanding the patterns here rather than in a shell.
+	"""
+	files=[]
+	for pattern in patterns:
+		files+=sorted(glob.glob(pattern))
+	if len(files)==0:
+		return 0
+	return run_command(["mv"]+files+[dest], logfile=logfile)
+
+def remove_files(patterns):
+	"""
+	Removes the files and directories matching the glob patterns with rm -rf, expanding the patterns here rather than in a shell.
+	"""
+	files=[]
+	for pattern in patterns:
+		files+=sorted(glob.glob(pattern))
+	if len(files)==0:
+		return 0
+	return run_command(["rm", "-rf"]+files)
+
+def run_task(name, func, args):
+	"""
+	Runs a task of the task graph in a worker, recording its wall time so the commands it ran can be tied to it.
+	"""
+	global current_task
+	current_task=name
+	start=time.time()
+	try:
+		return func(*args)
+	finally:
+		record_stats({"task":name, "tool":None, "start":start, "wall":time.time()-start})
+		current_task=None
+
+def write_run_report(stats, report, nshow=10):
+	"""
+	Summarises the stats file into a JSON report of the totals per stage (the kind of task, e.g. ndppp), per tool and per dataset \
+	and logs the slowest stages and datasets.
+	"""
+	if stats==None or not os.path.isfile(stats):
+		return
+	entries=[json.loads(line) for line in open(stats, 'r') if line.strip()!=""]
+	summary={"stages":{}, "tools":{}, "datasets":{}, "tasks":[]}
+	def add(group, key, e):
+		if key not in group:
+			group[key]={"count":0, "wall":0., "user":0., "sys":0., "maxrss":0., "read":0., "write":0.}
+		g=group[key]
+		g["count"]+=1
+		for k in ["wall", "user", "sys", "read", "write"]:
+			g[k]+=e.get(k, 0.)
+		g["maxrss"]=max(g["maxrss"], e.get("maxrss", 0.))
+	for e in entries:
+		if e["tool"]==None:
+			summary["tasks"].append({"task":e["task"], "wall":e["wall"]})
+			add(summary["stages"], e["task"].split(":")[0], e)
+			add(summary["datasets"], e["task"].split(":", 1)[-1], e)
+		else:
+			add(summary["tools"], e["tool"], e)
+			if e["task"]!=None:
+				#the resource use of a task is the sum of its commands
+				for group, key in [(summary["stages"], e["task"].split(":")[0]), (summary["datasets"], e["task"].split(":", 1)[-1])]:
+					add(group, key, dict([(k, e[k]) for k in ["user", "sys", "maxrss", "read", "write"]]))
+					group[key]["count"]-=1
+	summary["tasks"]=sorted(summary["tasks"], key=lambda t: -t["wall"])
+	f=open(report, 'w')
+	json.dump(summary, f, indent=1, sort_keys=True)
+	f.close()
+	for title, group in [("stages", summary["stages"]), ("datasets", summary["datasets"])]:
+		log.info("Slowest {0}:".format(title))
+		log.info("{0:<60} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format("", "Count", "Wall (s)", "CPU (s)", "RSS (MB)", "Read (MB)", "Write (MB)"))
+		for key in sorted(group, key=lambda k: -group[k]["wall"])[:nshow]:
+			g=group[key]
+			log.info("{0:<60} {1:>6} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>10.1f} {6:>10.1f}".format(key[-60:], g["count"], g["wall"], g["user"]+g["sys"],
+			g["maxrss"], g["read"], g["write"]))
+	log.info("Run report written to {0}".format(report))
+
+#----------------------------------------------------------------------------------------------------------------------------------------------
+#																Task Graph
+#----------------------------------------------------------------------------------------------------------------------------------------------
+
+def task_depths(tasks):
+	"""
+	Returns how far down the graph each task sits, used to favour tasks further along a chain so that datasets finish early.
+	"""
+	depths={}
+	def depth(name):
+		if name not in depths:
+			depths[name]=0
+			parents=[d for d in tasks[name].get("deps", [])+tasks[name].get("after", []) if d in tasks]
+			if len(parents)>0:
+				depths[name]=1+max([depth(d) for d in parents])
+		return depths[name]
+	for name in tasks:
+		depth(name)
+	return depths
+
+def read_ledger(ledger):
+	"""
+	Reads the stage ledger written by a previous run, returning a dictionary of task name -> record.
+	"""
+	done={}
+	if os.path.isfile(ledger):
+		for line in open(ledger, 'r'):
+			try:
+				record=json.loads(line)
+			except ValueError:
+				#a partially written line from a crash
+				continue
+			done[record["task"]]=record
+	return done
+
+def record_task(ledger, name, task):
+	"""
+	Appends a completed task, with its inputs and the outputs it produced, to the stage ledger.
+	"""
+	record={"task":name, "inputs":task.get("inputs", []), "outputs":[o for o in task.get("outputs", []) if os.path.exists(o)], 
+	"finished":datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")}
+	f=open(ledger, 'a')
+	f.write(json.dumps(record)+"\n")
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+
+def output_ok(path):
+	"""
+	Checks that an output recorded in the ledger is still present and, for tables, that it can still be opened.
+	"""
+	if not os.path.exists(path):
+		return False
+	if os.path.isfile(os.path.join(path, "table.dat")):
+		try:
+			t=pt.table(path, ack=False)
+			rows=t.nrows()
+			t.close()
+		except:
+			return False
+		return rows > 0
+	return True
+
+def completed_tasks(tasks, ledger):
+	"""
+	Works out which tasks were completed by a previous run and can be skipped. A task recorded in the ledger is still valid if its \
+	outputs are intact or if they have since been used up by tasks which are themselves valid (e.g. a .tmp set removed by the shift). \
+	A valid task is only complete if everything it depends on is also complete, so anything downstream of redone work is redone too.
+	"""
+	done=read_ledger(ledger)
+	children={}
+	for name in tasks:
+		for d in tasks[name].get("deps", [])+tasks[name].get("after", []):
+			if d in tasks:
+				children.setdefault(d, []).append(name)
+	valid={}
+	def is_valid(name):
+		if name not in valid:
+			valid[name]=False
+			if name in done and done[name]["inputs"]==tasks[name].get("inputs", []):
+				outputs=done[name]["outputs"]
+				kids=children.get(name, [])
+				if len(outputs)>0 and len([o for o in outputs if not output_ok(o)])==0:
+					valid[name]=True
+				elif len(kids)>0:
+					valid[name]=len([k for k in kids if not is_valid(k)])==0
+				else:
+					valid[name]=len(outputs)==0
+		return valid[name]
+	complete={}
+	def is_complete(name):
+		if name not in complete:
+			parents=[d for d in tasks[name].get("deps", [])+tasks[name].get("after", []) if d in tasks]
+			complete[name]=is_valid(name) and len([d for d in parents if not is_complete(d)])==0
+		return complete[name]
+	return [name for name in tasks if is_complete(name)]
+
+def free_memory():
+	"""
+	Returns the memory available to new processes in MB as reported by the kernel.
+	"""
+	info={}
+	f=open("/proc/meminfo", 'r')
+	for line in f:
+		parts=line.split()
+		info[parts[0].rstrip(":")]=int(parts[1])
+	f.close()
+	if "MemAvailable" in info:
+		return info["MemAvailable"]/1024.
+	return (info["MemFree"]+info.get("Buffers", 0)+info.get("Cached", 0))/1024.
+
+def disk_device(path):
+	"""
+	Returns the (major, minor) device numbers of the disk holding path.
+	"""
+	st=os.stat(path)
+	return (os.major(st.st_dev), os.minor(st.st_dev))
+
+def disk_sectors(device):
+	"""
+	Returns the total number of sectors read and written on a (major, minor) device from /proc/diskstats, or None if it is not listed.
+	"""
+	f=open("/proc/diskstats", 'r')
+	for line in f:
+		parts=line.split()
+		if (int(parts[0]), int(parts[1]))==device:
+			f.close()
+			return int(parts[5])+int(parts[9])
+	f.close()
+	return None
+
+def task_fits(cost, inuse, nworkers, memfree, iorate, maxmem, diskbw):
+	"""
+	Decides if a task with the given cost ({'cpu':threads, 'mem':MB, 'io':MB/s}) can start next to the running tasks, whose summed \
+	costs are in inuse. Memory has to be free now and within maxmem, if set. Disk bandwidth is limited to diskbw, if set, but a task \
+	may go over the declared total when the measured throughput iorate shows the disk has room.
+	"""
+	if inuse["cpu"]+cost.get("cpu", 1) > nworkers:
+		return False
+	mem=cost.get("mem", 0)
+	if mem>0:
+		if mem > memfree:
+			return False
+		if maxmem>0 and inuse["mem"]+mem > maxmem:
+			return False
+	io=cost.get("io", 0)
+	if io>0 and diskbw>0 and inuse["io"]+io > diskbw:
+		if iorate==None or iorate+io > diskbw:
+			return False
+	return True
+
+def run_task_graph(pool, tasks, nworkers, on_done=None, ledger=None, poll=0.5, nslots=None, maxmem=0, diskbw=0, iopath=".", settle=30.):
+	"""
+	Runs a dictionary of tasks on the worker pool, starting each one as soon as the tasks it depends on have finished rather than \
+	waiting for a whole stage to complete on every dataset. Each task is a dictionary with 'func' and 'args' and optionally 'deps' \
+	(tasks which must succeed first) and 'after' (tasks which must have finished, successfully or not). Tasks returning False or \
+	raising an exception have failed and anything depending on them is skipped. on_done(name, result) is called in the main process \
+	as each task succeeds and can return False to mark it as failed. If a ledger file is given each completed task is recorded in it, \
+	along with its 'inputs' and 'outputs', and tasks already completed by a previous run are skipped. Returns a dictionary of task \
+	name -> True/False.
+	Tasks are admitted according to their 'cost' (see task_fits), with nworkers the number of CPU threads to fill and nslots the \
+	number of pool processes (nworkers by default). Tasks started in the last settle seconds are assumed not to have allocated \
+	their memory yet. A task is always started when nothing else is running.
+	"""
+	status={}
+	running={}
+	started={}
+	if nslots==None:
+		nslots=nworkers
+	try:
+		device=disk_device(iopath)
+		lastsectors=disk_sectors(device)
+	except (OSError, IOError):
+		device=None
+		lastsectors=None
+	lastsample=time.time()
+	depths=task_depths(tasks)
+	pending=sorted(tasks, key=lambda name: (-depths[name], name))
+	if ledger!=None and os.path.isfile(ledger):
+		for name in completed_tasks(tasks, ledger):
+			status[name]=True
+			pending.remove(name)
+		if len(status)>0:
+			log.info("Resuming: {0} of {1} tasks were completed by a previous run and will be skipped".format(len(status), len(tasks)))
+	while len(pending)>0 or len(running)>0:
+		now=time.time()
+		inuse={"cpu":0., "mem":0., "io":0.}
+		memfree=free_memory()
+		for name in running:
+			cost=tasks[name].get("cost", {})
+			for k in inuse:
+				inuse[k]+=cost.get(k, 1 if k=="cpu" else 0)
+			if now-started[name] < settle:
+				memfree-=cost.get("mem", 0)
+		iorate=None
+		if lastsectors!=None:
+			sectors=disk_sectors(device)
+			if sectors!=None and now > lastsample:
+				iorate=(sectors-lastsectors)*512./1.e6/(now-lastsample)
+			lastsectors=sectors
+			lastsample=now
+		for name in pending[:]:
+			deps=[d for d in tasks[name].get("deps", []) if d in tasks]
+			after=[d for d in tasks[name].get("after", []) if d in tasks]
+			if len([d for d in deps+after if d not in status])>0:
+				continue
+			failed=[d for d in deps if not status[d]]
+			if len(failed)>0:
+				log.warning("Skipping {0} as {1} did not complete".format(name, ", ".join(failed)))
+				status[name]=False
+				pending.remove(name)
+				continue
+			cost=tasks[name].get("cost", {})
+			if len(running) >= nslots:
+				continue
+			if len(running)>0 and not task_fits(cost, inuse, nworkers, memfree, iorate, maxmem, diskbw):
+				continue
+			if ledger!=None:
+				#clear out anything left behind by an interrupted attempt at this task
+				for o in tasks[name].get("outputs", []):
+					if o not in tasks[name].get("inputs", []) and os.path.exists(o):
+						log.warning("Removing incomplete {0}...".format(o))
+						run_command(["rm", "-rf", o])
+			log.debug("Starting task {0}".format(name))
+			running[name]=pool.apply_async(run_task, (name, tasks[name]["func"], tasks[name].get("args", ())))
+			started[name]=now
+			pending.remove(name)
+			for k in inuse:
+				inuse[k]+=cost.get(k, 1 if k=="cpu" else 0)
+			memfree-=cost.get("mem", 0)
+			if iorate!=None:
+				iorate+=cost.get("io", 0)
+		finished=False
+		for name in running.keys():
+			if not running[name].ready():
+				continue
+			result=running.pop(name)
+			finished=True
+			try:
+				value=result.get()
+			except Exception, e:
+				log.error("Task {0} failed: {1}".format(name, e))
+				status[name]=False
+				continue
+			status[name]=(value is not False)
+			if status[name] and on_done!=None:
+				if on_done(name, value)==False:
+					status[name]=False
+			if status[name] and ledger!=None:
+				record_task(ledger, name, tasks[name])
+		if not finished:
+			time.sleep(poll)
+	return status
+
+#----------------------------------------------------------------------------------------------------------------------------------------------
+#																Stage Cache
+#----------------------------------------------------------------------------------------------------------------------------------------------
+
+def file_text(f):
+	"""
+	Returns the contents of a parset or model file for use in a cache key.
+	"""
+	if not os.path.isfile(f):
+		return ""
+	g=open(f, 'r')
+	text=g.read()
+	g.close()
+	return text
+
+def ms_fingerprint(ms):
+	"""
+	Identifies a measurement set directory on disk by the device and inode numbers of it and its files. These survive renames \
+	and in place changes, but not copies. The lock file is left out as it can be recreated whenever the set is opened.
+	"""
+	st=os.stat(ms)
+	h=hashlib.sha1("{0}:{1}".format(st.st_dev, st.st_ino))
+	for f in sorted(os.listdir(ms)):
+		if f=="table.lock":
+			continue
+		h.update("{0}:{1}".format(f, os.lstat(os.path.join(ms, f)).st_ino))
+	return h.hexdigest()
+
+def identity_file(ms, cache):
+	return os.path.join(cache, "identities", ms_fingerprint(ms))
+
+def ms_identity(ms, cache=None):
+	"""
+	Returns the identity of a measurement set used in cache keys. Sets produced by a cached stage are registered in the cache \
+	with the key of that stage, anything else (i.e. the raw data) is identified by its path and the sizes and modification times \
+	of its files.
+	"""
+	if cache not in (None, ""):
+		keyfile=identity_file(ms, cache)
+		if os.path.isfile(keyfile):
+			return file_text(keyfile).strip()
+	h=hashlib.sha1(os.path.realpath(ms))
+	for f in sorted(os.listdir(ms)):
+		path=os.path.join(ms, f)
+		if os.path.isfile(path):
+			st=os.stat(path)
+			h.update("{0}:{1}:{2}".format(f, st.st_size, int(st.st_mtime)))
+	return h.hexdigest()
+
+def set_identity(ms, key, cache):
+	"""
+	Registers the identity of a measurement set in the cache, outside of the set itself.
+	"""
+	keyfile=identity_file(ms, cache)
+	if not os.path.isdir(os.path.dirname(keyfile)):
+		try:
+			os.makedirs(os.path.dirname(keyfile))
+		except OSError:
+			pass
+	tmp="{0}.tmp{1}".format(keyfile, os.getpid())
+	f=open(tmp, 'w')
+	f.write(key+"\n")
+	f.close()
+	os.rename(tmp, keyfile)
+
+def extend_identity(ms, step, cache):
+	"""
+	Folds a step that changes a measurement set in place (e.g. flagging) into its identity, so later stages are not reused from before it.
+	"""
+	if cache in (None, "") or not os.path.isdir(ms):
+		return
+	set_identity(ms, hashlib.sha1(ms_identity(ms, cache)+step).hexdigest(), cache)
+
+def unshare_dataset(ms, cache=None):
+	"""
+	Gives a measurement set its own copy of any files it shares with the stage cache through hard links. This must be done before \
+	the set is changed in place, so the stored result is left untouched. The identity of the set is carried over to the new files.
+	"""
+	if cache in (None, "") or not os.path.isdir(ms):
+		return
+	identity=ms_identity(ms, cache)
+	shared=False
+	for root, dirs, files in os.walk(ms):
+		for f in files:
+			path=os.path.join(root, f)
+			if os.lstat(path).st_nlink > 1:
+				tmp="{0}.unshare{1}".format(path, os.getpid())
+				shutil.copy2(path, tmp)
+				os.rename(tmp, path)
+				shared=True
+	if shared:
+		set_identity(ms, identity, cache)
+
+def tool_identity(names):
+	"""
+	Identifies the installed versions of external tools by the resolved path, size and modification time of each executable, \
+	so that results are not reused across tool upgrades.
+	"""
+	ids=[]
+	for name in names:
+		if name not in tool_ids:
+			path=find_executable(name)
+			if path==None:
+				tool_ids[name]=name+":missing"
+			else:
+				path=os.path.realpath(path)
+				st=os.stat(path)
+				tool_ids[name]="{0}:{1}:{2}:{3}".format(name, path, st.st_size, int(st.st_mtime))
+		ids.append(tool_ids[name])
+	return "\n".join(ids)
+
+def stage_key(inputs, parset_text, extra="", tools=[], cache=None):
+	"""
+	Returns the cache key of a stage from the identities of its input measurement sets, the exact parset text it runs with \
+	and the identities of the tools it runs. msin and msout lines are left out so that the key does not depend on the output \
+	directory name.
+	"""
+	h=hashlib.sha1()
+	for ms in inputs:
+		if os.path.isdir(ms):
+			h.update(ms_identity(ms, cache))
+		else:
+			h.update("missing:"+ms.split("/")[-1])
+	h.update(tool_identity(tools))
+	for line in parset_text.splitlines():
+		if line.replace(" ", "").split("=")[0] in ["msin", "msout"]:
+			continue
+		h.update(line+"\n")
+	h.update(extra)
+	return h.hexdigest()
+
+def link_copy(src, dest):
+	"""
+	Copies a file or directory as hard links, falling back to a full copy if the two are on different file systems.
+	"""
+	if run_command(["cp", "-al", src, dest], logfile=os.devnull)!=0:
+		run_command(["rm", "-rf", dest])
+		run_command(["cp", "-r", src, dest])
+
+def cache_fetch(cache, key, outputs):
+	"""
+	Hard links the outputs of a stage stored under key into place, returning True if a stored result was found.
+	"""
+	if cache in (None, ""):
+		return False
+	stored=os.path.join(cache, key)
+	if not os.path.isdir(stored):
+		return False
+	for o in outputs:
+		if not os.path.exists(os.path.join(stored, o.split("/")[-1])):
+			return False
+	for o in outputs:
+		if os.path.exists(o):
+			run_command(["rm", "-rf", o])
+		link_copy(os.path.join(stored, o.split("/")[-1]), o)
+	log.info("Reusing cached result for {0}".format(", ".join([o.split("/")[-1] for o in outputs])))
+	return True
+
+def cache_result(cache, key, outputs):
+	"""
+	Registers the outputs of a stage with its key and stores them in the cache as hard links, so no data is copied. Steps changing \
+	the outputs in place later call unshare_dataset first. The links are made in a temporary directory and then renamed so a half \
+	written result is never picked up.
+	"""
+	if cache in (None, ""):
+		return
+	outputs=[o for o in outputs if os.path.exists(o)]
+	for o in outputs:
+		if os.path.isdir(o):
+			set_identity(o, key, cache)
+	stored=os.path.join(cache, key)
+	if os.path.isdir(stored) or len(outputs)==0:
+		return
+	tmp="{0}.tmp{1}".format(stored, os.getpid())
+	os.makedirs(tmp)
+	for o in outputs:
+		link_copy(o, os.path.join(tmp, o.split("/")[-1]))
+	try:
+		os.rename(tmp, stored)
+	except OSError:
+		#another process stored the same result first
+		run_command(["rm", "-rf", tmp])
+
+#----------------------------------------------------------------------------------------------------------------------------------------------
+#																Sky Model Cache
+#----------------------------------------------------------------------------------------------------------------------------------------------
+
+def skymodel_cache(cache):
+	"""
+	Returns the directory of the stage cache holding the sourcedbs and parsed sky models, or None if there is no cache.
+	"""
+	if cache in (None, ""):
+		return None
+	return os.path.join(cache, "skymodels")
+
+def build_sourcedb(model, out, fmt="<", cache=None, logfile=os.devnull, check=False):
+	"""
+	Makes the sourcedb out from a text sky model with makesourcedb. With a cache the sourcedb is built once per model content \
+	and format under cache/skymodels, and out is made a link to it.
+	"""
+	if os.path.lexists(out):
+		run_command(["rm", "-rf", out])
+	store=skymodel_cache(cache)
+	if store is None:
+		return run_command(["makesourcedb", "in="+model, "out="+out, "format="+fmt], logfile=logfile, cleanup=[out], check=check)
+	h=hashlib.sha1()
+	h.update(file_text(model))
+	h.update("\0"+fmt)
+	stored=os.path.join(store, h.hexdigest()+".sourcedb")
+	if not os.path.isdir(stored):
+		if not os.path.isdir(store):
+			try:
+				os.makedirs(store)
+			except OSError:
+				pass
+		tmp="{0}.tmp{1}".format(stored, os.getpid())
+		if not run_command(["makesourcedb", "in="+model, "out="+tmp, "format="+fmt], logfile=logfile, cleanup=[tmp], check=check)==0:
+			run_command(["rm", "-rf", tmp])
+			return 1
+		try:
+			os.rename(tmp, stored)
+		except OSError:
+			#another process stored the same sourcedb first
+			run_command(["rm", "-rf", tmp])
+	else:
+		log.info("Reusing cached sourcedb for {0}".format(model))
+	os.symlink(stored, out)
+	return 0
+
 #----------------------------------------------------------------------------------------------------------------------------------------------
 #																HBA Funcs
 #----------------------------------------------------------------------------------------------------------------------------------------------
@@ -974,12 +1994,8 @@ def hba_check_targets(i, beam, targets, targets_corrupt, rsm_bands, rsm_band_num
 		log.debug("Ideal {0} Band {1}: {2}".format(i, bnd, ideal_bands[thiskey]))
 	for t in targets[i][beamselect]:
 		target_msname=t.split("/")[-1]
-		try:
-			test=pt.table(t, ack=False)
-			test.close()
-		except:
+		if ms_metadata(t)["corrupt"]:
 			log.warning("Target {0} is corrupt!".format(target_msname))
-			time.sleep(1)
 			targets_corrupt[i].append(t)
 			toremove.append(t)
 			missingfile.write("Measurement set {0} corrupted from observation {1}\n".format(target_msname, i))
@@ -1008,14 +2024,11 @@ def hba_check_targets(i, beam, targets, targets_corrupt, rsm_bands, rsm_band_num
 		rsm_bands_lens[k]=len(rsm_bands[k])
 	return localmiss
 
-def hba_calibrate_msss1(Calib, beams, diff, calparset, calmodel, correctparset, dummy, oddeven, firstid, mode):
+def hba_transfer_targets(Calib, beams, diff, oddeven, firstid):
 	"""
-	Function that performs the full calibrator calibration and transfer of solutions for HBA and LBA. Performs \
-	the calibration and then shifts the corrected data over to a new data column.
+	Returns the target sub bands, one per beam, that the solutions of the calibrator sub band Calib are transferred to.
 	"""
-	calibsplit=Calib.split('/')
-	curr_obs=calibsplit[0]
-	calib_name=calibsplit[-1]
+	curr_obs=Calib.split('/')[0]
 	obs_number=int(curr_obs.replace("L",""))
 	if oddeven=="even":
 		if firstid=="even":
@@ -1029,40 +2042,77 @@ def hba_calibrate_msss1(Calib, beams, diff, calparset, calmodel, correctparset,
 			tar_number=obs_number-1
 	tar_obs="L"+str(tar_number)
 	curr_SB=int(Calib.split("_")[2][-3:])
-	log.info("Calibrating calibrator {0}...".format(calib_name))
-	subprocess.call("calibrate-stand-alone --replace-parmdb --sourcedb sky.calibrator {0} {1} {2} > {3}/logs/calibrate_cal_{4}.txt 2>&1".format(Calib,calparset,calmodel, curr_obs, calib_name), shell=True)
-	log.info("Zapping suspect points for {0}...".format(calib_name))
-	subprocess.call("{0} --sigma=1 --auto {1}/instrument/ > {2}/logs/edit_parmdb_{3}.txt 2>&1".format(tools["editparmdb"], Calib, curr_obs, calib_name), shell=True)
-	log.info("Making diagnostic plots for {0}...".format(calib_name))
-	subprocess.call("{0} -q -m -o {3}/{1} {2}/instrument/ > {3}/logs/solplot.log 2>&1".format(tools["solplot"], calib_name, Calib, curr_obs),shell=True)
-	log.info("Obtaining Median Solutions for {0}...".format(calib_name))
-	subprocess.call("parmexportcal in={0}/instrument/ out={0}.parmdb > {1}/logs/parmexportcal_{2}_log.txt 2>&1".format(Calib, curr_obs, calib_name), shell=True)
+	targets=[]
 	for beam in beams:
 		if beam==0:
 			target=Calib.replace(curr_obs,tar_obs)
 		else:
 			target_subband=curr_SB+(diff*beam)
 			target=Calib.replace("SB{0}".format('%03d' % curr_SB), "SB{0}".format('%03d' % target_subband)).replace("SAP000", "SAP00{0}".format(beam)).replace(curr_obs, tar_obs)
+		targets.append(target)
+	return targets
+
+def hba_calibrate_msss1(Calib, beams, diff, calparset, calmodel, correctparset, dummy, oddeven, firstid, mode, shift=True, cache=None):
+	"""
+	Function that performs the full calibrator calibration and transfer of solutions for HBA and LBA. Performs \
+	the calibration and then shifts the corrected data over to a new data column, unless shift is False in which \
+	case the shift is left to the band combination.
+	"""
+	calibsplit=Calib.split('/')
+	curr_obs=calibsplit[0]
+	calib_name=calibsplit[-1]
+	calkey=stage_key([Calib], file_text(calparset)+file_text(calmodel), tools=["calibrate-stand-alone", "bbs-reducer", "parmexportcal"], cache=cache)
+	if not cache_fetch(cache, calkey, [Calib+"/instrument", Calib+".parmdb"]):
+		log.info("Calibrating calibrator {0}...".format(calib_name))
+		unshare_dataset(Calib, cache)
+		run_command(["calibrate-stand-alone", "--replace-parmdb", "--sourcedb", "sky.calibrator", Calib, calparset, calmodel], logfile="{0}/logs/calibrate_cal_{1}.txt".format(curr_obs, calib_name), check=True)
+		log.info("Zapping suspect points for {0}...".format(calib_name))
+		run_command([tools["editparmdb"], "--sigma=1", "--auto", Calib+"/instrument/"], logfile="{0}/logs/edit_parmdb_{1}.txt".format(curr_obs, calib_name))
+		log.info("Obtaining Median Solutions for {0}...".format(calib_name))
+		run_command(["parmexportcal", "in={0}/instrument/".format(Calib), "out={0}.parmdb".format(Calib)], logfile="{0}/logs/parmexportcal_{1}_log.txt".format(curr_obs, calib_name),
+		cleanup=[Calib+".parmdb"], check=True)
+		cache_result(cache, calkey, [Calib+"/instrument", Calib+".parmdb"])
+	log.info("Making diagnostic plots for {0}...".format(calib_name))
+	run_command([tools["solplot"], "-q", "-m", "-o", "{0}/{1}".format(curr_obs, calib_name), Calib+"/instrument/"], logfile="{0}/logs/solplot.log".format(curr_obs))
+	for target in hba_transfer_targets(Calib, beams, diff, oddeven, firstid):
+		tar_obs=target.split('/')[0]
 		target_name=target.split('/')[-1]
+		if not os.path.isdir(target):
+			log.warning("{0} is not present - solutions will not be transferred".format(target_name))
+			continue
+		if shift:
+			shifted=target.replace(".dppp.tmp", ".dppp")
+		else:
+			shifted=target
+		key=stage_key([target], file_text(correctparset)+file_text(dummy), calkey+"shift={0}".format(shift), tools=["calibrate-stand-alone", "bbs-reducer", "NDPPP"], cache=cache)
+		if cache_fetch(cache, key, [shifted]):
+			if shift:
+				run_command(["rm", "-r", target])
+			continue
 		log.info("Transferring calibrator solutions to {0}...".format(target_name))
-		subprocess.call("calibrate-stand-alone --sourcedb sky.dummy --parmdb {0}.parmdb {1} {2} {3} > {4}/logs/calibrate_transfer_{5}.txt 2>&1".format(Calib, target, correctparset, dummy, curr_obs, target_name), shell=True)
-		shiftndppp(target, tar_obs, target_name)
+		unshare_dataset(target, cache)
+		if run_command(["calibrate-stand-alone", "--sourcedb", "sky.dummy", "--parmdb", Calib+".parmdb", target, correctparset, dummy], logfile="{0}/logs/calibrate_transfer_{1}.txt".format(curr_obs, target_name))!=0:
+			log.error("Transfer of solutions to {0} failed".format(target_name))
+			continue
+		if shift:
+			shiftndppp(target, tar_obs, target_name)
+		cache_result(cache, key, [shifted])
 		
 def hba_final_concat(band, beam, target_obs):
 	"""
 	Simply uses concat.py to concat all the BANDX together into a final set.
 	"""
 	log.info("Concatenating BEAM {0} BAND{1:02d}".format(beam, band))
-	concat_commd="{0} final_datasets/SAP00{1}_BAND{2:02d}_FINAL.MS.dppp".format(tools["concat"],beam,band)
+	concat_commd=[tools["concat"], "final_datasets/SAP00{0}_BAND{1:02d}_FINAL.MS.dppp".format(beam,band)]
 	toconcat=sorted(glob.glob("L*/*SAP00{0}*BAND{1:02d}*.dppp".format(beam, band)))
 	for ms in toconcat:
 		# temp=pt.table("{0}/SPECTRAL_WINDOW".format(ms), ack=False)
 		# nchans=int(temp.col("NUM_CHAN")[0])
 		# if nchans == correct:
-		concat_commd+=" {0}".format(ms)
+		concat_commd.append(ms)
 		# else:
 			# log.error("MS {0} has less than {1} channels - skipping in concat...".format(ms, correct))
-	subprocess.call(concat_commd+" > logs/concat_SAP00{0}_BAND{1:02d}.log 2>&1".format(beam, band), shell=True)
+	run_command(concat_commd, logfile="logs/concat_SAP00{0}_BAND{1:02d}.log".format(beam, band), check=True)
 	
 #----------------------------------------------------------------------------------------------------------------------------------------------
 #																LBA Funcs
@@ -1095,12 +2145,8 @@ def lba_check_targets(i, beam, targets, targets_corrupt, rsm_bands, rsm_band_num
 		log.debug("Ideal {0} Band {1}: {2}".format(i, bnd, ideal_bands[thiskey]))
 	for t in targets[i][beamselect]:
 		target_msname=t.split("/")[-1]
-		try:
-			test=pt.table(t, ack=False)
-			test.close()
-		except:
+		if ms_metadata(t)["corrupt"]:
 			log.warning("Target {0} is corrupt!".format(target_msname))
-			time.sleep(1)
 			targets_corrupt[i].append(t)
 			toremove.append(t)
 			missingfile.write("Measurement set {0} corrupted from observation {1}\n".format(target_msname, i))
@@ -1134,29 +2180,59 @@ def lba_check_targets(i, beam, targets, targets_corrupt, rsm_bands, rsm_band_num
 		rsm_bands_lens[k]=len(rsm_bands[k])
 	return localmiss
 
-def lba_calibrate_msss1(Calib, beams, diff, calparset, calmodel, correctparset, dummy, calibbeam, mode):
+def lba_transfer_targets(Calib, beams, diff, calibbeam):
 	"""
-	Function that performs the full calibrator calibration and transfer of solutions for HBA and LBA. Performs \
-	the calibration and then shifts the corrected data over to a new data column.
+	Returns the target sub bands, one per beam, that the solutions of the calibrator sub band Calib are transferred to.
 	"""
-	calibsplit=Calib.split('/')
-	curr_obs=calibsplit[0]
-	calib_name=calibsplit[-1]
 	curr_SB=int(Calib.split("SB")[1][:3])
-	log.info("Calibrating calibrator {0}...".format(calib_name))
-	subprocess.call("calibrate-stand-alone --replace-parmdb --sourcedb sky.calibrator {0} {1} {2} > {3}/logs/calibrate_cal_{4}.txt 2>&1".format(Calib,calparset,calmodel, curr_obs, calib_name), shell=True)
-	log.info("Zapping suspect points for {0}...".format(calib_name))
-	subprocess.call("{0} --sigma=1 --auto {1}/instrument/ > {2}/logs/edit_parmdb_{3}.txt 2>&1".format(tools["editparmdb"], Calib, curr_obs, calib_name), shell=True)
-	log.info("Making diagnostic plots for {0}...".format(calib_name))
-	subprocess.call("{0} -q -m -o {3}/{1} {2}/instrument/ > {3}/logs/solplot.log 2>&1".format(tools["solplot"], calib_name, Calib, curr_obs),shell=True)
+	targets=[]
 	for beam in beams:
 		if beam<calibbeam:
 			target_subband=curr_SB-(diff*(calibbeam-beam))
-			target=Calib.replace("SB{0}".format('%03d' % curr_SB), "SB{0}".format('%03d' % target_subband)).replace("SAP00{0}".format(calibbeam), "SAP00{0}".format(beam))
 		else:
 			target_subband=curr_SB+(diff*beam)
-			target=Calib.replace("SB{0}".format('%03d' % curr_SB), "SB{0}".format('%03d' % target_subband)).replace("SAP00{0}".format(calibbeam), "SAP00{0}".format(beam))
+		target=Calib.replace("SB{0}".format('%03d' % curr_SB), "SB{0}".format('%03d' % target_subband)).replace("SAP00{0}".format(calibbeam), "SAP00{0}".format(beam))
+		targets.append(target)
+	return targets
+
+def lba_calibrate_msss1(Calib, beams, diff, calparset, calmodel, correctparset, dummy, calibbeam, mode, shift=True, cache=None):
+	"""
+	Function that performs the full calibrator calibration and transfer of solutions for HBA and LBA. Performs \
+	the calibration and then shifts the corrected data over to a new data column, unless shift is False in which \
+	case the shift is left to the band combination.
+	"""
+	calibsplit=Calib.split('/')
+	curr_obs=calibsplit[0]
+	calib_name=calibsplit[-1]
+	calkey=stage_key([Calib], file_text(calparset)+file_text(calmodel), tools=["calibrate-stand-alone", "bbs-reducer", "parmexportcal"], cache=cache)
+	if not cache_fetch(cache, calkey, [Calib+"/instrument"]):
+		log.info("Calibrating calibrator {0}...".format(calib_name))
+		unshare_dataset(Calib, cache)
+		run_command(["calibrate-stand-alone", "--replace-parmdb", "--sourcedb", "sky.calibrator", Calib, calparset, calmodel], logfile="{0}/logs/calibrate_cal_{1}.txt".format(curr_obs, calib_name), check=True)
+		log.info("Zapping suspect points for {0}...".format(calib_name))
+		run_command([tools["editparmdb"], "--sigma=1", "--auto", Calib+"/instrument/"], logfile="{0}/logs/edit_parmdb_{1}.txt".format(curr_obs, calib_name))
+		cache_result(cache, calkey, [Calib+"/instrument"])
+	log.info("Making diagnostic plots for {0}...".format(calib_name))
+	run_command([tools["solplot"], "-q", "-m", "-o", "{0}/{1}".format(curr_obs, calib_name), Calib+"/instrument/"], logfile="{0}/logs/solplot.log".format(curr_obs))
+	for target in lba_transfer_targets(Calib, beams, diff, calibbeam):
 		target_name=target.split('/')[-1]
+		if not os.path.isdir(target):
+			log.warning("{0} is not present - solutions will not be transferred".format(target_name))
+			continue
+		if shift:
+			shifted=target.replace(".dppp.tmp", ".dppp")
+		else:
+			shifted=target
+		key=stage_key([target], file_text(correctparset)+file_text(dummy), calkey+"shift={0}".format(shift), tools=["calibrate-stand-alone", "bbs-reducer", "NDPPP"], cache=cache)
+		if cache_fetch(cache, key, [shifted]):
+			if shift:
+				run_command(["rm", "-r", target])
+			continue
 		log.info("Transferring calibrator solutions to {0}...".format(target_name))
-		subprocess.call("calibrate-stand-alone --sourcedb sky.dummy --parmdb {0}/instrument {1} {2} {3} > logs/calibrate_transfer_{4}.txt 2>&1".format(Calib, target, correctparset, dummy, target_name), shell=True)
-		shiftndppp(target, curr_obs, target_name)
\ No newline at end of file
+		unshare_dataset(target, cache)
+		if run_command(["calibrate-stand-alone", "--sourcedb", "sky.dummy", "--parmdb", Calib+"/instrument", target, correctparset, dummy], logfile="logs/calibrate_transfer_{0}.txt".format(target_name))!=0:
+			log.error("Transfer of solutions to {0} failed".format(target_name))
+			continue
+		if shift:
+			shiftndppp(target, curr_obs, target_name)
+		cache_result(cache, key, [shifted])
\ No newline at end of file
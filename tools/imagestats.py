@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Robust image statistics shared by rsmpp, lofar-imager and the averaging tool.
+# The clipping works on a plain float32 copy of the finite pixels, which shrinks as pixels are clipped,
+# with medians found by partitioning rather than sorting or masked arrays.
+
+import pyfits
+import numpy as np
+
+def fast_median(vals):
+	"""
+	Median of a 1D array using a partial sort. The array is partitioned in place.
+	"""
+	n=len(vals)
+	if n==0:
+		return np.nan
+	k=n/2
+	if n%2:
+		vals.partition(k)
+		return float(vals[k])
+	vals.partition([k-1, k])
+	return (float(vals[k-1])+float(vals[k]))/2.
+
+def sigma_clip(arr, sigma=3, max_iter=3, ftol=0.01, xtol=0.05, sample=None, seed=0):
+	"""
+	Iteratively clips the pixels deviating more than sigma standard deviations from the median, as Median_clip does. \
+	Returns the median, the standard deviation and a boolean array of the pixels that were kept. If sample is given and \
+	there are more finite pixels than this, the statistics are found from a random subsample of that many pixels.
+	"""
+	arr=np.asarray(arr)
+	finite=np.isfinite(arr)
+	vals=np.array(arr[finite], dtype=np.float32)
+	if sample is not None and len(vals) > sample:
+		vals=vals[np.random.RandomState(seed).randint(0, len(vals), int(sample))]
+	med=fast_median(vals)
+	std=vals.std(dtype=np.float64)
+	ncount=len(vals)
+	#pixels once clipped stay clipped, so the pixels kept are those inside every interval used
+	lo, hi=-np.inf, np.inf
+	for niter in xrange(max_iter):
+		ncount_old=len(vals)
+		lo=max(lo, med-std*sigma)
+		hi=min(hi, med+std*sigma)
+		vals=vals[(vals >= lo) & (vals <= hi)]
+		ncount_new=len(vals)
+		med=fast_median(vals)
+		std=vals.std(dtype=np.float64)
+		if ncount-ncount_new > xtol*ncount:
+			break
+		if ncount_old-ncount_new < ftol*ncount_old or ncount_old==ncount_new:
+			break
+	mask=finite & (arr >= lo) & (arr <= hi)
+	return med, std, mask
+
+def Median_clip(arr, sigma=3, max_iter=3, ftol=0.01, xtol=0.05, full_output=False, axis=None):
+	"""
+	Drop in replacement for the Median_clip previously copied into each script, using sigma_clip. Only axis=None is supported.
+	"""
+	if axis is not None:
+		raise ValueError("Median_clip only supports axis=None")
+	med, std, mask=sigma_clip(arr, sigma=sigma, max_iter=max_iter, ftol=ftol, xtol=xtol)
+	if full_output:
+		return med, std, mask
+	return med
+
+def plane_region(data, header, border=None):
+	"""
+	Takes the first image plane of the unscaled fits data, or only its inner part if border is given, dropping 1/border \
+	of the image at each edge, and returns it as float32 with BSCALE and BZERO applied to the region alone.
+	"""
+	plane=data[(0,)*(data.ndim-2)]
+	if border is not None:
+		X,Y=plane.shape
+		plane=plane[Y/border:(border-1)*Y/border,X/border:(border-1)*X/border]
+	return scale_data(plane, header)
+
+def scale_data(data, header):
+	"""
+	Copies a block of unscaled fits data to float32 and applies BSCALE and BZERO.
+	"""
+	block=np.array(data, dtype=np.float32)
+	bscale=header.get('bscale', 1.)
+	bzero=header.get('bzero', 0.)
+	if bscale!=1.:
+		block*=bscale
+	if bzero!=0.:
+		block+=bzero
+	return block
+
+def image_region(infile, border=None):
+	"""
+	Reads the first image plane of a fits image, or only its inner part, with plane_region. The file is memory mapped so \
+	only the pixels needed are read. Returns the region and the header.
+	"""
+	fln=pyfits.open(infile, memmap=True, do_not_scale_image_data=True)
+	header=fln[0].header.copy()
+	region=plane_region(fln[0].data, header, border)
+	fln.close()
+	return region, header
+
+def image_std(infile, border=6, sigma=3, max_iter=10, sample=None):
+	"""
+	Estimates the noise of a fits image from the clipped standard deviation of its inner region.
+	"""
+	region, header=image_region(infile, border)
+	med, std, mask=sigma_clip(region, sigma=sigma, max_iter=max_iter, ftol=0.0, sample=sample)
+	return std
@@ -8,44 +8,57 @@ import pyrap.images as pim
 import argparse
 import numpy as np
 
-def main(args):
+# Corner masks already made, keyed by image shape and radius
+masks = {}
+
+def corner_mask(shape, radius):
+ """
+ Boolean mask of the pixels further than radius (as a fraction of the image width) from the image centre.
+ """
+ key = (tuple(shape), radius)
+ if key not in masks:
+  (nx,ny) = shape
+  pbrad = radius*nx
+  cy = ny/2
+  cx = nx/2
+  j = np.arange(cx+1, nx+1)
+  k = np.arange(cy+1, ny+1)
+  quadrant = np.sqrt((j[np.newaxis,:]-cx)**2+(k[:,np.newaxis]-cy)**2)>pbrad
+  mask = np.zeros(shape, dtype=bool)
+  for rows in (k-1, ny-k):
+   for cols in (j-1, nx-j):
+    mask[np.ix_(rows, cols)] |= quadrant
+  masks[key] = mask
+ return masks[key]
 
- image = args.image
+def zero_avgpb(image, output='', radius=0.5):
+ """
+ Zeroes the corners of an avgpb image, writing it to output or to the image name with a 'z' added.
+ Returns the output name and the number of pixels zeroed.
+ """
  pb = pim.image(image)
  pbdata = pb.getdata()
- (nx,ny) = pbdata.shape[2:]
- pbrad = args.radius*nx
- cy = ny/2
- cx = nx/2
- pbcounter = 0
- for j in range(nx,cx,-1):
-  k = ny
-  while np.sqrt((j-cx)**2+(k-cy)**2)>pbrad and k>cy:
-   pbcounter += 1
-   pbdata[:,:,k-1,j-1]=0.
-   pbdata[:,:,k-1,nx-j]=0.
-   pbdata[:,:,ny-k,j-1]=0.
-   pbdata[:,:,ny-k,nx-j]=0.
-   k -= 1
-  if k == ny:
-   print j,nx
-   break
- print pbcounter,'x 4 =',pbcounter*4,'zeros replaced'
- if args.output == '':
+ mask = corner_mask(pbdata.shape[2:], float(radius))
+ pbdata[:,:,mask] = 0.
+ if output == '':
   while image[-1]=='/':
    image=image[:-1]
   outim = image+'z'
  else:
-  outim = args.output
- print 'Writing',outim
+  outim = output
  pout = pim.image(outim,values=pbdata,coordsys=pb.coordinates())
- 
-print "AVGPB editor"
-parser = argparse.ArgumentParser(description="Zero corners of avgpb images")
-parser.add_argument('image',help="Image to adjust")
-parser.add_argument('-o','--output',help="Output image name [default is to add a 'z' to the end of the input filename",default='')
-parser.add_argument('-r','--radius',help='Radius beyond which to zero avgpb values (expressed as fraction of image width) [default 0.5 = half of image width, i.e. zero outside of a circle with diameter NAXIS1]',default=0.5,type=float)
-args=parser.parse_args()
-main(args)
+ return outim, mask.sum()
 
+def main(args):
+ (outim, nzero) = zero_avgpb(args.image, args.output, args.radius)
+ print nzero,'zeros replaced'
+ print 'Written',outim
 
+if __name__ == '__main__':
+ print "AVGPB editor"
+ parser = argparse.ArgumentParser(description="Zero corners of avgpb images")
+ parser.add_argument('image',help="Image to adjust")
+ parser.add_argument('-o','--output',help="Output image name [default is to add a 'z' to the end of the input filename",default='')
+ parser.add_argument('-r','--radius',help='Radius beyond which to zero avgpb values (expressed as fraction of image width) [default 0.5 = half of image width, i.e. zero outside of a circle with diameter NAXIS1]',default=0.5,type=float)
+ args=parser.parse_args()
+ main(args)
@@ -33,7 +33,165 @@ import argparse
 import pylab as plt
 import pyfits
 import os
+import sys
 import time
+import copy
+import multiprocessing
+from itertools import izip
+import tempfile
+import shutil
+import hashlib
+from pyrap.images.coordinates import coordinatesystem
+
+def select_stokes(image, stokes):
+    """
+    Returns the image restricted to the requested Stokes parameter, and the number of channels.
+    """
+    sptcoords = image.coordinates().get_coordinate('spectral')
+    nc = sptcoords.get_axis_size()
+    assert(sptcoords.get_image_axis() == 0)
+
+    # Get Stokes axis. Ensure we are working with the Stokes parameter requested.
+    stkcoords = image.coordinates().get_coordinate('stokes')
+    assert(stkcoords.get_image_axis() == 1)
+    if stkcoords.get_axis_size() == 1:
+        assert(stkcoords.get_stokes()[0] == stokes)
+    else:
+        stks = stkcoords.get_stokes().index(stokes)
+        image = image.subimage(blc=(0, stks), trc=(nc-1, stks), dropdegenerate=False)
+    return image, nc
+
+def footprint(image, master, nmaster, npoints=17, margin=2):
+    """
+    Finds the box of master pixels (y0, y1, x0, x1) covered by an input image, from points along the edges of the input
+    converted to master pixels. Returns None if the input does not overlap the master grid.
+    """
+    dircoords = image.coordinates().get_coordinate('direction')
+    nx = dircoords.get_axis_size(axis=1)
+    ny = dircoords.get_axis_size(axis=0)
+    edge = []
+    for t in np.linspace(0., 1., npoints):
+        edge += [(0., t*(nx-1)), (ny-1., t*(nx-1)), (t*(ny-1), 0.), (t*(ny-1), nx-1.)]
+    pix = np.array([master.topixel(image.toworld([0, 0, y, x]))[2:] for (y, x) in edge])
+    y0 = max(int(np.floor(pix[:,0].min()))-margin, 0)
+    y1 = min(int(np.ceil(pix[:,0].max()))+margin+1, nmaster[0])
+    x0 = max(int(np.floor(pix[:,1].min()))-margin, 0)
+    x1 = min(int(np.ceil(pix[:,1].max()))+margin+1, nmaster[1])
+    if y0 >= y1 or x0 >= x1:
+        return None
+    return (y0, y1, x0, x1)
+
+def direction_frame(image):
+    """
+    The direction coordinate and image size of an image, used to tell whether two images share a pixel grid.
+    """
+    dircoords = image.coordinates().get_coordinate('direction')
+    return repr((list(dircoords.get_referencevalue()), list(dircoords.get_referencepixel()), list(dircoords.get_increment()),
+        dircoords.get_projection(), list(image.shape()[2:])))
+
+def plan_key(pims, ppbs, ncp):
+    """
+    Key of the regridding plan for a set of inputs, which only depends on their pixel grids.
+    """
+    h = hashlib.sha1()
+    for image in pims+ppbs:
+        h.update(direction_frame(image))
+    h.update(repr(ncp))
+    return h.hexdigest()
+
+def pixel_map(image, csys, outshape):
+    """
+    Finds the (fractional) input pixel sampled by each pixel of the sub-grid, by regridding images whose values are their
+    own pixel indexes. As the interpolation is linear these are reproduced exactly. Returns float32 y and x maps and a
+    boolean map of the sub-grid pixels that fall inside the input.
+    """
+    (ny, nx) = image.shape()[2:]
+    (yy, xx) = np.mgrid[0:ny, 0:nx]
+    maps = []
+    for values in (yy, xx, np.ones((ny, nx))):
+        index = pim.image('',values=values.reshape((1,1,ny,nx)).astype(np.float64),coordsys=image.coordinates())
+        maps.append(index.regrid([2,3],csys,outshape=(1,1)+tuple(outshape[2:])).getdata()[0,0])
+    return maps[0].astype(np.float32), maps[1].astype(np.float32), maps[2] > 0.999
+
+def gather(data, py, px, valid):
+    """
+    Bilinear interpolation of a 2D image at the pixels of a plan, zero outside the input.
+    """
+    (ny, nx) = data.shape
+    y0 = np.clip(np.floor(py).astype(int), 0, ny-2)
+    x0 = np.clip(np.floor(px).astype(int), 0, nx-2)
+    fy = py - y0
+    fx = px - x0
+    out = (data[y0,x0]*(1-fy) + data[y0+1,x0]*fy)*(1-fx) + (data[y0,x0+1]*(1-fy) + data[y0+1,x0+1]*fy)*fx
+    out[~valid] = 0.
+    return out.astype(np.float32)
+
+def regrid_input(task):
+    """
+    Regrids an input image and its avgpb onto a sub-grid of the master mosaic, returning them as float32 arrays.
+    Run in the worker processes, so the images are opened here. If a plan file is given the pixel maps are read from
+    it, or made and saved if it does not exist yet, and the images are interpolated from the maps.
+    """
+    (im, pb, stokes, csysrec, outshape, planfile) = task
+    csys = coordinatesystem(csysrec)
+    image, nc = select_stokes(pim.image(im), stokes)
+    pbimage = pim.image(pb)
+    if planfile is None:
+        imdata = image.regrid([2,3],csys,outshape=outshape).getdata()[0,0]
+        pbdata = pbimage.regrid([2,3],csys,outshape=outshape).getdata()[0,0]
+        return np.asarray(imdata, dtype=np.float32), np.asarray(pbdata, dtype=np.float32)
+    if os.path.exists(planfile):
+        plan = np.load(planfile)
+    else:
+        plan = {}
+        (plan['im_y'], plan['im_x'], plan['im_valid']) = pixel_map(image, csys, outshape)
+        if direction_frame(pbimage) == direction_frame(image):
+            (plan['pb_y'], plan['pb_x'], plan['pb_valid']) = (plan['im_y'], plan['im_x'], plan['im_valid'])
+        else:
+            (plan['pb_y'], plan['pb_x'], plan['pb_valid']) = pixel_map(pbimage, csys, outshape)
+        np.savez(planfile+'.tmp.npz', **plan)
+        os.rename(planfile+'.tmp.npz', planfile)
+    imdata = gather(image.getdata()[0,0], plan['im_y'], plan['im_x'], plan['im_valid'])
+    pbdata = gather(pbimage.getdata()[0,0], plan['pb_y'], plan['pb_x'], plan['pb_valid'])
+    return imdata, pbdata
+
+def master_array(shape, scratch, name):
+    """
+    Makes a zeroed float32 master array, memory mapped to a file in the scratch directory if one is given.
+    """
+    if scratch is None:
+        return np.zeros(shape, dtype=np.float32)
+    return np.memmap(os.path.join(scratch, name), dtype=np.float32, mode='w+', shape=shape)
+
+def fits_header(ma, shape, template):
+    """
+    Makes the fits header of a master image with the coordinates ma, by converting a 1x1 image with pyrap and setting
+    the image size. The template fits file is removed again.
+    """
+    ref = ma['direction'].get_referencepixel()
+    pim.image('',shape=(1,1,1,1),coordsys=ma).tofits(template, overwrite=True)
+    header = pyfits.getheader(template)
+    os.remove(template)
+    header.update('NAXIS1',shape[1])
+    header.update('NAXIS2',shape[0])
+    header.update('CRPIX1',ref[1]+1.)
+    header.update('CRPIX2',ref[0]+1.)
+    for key in ('DATAMIN','DATAMAX'):
+        if key in header:
+            del header[key]
+    return header
+
+def write_image(data, header, fitsname, stripe):
+    """
+    Writes a 2D master array straight to a fits image a stripe of rows at a time, so that neither the array nor a
+    copy of it is held in memory.
+    """
+    if os.path.exists(fitsname):
+        os.remove(fitsname)
+    hdu = pyfits.StreamingHDU(fitsname, header)
+    for r0 in range(0, data.shape[0], stripe):
+        hdu.write(np.asarray(data[r0:r0+stripe], dtype='>f4'))
+    hdu.close()
 
 def main(args):
 
@@ -107,19 +265,7 @@ def main(args):
 
 # Get image frames for input images
     for im, pb in zip(images, avgpbs):
-        image = pim.image(im)
-        sptcoords = image.coordinates().get_coordinate('spectral')
-        nc = sptcoords.get_axis_size()
-        assert(sptcoords.get_image_axis() == 0)
-
-        # Get Stokes axis. Ensure we are working with the Stokes parameter requested.
-        stkcoords = image.coordinates().get_coordinate('stokes')
-        assert(stkcoords.get_image_axis() == 1)
-        if stkcoords.get_axis_size() == 1:
-            assert(stkcoords.get_stokes()[0] == args.stokes)
-        else:
-            stks = stkcoords.get_stokes().index(args.stokes)
-            image = image.subimage(blc=(0, stks), trc=(nc-1, stks), dropdegenerate=False)
+        image, nc = select_stokes(pim.image(im), args.stokes)
         ns = 1
 
         dircoords = image.coordinates().get_coordinate('direction')
@@ -174,49 +320,83 @@ def main(args):
         ma['direction'].set_referencepixel([dec_imsize/2.,ra_imsize/2.])
 
     # Initialize the arrays for the output image, sensitivity, and weights
-    master_im = np.zeros((len(master_dec),len(master_ra)))
-    master_weight = np.zeros((len(master_dec),len(master_ra)))
-    master_sens = np.zeros((len(master_dec),len(master_ra)))
+    if args.scratch == '':
+        scratch = None
+    else:
+        scratch = tempfile.mkdtemp(prefix='mosaic_', dir=args.scratch)
+    master_im = master_array((len(master_dec),len(master_ra)), scratch, 'master_im')
+    master_weight = master_array((len(master_dec),len(master_ra)), scratch, 'master_weight')
+    master_sens = master_array((len(master_dec),len(master_ra)), scratch, 'master_sens')
 
-    # Reproject the images onto the master grid, weight and normalize
+    # Each input is only regridded onto the part of the master grid it covers
+    master = pim.image('',shape=(1,1,1,1),coordsys=ma)
+    boxes = []
+    if args.plan != '':
+        if not os.path.isdir(args.plan):
+            os.makedirs(args.plan)
+        key = plan_key(pims, ppbs, args.NCP)
+        print "Using regridding plan {0}".format(key)
+    tasks = []
     for i in range(len(pims)):
-        im = pims[i].regrid([2,3],ma,outshape=(nc,ns,len(master_dec),len(master_ra)))
-        pb = ppbs[i].regrid([2,3],ma,outshape=(nc,ns,len(master_dec),len(master_ra)))
-        imdata = np.squeeze(im.getdata())
-        pbdata = np.squeeze(pb.getdata())
-        newim = imdata
-        newpb = pbdata
-        newwt = (weights[i]*newpb)**2
-        master_im += newim*newwt
-        master_sens += newpb*newwt
-        master_weight += newwt
-    inds = master_weight != 0.
-    master_im[inds] /= master_weight[inds]
-    master_sens[inds] /= master_weight[inds]
+        box = footprint(pims[i], master, master_im.shape)
+        if box is None:
+            print "Warning: {0} does not overlap the mosaic, skipping it.".format(images[i])
+            continue
+        (y0, y1, x0, x1) = box
+        sub = coordinatesystem(copy.deepcopy(ma.dict()))
+        ref = sub['direction'].get_referencepixel()
+        sub['direction'].set_referencepixel([ref[0]-y0, ref[1]-x0])
+        boxes.append((i, box))
+        if args.plan != '':
+            planfile = os.path.join(args.plan, "{0}_{1}.npz".format(key, i))
+        else:
+            planfile = None
+        tasks.append((images[i], avgpbs[i], args.stokes, sub.dict(), (nc,ns,y1-y0,x1-x0), planfile))
+        if args.verbose:
+            print "{0}: master pixels y {1}-{2}, x {3}-{4}".format(images[i], y0, y1, x0, x1)
+
+    if len(tasks) == 0:
+        print "Error: None of the images overlap the mosaic"
+        if scratch is not None:
+            shutil.rmtree(scratch)
+        return 1
+
+    # Reproject the images onto the master grid, weight and normalize
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(processes=min(args.jobs, len(tasks)))
+        regridded = pool.imap(regrid_input, tasks)
+    else:
+        pool = None
+        regridded = (regrid_input(t) for t in tasks)
+    for (i, (y0, y1, x0, x1)), (newim, newpb) in izip(boxes, regridded):
+        newwt = ((weights[i]*newpb)**2).astype(np.float32)
+        master_im[y0:y1,x0:x1] += newim*newwt
+        master_sens[y0:y1,x0:x1] += newpb*newwt
+        master_weight[y0:y1,x0:x1] += newwt
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for r0 in range(0, len(master_dec), args.stripe):
+        weight = master_weight[r0:r0+args.stripe]
+        inds = weight != 0.
+        master_im[r0:r0+args.stripe][inds] /= weight[inds]
+        master_sens[r0:r0+args.stripe][inds] /= weight[inds]
 
     # Show image if requested
     if args.plotimg:
         plt.imshow(master_im,vmin=0.,vmax=0.5)
         plt.show()
 
-    # Write fits files
-    arrax = np.zeros( (1,1, len(master_im[:,0]), len(master_im[0,:])) )
-    arrax[0,0,:,:] = master_im
-
-
-    # Open new casa image for mosaic
-    new_pim = pim.image('',shape=(1,1, len(master_dec),len(master_ra)), coordsys=ma)
-    new_pim.putdata(arrax)
-    # Write fits
-    new_pim.tofits(args.outfits, overwrite=True)
-    # Same for sensitivity
-    new_pim_sens = pim.image('',shape=(1,1,len(master_dec),len(master_ra)),coordsys=ma)
-    arrax[0,0,:,:] = master_sens
-    new_pim_sens.putdata(arrax)  #
-    new_pim_sens.tofits(args.sensfits, overwrite=True)
+    # Write fits files for the mosaic and the sensitivity
+    header = fits_header(ma, master_im.shape, args.outfits+'.template.fits')
+    write_image(master_im, header, args.outfits, args.stripe)
+    write_image(master_sens, header, args.sensfits, args.stripe)
+    del master_im, master_weight, master_sens
+    if scratch is not None:
+        shutil.rmtree(scratch)
 
-    # need to add new beam info (not sure if this is possible with pyrap)
-    hdu = pyfits.open(args.outfits,mode='update')
+    # need to add new beam info (not sure if this is possible with pyrap), only the header is rewritten
+    hdu = pyfits.open(args.outfits,mode='update',memmap=True)
     header = hdu[0].header
     header.update('BMAJ',mean_psf_fwhm[0])
     header.update('BMIN',mean_psf_fwhm[1])
@@ -224,8 +404,8 @@ def main(args):
     header.update('BUNIT',pims[-1].info()['unit'])
     header.update('RESTFRQ',mean_frequency)
     header.update('RESTFREQ',mean_frequency)
-    newhdu = pyfits.PrimaryHDU(data=hdu[0].data, header=header)
-    newhdu.writeto(args.outfits,clobber=True)
+    hdu.flush()
+    hdu.close()
 
     return
 
@@ -241,6 +421,10 @@ parser.add_argument('-o','--outfits',help='Output name of mosaic fits file [defa
 parser.add_argument('-s','--sensfits',help='Output name of sensitivity fits file [default sensitivity.fits]',default='sensitivity.fits')
 parser.add_argument('-p','--plotimg',help='Display image on screen? [default False]',action='store_true',default=False)
 parser.add_argument('-S','--stokes',help='Stokes parameter to use?  [default I]',default='I')
+parser.add_argument('-j','--jobs',help='Number of processes used to regrid the input images [default 1]',default=1,type=int)
+parser.add_argument('-t','--scratch',help='Directory in which to keep the master arrays as memory mapped files, for mosaics too large for memory [default \'\' keeps them in memory]',default='')
+parser.add_argument('-r','--stripe',help='Number of rows of the master arrays normalised and written at a time [default 1024]',default=1024,type=int)
+parser.add_argument('-P','--plan',help='Directory of regridding plans. Inputs on the same pixel grids as an earlier run, such as the time windows of one pointing set, reuse its plan instead of being regridded [default \'\' regrids every time]',default='')
 parser.add_argument('-N','--NCP',help='Use NCP instead of SIN? This option does not work yet. [default False]',default=False,action='store_true')
 args = parser.parse_args()
-main(args)
+sys.exit(main(args))
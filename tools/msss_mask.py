@@ -37,88 +37,112 @@ import lofar.parmdb
 
 pad = 250. # increment in maj/min axes [arcsec]
 
-# open command line arguments
-mask_file = sys.argv[1]
-catalogue = sys.argv[2]
-
-
-# open mask
-mask = pi.image(mask_file, overwrite = True)
-mask_data = mask.getdata()
-xlen, ylen = mask.shape()[2:]
-freq, stokes, null, null = mask.toworld([0, 0, 0, 0])
-
-
-#Open the sourcedb:
-table = pt.table(catalogue + "::SOURCES")
-pdb = lofar.parmdb.parmdb(catalogue)
-
-# Get the data of interest
-source_list = table.getcol("SOURCENAME")
-source_type = table.getcol("SOURCETYPE")
-all_values_dict = pdb.getDefValues()  # All date in the format valuetype:sourcename
-
-# Loop the sources
-for source, type in zip(source_list, source_type):
-    if type == 1:
-        type_string = "Gaussian"
-    else:
-        type_string = "Point"
-    print "processing: {0} ({1})".format(source, type_string)
-
-    # Get de ra and dec (already in radians)
-    ra = all_values_dict["Ra:" + source][0, 0]
-    dec = all_values_dict["Dec:" + source][0, 0]
-    if type == 1:
-        # Get the raw values from the db
-        maj_raw = all_values_dict["MajorAxis:" + source][0, 0]
-        min_raw = all_values_dict["MinorAxis:" + source][0, 0]
-        pa_raw = all_values_dict["Orientation:" + source][0, 0]
-        #convert to radians (conversion is copy paste JDS)
-        maj = (((maj_raw + pad)) / 3600.) * np.pi / 180. # major radius (+pad) in rad
-        min = (((min_raw + pad)) / 3600.) * np.pi / 180. # minor radius (+pad) in rad
-        pa = pa_raw * np.pi / 180.
-        if maj == 0 or min == 0: # wenss writes always 'GAUSSIAN' even for point sources -> set to wenss beam+pad
-            maj = ((54. + pad) / 3600.) * np.pi / 180.
-            min = ((54. + pad) / 3600.) * np.pi / 180.
-    elif type == 0: # set to wenss beam+pad
-        maj = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
-        min = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
-        pa = 0.
-    else:
-        print "WARNING: unknown source type ({0}), ignoring it.".format(type)
-        continue
-
-    #print "Maj = ", maj*180*3600/np.pi, " - Min = ", min*180*3600/np.pi # DEBUG
-
-    # define a small square around the source to look for it
-    null, null, y1, x1 = mask.topixel([freq, stokes, dec - maj, ra - maj / np.cos(dec - maj)])
-    null, null, y2, x2 = mask.topixel([freq, stokes, dec + maj, ra + maj / np.cos(dec + maj)])
-    xmin = np.int(np.floor(np.min([x1, x2])))
-    xmax = np.int(np.ceil(np.max([x1, x2])))
-    ymin = np.int(np.floor(np.min([y1, y2])))
-    ymax = np.int(np.ceil(np.max([y1, y2])))
-
-    if xmin > xlen or ymin > ylen or xmax < 0 or ymax < 0:
-        print "WARNING: source ", source, "falls outside the mask, ignoring it."
-        continue
-
-    if xmax > xlen or ymax > ylen or xmin < 0 or ymin < 0:
-        print "WARNING: source ", source, "falls across map edge."
-
-
-    for x in xrange(xmin, xmax):
-        for y in xrange(ymin, ymax):
-            # skip pixels outside the mask field
-            if x >= xlen or y >= ylen or x < 0 or y < 0:
-                continue
-            # get pixel ra and dec in rad
-            null, null, pix_dec, pix_ra = mask.toworld([0, 0, y, x])
-
-            X = (pix_ra - ra) * np.sin(pa) + (pix_dec - dec) * np.cos(pa); # Translate and rotate coords.
-            Y = -(pix_ra - ra) * np.cos(pa) + (pix_dec - dec) * np.sin(pa); # to align with ellipse
-            if X ** 2 / maj ** 2 + Y ** 2 / min ** 2 < 1:
-                mask_data[0, 0, y, x] = 1
-
-mask.putdata(mask_data)
-table.close()
+def pixel_world(mask, dircoords, y, x):
+    """
+    Returns the dec and ra (rad) of the pixels y, x (arrays) of the mask. SIN projected images, as made by the awimager,
+    are deprojected for all the pixels at once, other projections fall back to one toworld call per pixel.
+    """
+    if dircoords.get_projection() != "SIN":
+        world = np.array([mask.toworld([0, 0, j, i]) for j, i in zip(y.ravel(), x.ravel())])
+        return world[:, 2].reshape(y.shape), world[:, 3].reshape(y.shape)
+    (dec0, ra0) = dircoords.get_referencevalue()
+    (refy, refx) = dircoords.get_referencepixel()
+    (incy, incx) = dircoords.get_increment()
+    l = (x - refx) * incx
+    m = (y - refy) * incy
+    n = np.sqrt(1. - l ** 2 - m ** 2)
+    pix_dec = np.arcsin(m * np.cos(dec0) + n * np.sin(dec0))
+    pix_ra = ra0 + np.arctan2(l, n * np.cos(dec0) - m * np.sin(dec0))
+    return pix_dec, pix_ra
+
+def fill_mask(mask_file, catalogue, verbose=True):
+    """
+    Sets to 1 the pixels of the mask image inside the (padded) ellipse of each source of the sourcedb catalogue.
+    The pixels in the bounding box of a source are tested together. Returns the warnings about the sources, which
+    are only printed if verbose.
+    """
+    # open mask
+    mask = pi.image(mask_file, overwrite = True)
+    mask_data = mask.getdata()
+    xlen, ylen = mask.shape()[2:]
+    freq, stokes, null, null = mask.toworld([0, 0, 0, 0])
+    dircoords = mask.coordinates().get_coordinate('direction')
+
+    #Open the sourcedb:
+    table = pt.table(catalogue + "::SOURCES")
+    pdb = lofar.parmdb.parmdb(catalogue)
+
+    # Get the data of interest
+    source_list = table.getcol("SOURCENAME")
+    source_type = table.getcol("SOURCETYPE")
+    all_values_dict = pdb.getDefValues()  # All date in the format valuetype:sourcename
+
+    warnings = []
+    # Loop the sources
+    for source, type in zip(source_list, source_type):
+        if type == 1:
+            type_string = "Gaussian"
+        else:
+            type_string = "Point"
+        if verbose:
+            print "processing: {0} ({1})".format(source, type_string)
+
+        # Get de ra and dec (already in radians)
+        ra = all_values_dict["Ra:" + source][0, 0]
+        dec = all_values_dict["Dec:" + source][0, 0]
+        if type == 1:
+            # Get the raw values from the db
+            maj_raw = all_values_dict["MajorAxis:" + source][0, 0]
+            min_raw = all_values_dict["MinorAxis:" + source][0, 0]
+            pa_raw = all_values_dict["Orientation:" + source][0, 0]
+            #convert to radians (conversion is copy paste JDS)
+            maj = (((maj_raw + pad)) / 3600.) * np.pi / 180. # major radius (+pad) in rad
+            min = (((min_raw + pad)) / 3600.) * np.pi / 180. # minor radius (+pad) in rad
+            pa = pa_raw * np.pi / 180.
+            if maj == 0 or min == 0: # wenss writes always 'GAUSSIAN' even for point sources -> set to wenss beam+pad
+                maj = ((54. + pad) / 3600.) * np.pi / 180.
+                min = ((54. + pad) / 3600.) * np.pi / 180.
+        elif type == 0: # set to wenss beam+pad
+            maj = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
+            min = (((54. + pad) / 2.) / 3600.) * np.pi / 180.
+            pa = 0.
+        else:
+            warnings.append("unknown source type ({0}) of {1}, ignoring it.".format(type, source))
+            continue
+
+        # define a small square around the source to look for it
+        null, null, y1, x1 = mask.topixel([freq, stokes, dec - maj, ra - maj / np.cos(dec - maj)])
+        null, null, y2, x2 = mask.topixel([freq, stokes, dec + maj, ra + maj / np.cos(dec + maj)])
+        xmin = np.int(np.floor(np.min([x1, x2])))
+        xmax = np.int(np.ceil(np.max([x1, x2])))
+        ymin = np.int(np.floor(np.min([y1, y2])))
+        ymax = np.int(np.ceil(np.max([y1, y2])))
+
+        if xmin > xlen or ymin > ylen or xmax < 0 or ymax < 0:
+            warnings.append("source {0} falls outside the mask, ignoring it.".format(source))
+            continue
+
+        if xmax > xlen or ymax > ylen or xmin < 0 or ymin < 0:
+            warnings.append("source {0} falls across map edge.".format(source))
+
+        # skip pixels outside the mask field
+        (xmin, xmax, ymin, ymax) = (max(xmin, 0), min(xmax, xlen), max(ymin, 0), min(ymax, ylen))
+        if xmin >= xmax or ymin >= ymax:
+            continue
+        y, x = np.mgrid[ymin:ymax, xmin:xmax]
+        pix_dec, pix_ra = pixel_world(mask, dircoords, y, x)
+
+        X = (pix_ra - ra) * np.sin(pa) + (pix_dec - dec) * np.cos(pa); # Translate and rotate coords.
+        Y = -(pix_ra - ra) * np.cos(pa) + (pix_dec - dec) * np.sin(pa); # to align with ellipse
+        mask_data[0, 0, ymin:ymax, xmin:xmax][X ** 2 / maj ** 2 + Y ** 2 / min ** 2 < 1] = 1
+
+    mask.putdata(mask_data)
+    table.close()
+    if verbose:
+        for w in warnings:
+            print "WARNING: "+w
+    return warnings
+
+if __name__ == "__main__":
+    # open command line arguments
+    fill_mask(sys.argv[1], sys.argv[2])
@@ -1,202 +1,198 @@
 #! /usr/bin/env python
 
+# Chooses the sources to peel from a sky model and writes them into the peeling parset.
+# The sky model is parsed once into arrays (and cached) and the beam attenuated fluxes of all sources are found together,
+# so the planner can be imported and called for every band of a beam without reparsing.
+
 import optparse
 import pyrap.tables as pt
 import numpy as np
 import math as m
 import os
-import scipy as sci
-# Add a parser to the script
-
-parser = optparse.OptionParser()
-
-parser.add_option("-i", help="The input MS [required]", action="store", type="string", dest="input")
-parser.add_option("-p", help="Parset for calibration [required]", action="store", type="string", dest="parset")
-parser.add_option("-l", help="Flux limit in Jy down to which sources are included for peeling [10]", action="store", type="float", dest="limit", default=10.0)
-parser.add_option("-f", help="Flux limit for the skymodel in Jy (only used for gsm.py) [0.1]", action="store", type="float", dest="flimit", default=0.1)
-parser.add_option("-c", help="Radius around the pointing centre in which to search for sources in deg. (only used for gsm.py) [15]", action="store", type="float", dest="cone", default=15.0)
-parser.add_option("-m", help="Sky model to use, e.g. if you have already run gsm.py and don't want to generate a new skymodel. If \'none\', gsm.py will be executed. [\'none\']", action="store", type="string", dest="model_fn", default="none")
-parser.add_option("-v", help="Verbose mode, will print a bunch of helpful messages. [False]", action="store_true", default=False, dest="verbose")
-parser.add_option("-n", help="The number of sources to be peeled. The flux limit is still preserved. If zero, peels all sources down to the flux limit. [0]", action="store", type="int", dest="nsources", default=0)
-parser.add_option("-s", help="Explicitly specify sources to be peeled in the format of source1,source2,source3", action="store", type="string", dest="specsources", default="0")
-
-options, arguments = parser.parse_args()
-
-generate_skymodel = True
-if options.model_fn.lower() != "none":
-	generate_skymodel = False
-	skymodel_fn = options.model_fn
-else:
-	skymodel_fn = "peeling.skymodel"
-
-
-# Get the frequency and the pointing centre from the measurement set
-sw = pt.table(options.input + '/SPECTRAL_WINDOW')
-freq = sw.col('REF_FREQUENCY')[0]
-sw.close()
-
-# obs = pt.table(options.input + '/OBSERVATION')
-# ra = float(obs.col('LOFAR_TARGET')[0][0].split()[1])
-# dec = float(obs.col('LOFAR_TARGET')[0][0].split()[2])
-# obs.close()
-
-obs = pt.table(options.input + '/FIELD')
-ra = float(obs.col('PHASE_DIR')[0][0][0])
-if ra > 0.:
-	ra*=(180./m.pi)
-else:
-	ra=360.+(ra*(180./m.pi))
-dec = float(obs.col('PHASE_DIR')[0][0][1])*(180./m.pi)
-
-# This isn't the FWHM, but the standard deviation (due to the 
-# factor of 1/2.3548) to be used in the Gaussian tapering step later
-fwhm = 1.1*((3.0e8/freq)/32.25)*180./m.pi/2.3548
-if options.verbose:
-	print "Primary beam FWHM (est. deg) = " + str(fwhm*2.3548)
-
-# Calculate the skymodel from WENSS, VLSS and NVSS
-if generate_skymodel:
-	print 'Calculating skymodel!'
-	os.system('gsm.py '+skymodel_fn+' ' + str(ra) + ' ' + str(dec) + ' ' + str(options.cone) + ' ' + str(options.flimit))
-
-# Read in the sky model and create an array with ra,dec and flux. Adjust the sources to their apparent flux in the observation and find the sources abover an apparent limit to peel them.
-
-tmp1 = []
-tmp2 = []
-tmp3 = []
-tmpcs1 = []
-tmpcs2 = []
-tmpcs3 = []
-tmpcs4 = []
-brightest_name = ''
-brightest_flux = 0
-
-
-if options.verbose:
-	print "RA = " + str(ra)
-	print "Dec. = " + str(dec)
-	print "***********************************************************"
-
-for line in open(skymodel_fn):
-	sline=line.split(',')
-	if line[0] == '#': continue
-	if line[0] == 'FORMAT': continue
-	if line[0] == '\n': continue
-	name = str(sline[0])
-	ra_src = str(sline[2]).split(':')
-	ra_deg = float(ra_src[0])*15.0 + (float(ra_src[1])/60.0)*15.0 + (float(ra_src[2])/3600.0)*15.0
-	dec_src = str(sline[3]).split('.')
-	if len(dec_src) == 3:
-		dec_deg = float(dec_src[0]) + (float(dec_src[1])/60.0) + (float(dec_src[2])/3600.0)
-	else:
-		dec_deg = float(dec_src[0]) + (float(dec_src[1])/60.0) + (float(dec_src[2] + '.' + dec_src[3])/3600.0)
-	flux = str(sline[4])
-	dist = (180./m.pi)*m.acos(m.sin(dec*(m.pi/180.0)) * m.sin(dec_deg*(m.pi/180.0)) + m.cos(dec*(m.pi/180.0)) * m.cos(dec_deg*(m.pi/180.0)) * m.cos((ra-ra_deg)*(m.pi/180.0)))
-	flux_corr = float(flux)*m.exp(-(dist**2)/2./fwhm**2)
-	if flux_corr > brightest_flux:
-		brightest_flux = flux_corr
-		brightest_name = name
-
-	if options.nsources == 0:
-
-		if flux_corr > options.limit:
-			if options.verbose:
-				# print line
-				print "Beam attenuated flux (est. Jy) = " + str(flux_corr)
-				print "RA = " + str(ra_deg)
-				print "Dec. = " + str(dec_deg)
-				print "Dist. (Deg.) = " + str(dist)
-				print "***********************************************************"
-			tmp1.append(name)
-			tmp2.append([name,dist])
+import hashlib
+
+# Parsed sky models, keyed by file name and checked against the file size and modification time
+skymodels = {}
+# Frequency and pointing centre of each measurement set
+fields = {}
+
+def read_skymodel(skymodel_fn, cachedir=None):
+	"""
+	Reads the names, ra and dec (deg) and fluxes of the sources in a sky model, returning a list of names and arrays.
+	With cachedir the parsed model is also stored there as an npz file named by the hash of the model text, for later runs.
+	"""
+	st = os.stat(skymodel_fn)
+	stamp = (st.st_size, st.st_mtime)
+	if skymodel_fn in skymodels and skymodels[skymodel_fn][0] == stamp:
+		return skymodels[skymodel_fn][1]
+	if cachedir is not None:
+		stored = os.path.join(cachedir, hashlib.sha1(open(skymodel_fn).read()).hexdigest()+".npz")
+		if os.path.isfile(stored):
+			parsed = np.load(stored)
+			model = (list(parsed['names']), parsed['ra'], parsed['dec'], parsed['flux'])
+			skymodels[skymodel_fn] = (stamp, model)
+			return model
+	names = []
+	ras = []
+	decs = []
+	fluxes = []
+	for line in open(skymodel_fn):
+		if line[0] == '#': continue
+		if line.startswith('FORMAT') or line.startswith('format'): continue
+		if line.strip() == '': continue
+		sline = line.split(',')
+		names.append(sline[0])
+		ras.append(sline[2].split(':'))
+		decs.append(sline[3].split('.'))
+		fluxes.append(float(sline[4]))
+	ra_src = np.array([[float(r) for r in ra] for ra in ras]).reshape((-1, 3))
+	ra_deg = ra_src[:,0]*15.0 + (ra_src[:,1]/60.0)*15.0 + (ra_src[:,2]/3600.0)*15.0
+	dec_deg = np.array([float(d[0]) + (float(d[1])/60.0) + (float('.'.join(d[2:]))/3600.0) for d in decs])
+	model = (names, ra_deg, dec_deg, np.array(fluxes))
+	skymodels[skymodel_fn] = (stamp, model)
+	if cachedir is not None:
+		if not os.path.isdir(cachedir):
+			try:
+				os.makedirs(cachedir)
+			except OSError:
+				pass
+		tmp = "{0}.tmp{1}.npz".format(stored[:-4], os.getpid())
+		np.savez(tmp, names=np.array(names), ra=ra_deg, dec=dec_deg, flux=model[3])
+		os.rename(tmp, stored)
+	return model
+
+def field_info(ms):
+	"""
+	Returns the reference frequency and the pointing centre (ra, dec in deg) of a measurement set.
+	"""
+	if ms not in fields:
+		sw = pt.table(ms + '/SPECTRAL_WINDOW', ack=False)
+		freq = sw.col('REF_FREQUENCY')[0]
+		sw.close()
+		obs = pt.table(ms + '/FIELD', ack=False)
+		ra = float(obs.col('PHASE_DIR')[0][0][0])
+		if ra > 0.:
+			ra*=(180./m.pi)
 		else:
-			tmp3.append(name)
-	else:	
-		tmpcs2.append([name,flux_corr,ra_deg,dec_deg,dist])
-
-names=[]
-if options.nsources != 0:
-	if options.specsources != "0":
-		peel_names=options.specsources.split(",")
-		for s in tmpcs2:
-			if s[0] in peel_names and s[1] > options.limit:
-				names.append(s[0])
-				if options.verbose:
-	                        	        print "Beam attenuated flux (est. Jy) = " + str(s[1])
-	                                	print "RA = " + str(s[2])
-	                               		print "Dec. = " + str(s[3])
-	                                	print "Dist. (Deg.) = " + str(s[4])
-	                                	print "***********************************************************"
+			ra=360.+(ra*(180./m.pi))
+		dec = float(obs.col('PHASE_DIR')[0][0][1])*(180./m.pi)
+		obs.close()
+		fields[ms] = (freq, ra, dec)
+	return fields[ms]
+
+def apparent_fluxes(model, freq, ra, dec):
+	"""
+	Distances (deg) from the pointing centre and Gaussian primary beam attenuated fluxes of all the sources of a sky model.
+	"""
+	(names, ra_deg, dec_deg, flux) = model
+	# This isn't the FWHM, but the standard deviation (due to the
+	# factor of 1/2.3548) to be used in the Gaussian tapering step
+	fwhm = 1.1*((3.0e8/freq)/32.25)*180./m.pi/2.3548
+	d2r = m.pi/180.
+	cosdist = np.sin(dec*d2r)*np.sin(dec_deg*d2r) + np.cos(dec*d2r)*np.cos(dec_deg*d2r)*np.cos((ra-ra_deg)*d2r)
+	dist = np.degrees(np.arccos(np.clip(cosdist, -1., 1.)))
+	return dist, flux*np.exp(-(dist**2)/2./fwhm**2)
+
+def choose_sources(names, flux_corr, limit=10.0, nsources=0, specsources="0"):
+	"""
+	Splits the sources into those to peel and the rest. With nsources 0 all sources above the flux limit are peeled,
+	otherwise the given sources or the nsources brightest, as long as they are above the limit.
+	"""
+	peel = []
+	other = []
+	if nsources == 0:
+		for i in range(len(names)):
+			if flux_corr[i] > limit:
+				peel.append(names[i])
+			else:
+				other.append(names[i])
+	elif specsources != "0":
+		peel_names = specsources.split(",")
+		for i in range(len(names)):
+			if names[i] in peel_names and flux_corr[i] > limit:
+				peel.append(names[i])
 			else:
-				tmp3.append(s[0])
-		
-		print 'You are going to peel ' + str(len(names)) + ' sources!'
-		peel_src = ",".join(names)
+				other.append(names[i])
 	else:
-		# print "Got HERE"
-		tmpcs = sorted(tmpcs2, key=lambda tdown: tdown[1], reverse=True)	#All sources sorted by flux
-		# print tmpcs
-		tmpcs3 = tmpcs[:options.nsources]		#sources to peel
-		tmpcs4 = tmpcs[options.nsources:]		#rest of sources
-		for i in tmpcs4:						#for each source in rest add name to tmp3
-			tmp3.append(i[0])
-		for l in tmpcs3:
-			# print l						#for each source in to peel 
-			if l[1] > options.limit:							
-				names.append(l[0])				#if source over limit add name to names
-				if options.verbose:
-	                        	        print "Beam attenuated flux (est. Jy) = " + str(l[1])
-	                                	print "RA = " + str(l[2])
-	                               		print "Dec. = " + str(l[3])
-	                                	print "Dist. (Deg.) = " + str(l[4])
-	                                	print "***********************************************************"
+		order = np.argsort(-flux_corr, kind='mergesort')	#All sources sorted by flux
+		other = [names[i] for i in order[nsources:]]
+		for i in order[:nsources]:
+			if flux_corr[i] > limit:
+				peel.append(names[i])
 			else:
-				tmp3.append(l[0])				#if not add name to rest of sources
-
-	
-		print 'You are going to peel ' + str(len(names)) + ' sources!'
-		peel_src = ",".join(names)
-		#ref = tmpcs3[0][0]
-else:
-	print 'You are going to peel ' + str(len(tmp1)) + ' sources!'	#peel all sources above limit!
-
-	peel_src = ",".join(tmp1)
-	#tmp3 = sorted(tmp2, key=lambda tdown: tdown[1])
-	#ref = tmp3[0][0]
-
-
-other_src = ",".join(tmp3)
-f = open(options.parset, 'rw')
-newlines = []
-for line in f:
-    	if 'Step.add1.Model.Sources =' in line:
-        	line = 'Step.add1.Model.Sources = [' + str(peel_src) + ']\n'
-	if 'Step.solve.Model.Sources =' in line:
-		line = 'Step.solve.Model.Sources = [' + str(peel_src) + ']\n'
-	if 'Step.subtractstrong1.Model.Sources =' in line:
-		line = 'Step.subtractstrong1.Model.Sources = [' + str(peel_src) + ']\n'
-	if 'Step.add2.Model.Sources =' in line:
-		line = 'Step.add2.Model.Sources = [' + str(other_src) + ']\n'
-	if 'Step.solve2.Model.Sources =' in line:
-		line = 'Step.solve2.Model.Sources = [' + str(other_src) + ']\n'
-	#if 'Step.correct.Model.Sources =' in line:
-	#	if not correct_brightest:
-	#		line = 'Step.correct.Model.Sources = [' + str(ref) + ']\n'
-	#	else:
-	#		line = 'Step.correct.Model.Sources = [' + str(brightest_name) + ']\n'
-	#if 'Step.add3.Model.Sources =' in line:
-	#	line = 'Step.add3.Model.Sources = [' + str(peel_src) + ']\n'
-		
-    	newlines.append(line)
-
-outfile = file(options.parset, 'w')
-outfile.writelines(newlines)
+				other.append(names[i])
+	return peel, other
+
+def write_parset(parset, peel, other):
+	"""
+	Puts the sources to peel and the rest into the model source lists of the peeling parset.
+	"""
+	peel_src = ",".join(peel)
+	other_src = ",".join(other)
+	newlines = []
+	for line in open(parset, 'r'):
+		if 'Step.add1.Model.Sources =' in line:
+			line = 'Step.add1.Model.Sources = [' + peel_src + ']\n'
+		if 'Step.solve.Model.Sources =' in line:
+			line = 'Step.solve.Model.Sources = [' + peel_src + ']\n'
+		if 'Step.subtractstrong1.Model.Sources =' in line:
+			line = 'Step.subtractstrong1.Model.Sources = [' + peel_src + ']\n'
+		if 'Step.add2.Model.Sources =' in line:
+			line = 'Step.add2.Model.Sources = [' + other_src + ']\n'
+		if 'Step.solve2.Model.Sources =' in line:
+			line = 'Step.solve2.Model.Sources = [' + other_src + ']\n'
+		newlines.append(line)
+	outfile = open(parset, 'w')
+	outfile.writelines(newlines)
+	outfile.close()
+
+def plan_peeling(ms, skymodel_fn, limit=10.0, nsources=0, specsources="0", parset=None, verbose=False, cachedir=None):
+	"""
+	Chooses the sources to peel for a measurement set, writing them into the parset if one is given.
+	Returns the lists of sources to peel and of the rest.
+	"""
+	(freq, ra, dec) = field_info(ms)
+	model = read_skymodel(skymodel_fn, cachedir)
+	dist, flux_corr = apparent_fluxes(model, freq, ra, dec)
+	peel, other = choose_sources(model[0], flux_corr, limit, nsources, specsources)
+	if verbose:
+		print "Primary beam FWHM (est. deg) = " + str(1.1*((3.0e8/freq)/32.25)*180./m.pi)
+		print "RA = " + str(ra)
+		print "Dec. = " + str(dec)
+		print "***********************************************************"
+		for i in [model[0].index(p) for p in peel]:
+			print "Beam attenuated flux (est. Jy) = " + str(flux_corr[i])
+			print "RA = " + str(model[1][i])
+			print "Dec. = " + str(model[2][i])
+			print "Dist. (Deg.) = " + str(dist[i])
+			print "***********************************************************"
+		print 'You are going to peel ' + str(len(peel)) + ' sources!'
+	if parset is not None:
+		write_parset(parset, peel, other)
+	return peel, other
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser()
+
+	parser.add_option("-i", help="The input MS [required]", action="store", type="string", dest="input")
+	parser.add_option("-p", help="Parset for calibration [required]", action="store", type="string", dest="parset")
+	parser.add_option("-l", help="Flux limit in Jy down to which sources are included for peeling [10]", action="store", type="float", dest="limit", default=10.0)
+	parser.add_option("-f", help="Flux limit for the skymodel in Jy (only used for gsm.py) [0.1]", action="store", type="float", dest="flimit", default=0.1)
+	parser.add_option("-c", help="Radius around the pointing centre in which to search for sources in deg. (only used for gsm.py) [15]", action="store", type="float", dest="cone", default=15.0)
+	parser.add_option("-m", help="Sky model to use, e.g. if you have already run gsm.py and don't want to generate a new skymodel. If \'none\', gsm.py will be executed. [\'none\']", action="store", type="string", dest="model_fn", default="none")
+	parser.add_option("-v", help="Verbose mode, will print a bunch of helpful messages. [False]", action="store_true", default=False, dest="verbose")
+	parser.add_option("-n", help="The number of sources to be peeled. The flux limit is still preserved. If zero, peels all sources down to the flux limit. [0]", action="store", type="int", dest="nsources", default=0)
+	parser.add_option("-s", help="Explicitly specify sources to be peeled in the format of source1,source2,source3", action="store", type="string", dest="specsources", default="0")
+
+	options, arguments = parser.parse_args()
+
+	if options.model_fn.lower() != "none":
+		skymodel_fn = options.model_fn
+	else:
+		# Calculate the skymodel from WENSS, VLSS and NVSS
+		skymodel_fn = "peeling.skymodel"
+		(freq, ra, dec) = field_info(options.input)
+		print 'Calculating skymodel!'
+		os.system('gsm.py '+skymodel_fn+' ' + str(ra) + ' ' + str(dec) + ' ' + str(options.cone) + ' ' + str(options.flimit))
 
-# print 'Writing parset file!'
-#if not correct_brightest:
-#	if options.nsources != 0:
-#		print 'The field will be corrected for ' + str(ref) + ', which is located ' + str(tmpcs3[0][4]) + ' degrees from the pointing centre!'
-#	else:
-#		print 'The field will be corrected for ' + str(ref) + ', which is located ' + str(tmp3[0][1]) + ' degrees from the pointing centre!'
-#else:
-#	print "The field will be corrected for " + str(brightest_name) + ", which has a beam attenuated flux of " + str(brightest_flux) + "Jy."
\ No newline at end of file
+	plan_peeling(options.input, skymodel_fn, options.limit, options.nsources, options.specsources, options.parset, options.verbose)
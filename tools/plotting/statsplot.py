@@ -27,8 +27,6 @@ import optparse, os
 import numpy
 
 version_string = 'v0.2, 2 March 2012\nWritten by Oscar Martinez'
-print 'statsplot.py',version_string
-print ''
 
 POL_NAMES_INDEXES = {'XX':0,'XY':1,'YX':2,'YY':3}
 POL_INDEXES_NAMES = {0:'XX',1:'XY',2:'YX',3:'YY'}
@@ -40,6 +38,66 @@ def updateMinMax(stat,minStat,maxStat,analysisIndex):
     else:
         (minStat[analysisIndex],maxStat[analysisIndex]) = (min([stat, minStat[analysisIndex]]), max([stat, maxStat[analysisIndex]]))
 
+def find_bad_stations(ant1, ant2, pol, num, mstat, sstat, mpolar=(0,1,2,3), mthres=(3,0.4,0.2), spolar=(1,2), sthres=(3,0.4,0.2), npolar=(0,), nthres=(0.4,0.3)):
+    """
+    Selects the bad stations with the same 3 analysis as main, but from arrays in memory and without any plots or files.
+    The inputs have one entry per baseline and polarization: the antenna indexes, the polarization index, the number of
+    used samples and the stats for the median (or mean) and the std analysis. Returns the indexes of the BAD stations.
+    """
+    (ant1,ant2,pol,num) = (numpy.asarray(ant1),numpy.asarray(ant2),numpy.asarray(pol),numpy.asarray(num))
+    analysispolars = (list(mpolar),list(spolar),list(npolar))
+    analysisthresholds = (mthres,sthres,nthres)
+    polarizations = sorted(set(mpolar) | set(spolar) | set(npolar))
+    use = (num != 0) & numpy.in1d(pol, polarizations)
+    stationsIndexes = numpy.unique(numpy.concatenate((ant1[use],ant2[use])))
+    numstations = len(stationsIndexes)
+    if numstations == 0:
+        return []
+    # For each analysis and polarization a station x station grid of the stat, NaN where there is no baseline
+    grids = []
+    for (values,polars) in zip((mstat,sstat,num),analysispolars):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        grid = {}
+        for polar in polars:
+            sel = use & (pol == polar)
+            (ind_1,ind_2) = (numpy.searchsorted(stationsIndexes, ant1[sel]),numpy.searchsorted(stationsIndexes, ant2[sel]))
+            grid[polar] = numpy.empty((numstations,numstations))
+            grid[polar].fill(numpy.nan)
+            grid[polar][ind_2,ind_1] = values[sel]
+            grid[polar][ind_1,ind_2] = values[sel]
+        grids.append(grid)
+    analysisBadCounter = numpy.zeros(numstations, dtype=int)
+    # First analysis and second analysis have the same algorithm
+    for analysisIndex in (0,1):
+        polars = analysispolars[analysisIndex]
+        thresholds = analysisthresholds[analysisIndex]
+        w = numpy.array([(~numpy.isnan(grids[analysisIndex][polar])).sum(axis=1) for polar in polars])
+        u = numpy.zeros(w.shape, dtype=int)
+        for (p,polar) in enumerate(polars):
+            for stationIndex in range(numstations):
+                row = grids[analysisIndex][polar][stationIndex]
+                xs = numpy.nonzero(~numpy.isnan(row))[0]
+                if len(xs) == 0:
+                    continue
+                ys = numpy.array(row[xs], dtype=numpy.float32)
+                ydiff = ys - numpy.median(ys)
+                dmask = numpy.absolute(ydiff) > (thresholds[0] * 1.48 * numpy.median(numpy.absolute(ydiff)))
+                u[p][xs[dmask]] += 1
+        wsum = w.sum(axis=0)
+        wmean = numpy.where(wsum > 0, w.mean(axis=0), 1.)
+        avg_ko = (wsum > 0) & ((((w*u).sum(axis=0) // numpy.maximum(wsum,1)) / wmean) > float(thresholds[2]))
+        pol_ko = (u > (float(thresholds[1]) * w).astype(int)).any(axis=0)
+        analysisBadCounter += avg_ko | pol_ko
+    # Third analysis
+    thresholds = analysisthresholds[2]
+    num_mean = numpy.array([numpy.where(numpy.isnan(grids[2][polar]), 0, grids[2][polar]).astype(numpy.float32).sum(axis=1) / numstations for polar in analysispolars[2]])
+    max_num_mean = numpy.maximum(num_mean.max(axis=1), 0)[:,numpy.newaxis]
+    sumnummeanavg = num_mean.mean(axis=0)
+    kostation = ((sumnummeanavg < thresholds[1]*max_num_mean) | (num_mean.astype(int) < thresholds[0]*max_num_mean)).any(axis=0)
+    analysisBadCounter += kostation
+    # We set a BAD flag if at least two analysis said so
+    return list(stationsIndexes[analysisBadCounter > 1])
+
 def main(opts):
     # Check the input file path
     absPath = opts.input
@@ -341,19 +399,22 @@ def main(opts):
         outputfile.close()
         
 
-opt = optparse.OptionParser()
-opt.add_option('-i','--input',help='Input stats file',default='')
-opt.add_option('-m','--mean',default=False,help='In the median analysis use mean instead? [default False]',action='store_true')
-opt.add_option('-q','--mpolar',help='In the median (or mean) analysis: polarizations to use [default is 0,1,2,3]',default='0,1,2,3')
-opt.add_option('-c','--mcoord',help='In the median (or mean) analysis: complex coordinate to use (amp,phase,real or imag) [default is amp]',default='amp')
-opt.add_option('-t','--mthres',help='In the median (or mean) analysis: The thresholds to use. Provide them comma-separated. First threshold is for candidates, second one is for each polarization and third one is for average of polarizations [default is 3,0.4,0.2]',default='3,0.4,0.2')
-opt.add_option('-r','--spolar',help='In the std analysis: polarizations to use [default is 1,2]',default='1,2')
-opt.add_option('-s','--scoord',help='In the std analysis: complex coordinate to use (amp,phase,real or imag) [default is real]',default='real')
-opt.add_option('-e','--sthres',help='In the std analysis: The thresholds to use. [default is 3,0.4,0.2]',default='3,0.4,0.2')
-opt.add_option('-n','--npolar',help='In the num analysis: polarizations to use [default is 0]',default='0')
-opt.add_option('-l','--nthres',help='In the num analysis: The thresholds to use. In this case there are only two threshold [default is 0.4,0.3]',default='0.4,0.3')
-opt.add_option('-o','--out',default='',help='Output basename [default \'\' means to show the plot/table instead of save it] Filenames will be <basename>-<mean,median,std or num>.<extension> for the plots and <basename>-tab for the table',type='string')
-opt.add_option('-x','--ext',default='pdf',help='Image filename extension [default pdf]',type='string')
-options, arguments = opt.parse_args()
+if __name__ == '__main__':
+    print 'statsplot.py',version_string
+    print ''
+    opt = optparse.OptionParser()
+    opt.add_option('-i','--input',help='Input stats file',default='')
+    opt.add_option('-m','--mean',default=False,help='In the median analysis use mean instead? [default False]',action='store_true')
+    opt.add_option('-q','--mpolar',help='In the median (or mean) analysis: polarizations to use [default is 0,1,2,3]',default='0,1,2,3')
+    opt.add_option('-c','--mcoord',help='In the median (or mean) analysis: complex coordinate to use (amp,phase,real or imag) [default is amp]',default='amp')
+    opt.add_option('-t','--mthres',help='In the median (or mean) analysis: The thresholds to use. Provide them comma-separated. First threshold is for candidates, second one is for each polarization and third one is for average of polarizations [default is 3,0.4,0.2]',default='3,0.4,0.2')
+    opt.add_option('-r','--spolar',help='In the std analysis: polarizations to use [default is 1,2]',default='1,2')
+    opt.add_option('-s','--scoord',help='In the std analysis: complex coordinate to use (amp,phase,real or imag) [default is real]',default='real')
+    opt.add_option('-e','--sthres',help='In the std analysis: The thresholds to use. [default is 3,0.4,0.2]',default='3,0.4,0.2')
+    opt.add_option('-n','--npolar',help='In the num analysis: polarizations to use [default is 0]',default='0')
+    opt.add_option('-l','--nthres',help='In the num analysis: The thresholds to use. In this case there are only two threshold [default is 0.4,0.3]',default='0.4,0.3')
+    opt.add_option('-o','--out',default='',help='Output basename [default \'\' means to show the plot/table instead of save it] Filenames will be <basename>-<mean,median,std or num>.<extension> for the plots and <basename>-tab for the table',type='string')
+    opt.add_option('-x','--ext',default='pdf',help='Image filename extension [default pdf]',type='string')
+    options, arguments = opt.parse_args()
 
-main(options)
\ No newline at end of file
+    main(options)
\ No newline at end of file
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+# Local sky catalogue used in place of gsm.py to make the field models.
+# Source lists in makesourcedb format (e.g. VLSS, WENSS and NVSS exports) are parsed once into a declination zone index,
+# stored in an index directory (the run's cache or working directory), so the cone searches for all the beams only read
+# the zones they overlap. As with gsm.py, sources from several lists lying within the association radius of each other
+# are taken to be the same source and only kept once.
+
+import optparse
+import os
+import hashlib
+import numpy as np
+
+def split_fields(text):
+	"""
+	Splits a makesourcedb line or format string at the commas that are not inside brackets or quotes.
+	"""
+	fields=[]
+	depth=0
+	quote=False
+	start=0
+	for i, c in enumerate(text):
+		if c=="'":
+			quote=not quote
+		elif c=='[' and not quote:
+			depth+=1
+		elif c==']' and not quote:
+			depth-=1
+		elif c==',' and depth==0 and not quote:
+			fields.append(text[start:i].strip())
+			start=i+1
+	fields.append(text[start:].strip())
+	return fields
+
+def parse_format(line):
+	"""
+	Returns the column names (lower case) of a makesourcedb format line, in either the '# (Name, ...) = format' \
+	or the 'format = Name, ...' form, together with the full field definitions used to compare layouts.
+	"""
+	text=line.strip().lstrip('#').strip()
+	if text.startswith('('):
+		text=text[1:text.rindex(')')]
+	else:
+		text=text.split('=', 1)[1]
+	fields=split_fields(text)
+	return [f.split('=')[0].strip().lower() for f in fields], tuple(f.replace(" ", "") for f in fields)
+
+def source_position(ra, dec):
+	"""
+	Converts a makesourcedb ra (hh:mm:ss.s) and dec (+dd.mm.ss.s) to degrees.
+	"""
+	h=[float(i) for i in ra.strip().split(':')]
+	ra_deg=(h[0]+h[1]/60.+h[2]/3600.)*15.
+	dec=dec.strip()
+	d=dec.lstrip('+-').split('.')
+	dec_deg=float(d[0])+float(d[1])/60.+float('.'.join(d[2:]))/3600.
+	if dec.startswith('-'):
+		dec_deg=-dec_deg
+	return ra_deg, dec_deg
+
+def read_source_list(f):
+	"""
+	Reads the sources of a makesourcedb format source list, finding the Ra, Dec and I columns from its format line. \
+	Returns the format line, the layout, and lists of the source lines, ra and dec (deg) and fluxes.
+	"""
+	header=""
+	columns=None
+	lines=[]
+	ras=[]
+	decs=[]
+	fluxes=[]
+	for line in open(f):
+		if line.strip()=="":
+			continue
+		if line[0]=='#' or line.lower().startswith('format'):
+			if columns is None and (line.lower().startswith('format') or line.lower().rstrip().endswith('format')):
+				header=line if line.endswith('\n') else line+'\n'
+				columns, layout=parse_format(line)
+				for c in ('ra', 'dec', 'i'):
+					if c not in columns:
+						raise ValueError("Format line of {0} has no {1} column".format(f, c))
+			continue
+		if columns is None:
+			raise ValueError("Source list {0} has no format line before its first source".format(f))
+		sline=split_fields(line)
+		ra, dec=source_position(sline[columns.index('ra')], sline[columns.index('dec')])
+		lines.append(line if line.endswith('\n') else line+'\n')
+		ras.append(ra)
+		decs.append(dec)
+		fluxes.append(float(sline[columns.index('i')]))
+	if columns is None:
+		raise ValueError("Source list {0} has no format line".format(f))
+	return header, layout, lines, np.array(ras), np.array(decs), np.array(fluxes)
+
+def unit_vectors(ra, dec):
+	"""
+	Cartesian unit vectors of positions in degrees.
+	"""
+	ra=np.radians(ra)
+	dec=np.radians(dec)
+	return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+def associated(ra, dec, ref_ra, ref_dec, asth):
+	"""
+	Flags the sources lying within asth (deg) of any of the reference sources. The positions are hashed into cells of \
+	size asth on the unit sphere, so only the reference sources of the 27 neighbouring cells are compared.
+	"""
+	found=np.zeros(len(ra), dtype=bool)
+	if len(ra)==0 or len(ref_ra)==0:
+		return found
+	size=np.radians(asth)
+	n=int(np.ceil(1./size))+1
+	def keys(cells):
+		return ((cells[:,0]+n)*(2*n+1)+(cells[:,1]+n))*(2*n+1)+(cells[:,2]+n)
+	xyz=unit_vectors(ra, dec)
+	ref_xyz=unit_vectors(ref_ra, ref_dec)
+	ref_keys=keys(np.floor(ref_xyz/size).astype(np.int64))
+	order=np.argsort(ref_keys, kind='mergesort')
+	ref_keys=ref_keys[order]
+	ref_xyz=ref_xyz[order]
+	cells=np.floor(xyz/size).astype(np.int64)
+	mincos=np.cos(size)
+	for dx in (-1, 0, 1):
+		for dy in (-1, 0, 1):
+			for dz in (-1, 0, 1):
+				k=keys(cells+np.array([dx, dy, dz]))
+				first=np.searchsorted(ref_keys, k, side='left')
+				last=np.searchsorted(ref_keys, k, side='right')
+				#cells rarely hold more than one source, so step through them together
+				for j in xrange(int((last-first).max())):
+					has=(first+j) < last
+					idx=np.minimum(first+j, len(ref_keys)-1)
+					close=np.sum(xyz*ref_xyz[idx], axis=1) >= mincos
+					found|=has & close
+	return found
+
+def read_catalogue(files, asth=0.00278):
+	"""
+	Reads the sources of one or more source lists, which must share the same format line as the source lines are kept \
+	unchanged. Sources within asth (deg) of a source of an earlier list are dropped, so each source is only counted \
+	once, with the flux and spectrum of the first list given. Returns the format line and lists of the source lines, \
+	ra and dec (deg) and fluxes.
+	"""
+	header=""
+	layout=None
+	lines=[]
+	ras=np.array([])
+	decs=np.array([])
+	fluxes=np.array([])
+	for f in files:
+		thisheader, thislayout, thislines, ra, dec, flux=read_source_list(f)
+		if layout is None:
+			header, layout=thisheader, thislayout
+		elif thislayout!=layout:
+			raise ValueError("Format of {0} differs from that of {1}, the source lists must share one format".format(f, files[0]))
+		keep=~associated(ra, dec, ras, decs, asth)
+		lines+=[l for l, k in zip(thislines, keep) if k]
+		ras=np.concatenate((ras, ra[keep]))
+		decs=np.concatenate((decs, dec[keep]))
+		fluxes=np.concatenate((fluxes, flux[keep]))
+	return header, lines, ras, decs, fluxes
+
+def index_name(files, indexdir):
+	"""
+	Name of the index file of a catalogue in indexdir, named by the hash of the catalogue file paths.
+	"""
+	paths="\0".join(os.path.abspath(f) for f in files)
+	return os.path.join(indexdir, "catalogue_{0}.zones.npz".format(hashlib.sha1(paths).hexdigest()))
+
+def catalogue_stamp(files):
+	"""
+	Sizes and modification times of the catalogue files, stored with the index to tell when it needs rebuilding.
+	"""
+	stamp=[]
+	for f in files:
+		st=os.stat(f)
+		stamp+=[st.st_size, st.st_mtime]
+	return np.array(stamp)
+
+def build_index(files, indexdir, zone=1.0, asth=0.00278):
+	"""
+	Parses the catalogue files and sorts the sources by declination zone of height zone (deg) and by ra within each zone. \
+	Saves the index with the offset of each zone in indexdir and returns it as a dictionary.
+	"""
+	header, lines, ra, dec, flux=read_catalogue(files, asth)
+	zones=np.floor((dec+90.)/zone).astype(int)
+	order=np.lexsort((ra, zones))
+	nzones=int(np.ceil(180./zone))+1
+	index={"header":header, "lines":np.array(lines)[order], "ra":ra[order], "dec":dec[order],
+	"flux":flux[order], "offsets":np.searchsorted(zones[order], np.arange(nzones+1)), "zone":zone, "asth":asth, "stamp":catalogue_stamp(files)}
+	if not os.path.isdir(indexdir):
+		try:
+			os.makedirs(indexdir)
+		except OSError:
+			pass
+	output=index_name(files, indexdir)
+	tmp="{0}.tmp{1}.npz".format(output[:-4], os.getpid())
+	np.savez(tmp, **index)
+	os.rename(tmp, output)
+	return index
+
+def load_index(files, indexdir, zone=1.0, asth=0.00278):
+	"""
+	Loads the zone index of a catalogue from indexdir, building it first if it is missing, made with other settings \
+	or older than the catalogue files.
+	"""
+	output=index_name(files, indexdir)
+	if os.path.isfile(output):
+		stored=np.load(output)
+		if float(stored["zone"])==zone and float(stored["asth"])==asth and np.array_equal(stored["stamp"], catalogue_stamp(files)):
+			index=dict((k, stored[k]) for k in stored.files)
+			index["header"]=str(index["header"])
+			index["zone"]=float(index["zone"])
+			return index
+	return build_index(files, indexdir, zone, asth)
+
+def cone_search(index, centres, radius, cut=0.0):
+	"""
+	Finds the sources within radius (deg) of each (ra, dec) centre that are brighter than cut (Jy). \
+	Returns a list of the catalogue lines of each cone, brightest first.
+	"""
+	d2r=np.pi/180.
+	zone=index["zone"]
+	offsets=index["offsets"]
+	results=[]
+	for ra, dec in centres:
+		lo=int(np.floor((max(dec-radius, -90.)+90.)/zone))
+		hi=int(np.floor((min(dec+radius, 90.)+90.)/zone))
+		rows=slice(offsets[lo], offsets[min(hi+1, len(offsets)-1)])
+		zra=index["ra"][rows]
+		zdec=index["dec"][rows]
+		cosdist=np.sin(dec*d2r)*np.sin(zdec*d2r)+np.cos(dec*d2r)*np.cos(zdec*d2r)*np.cos((ra-zra)*d2r)
+		inside=(cosdist >= np.cos(radius*d2r)) & (index["flux"][rows] >= cut)
+		found=np.nonzero(inside)[0]
+		found=found[np.argsort(-index["flux"][rows][found], kind='mergesort')]
+		results.append([str(l) for l in index["lines"][rows][found]])
+	return results
+
+def write_model(output, header, lines):
+	"""
+	Writes a makesourcedb sky model with the catalogue format line followed by the source lines.
+	"""
+	f=open(output, 'w')
+	if header!="":
+		f.write(header)
+	f.writelines(lines)
+	f.close()
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage="%prog [options] catalogue[,catalogue...] output ra dec radius")
+	parser.add_option("-c", "--cut", action="store", type="float", dest="cut", default=0.1, help="Minimum flux of the sources in Jy [default: %default]")
+	parser.add_option("-a", "--asth", action="store", type="float", dest="asth", default=0.00278, help="Association radius in deg within which sources of different catalogues are the same source [default: %default]")
+	parser.add_option("-z", "--zone", action="store", type="float", dest="zone", default=1.0, help="Height of the declination zones of the index in deg [default: %default]")
+	parser.add_option("-d", "--indexdir", action="store", type="string", dest="indexdir", default=".", help="Directory in which to keep the catalogue index [default: %default]")
+	(options, args) = parser.parse_args()
+	files=args[0].split(",")
+	index=load_index(files, options.indexdir, options.zone, options.asth)
+	lines=cone_search(index, [(float(args[2]), float(args[3]))], float(args[4]), options.cut)[0]
+	write_model(args[1], index["header"], lines)
+	print "{0} sources written to {1}".format(len(lines), args[1])